@@ -28,6 +28,38 @@ import ssl
 import time
 
 
+try:
+    from devpi_server.fileutil import compress_entry
+    from devpi_server.fileutil import decompress_entry
+    from devpi_server.fileutil import dumps_indexed_entry
+    from devpi_server.fileutil import is_indexed_entry
+    from devpi_server.fileutil import loads_entry
+    from devpi_server.fileutil import loads_entry_value
+    from devpi_server.fileutil import plain_entry
+except ImportError:
+    # older devpi-server without support for compressed
+    # or indexed changelog entries
+    compress_entry = dumps_indexed_entry = loads_entry_value = None
+    loads_entry = loads
+
+    def decompress_entry(data):
+        return data
+
+    def is_indexed_entry(data):  # noqa: ARG001
+        return False
+
+    plain_entry = decompress_entry
+
+
+try:
+    from devpi_server.cache import KeynameMatcher
+    from devpi_server.cache import SizedLRUCache
+    from devpi_server.keyfs_sqlite import get_sized_cache_metrics
+except ImportError:
+    # older devpi-server without caches bounded by memory
+    SizedLRUCache = None
+
+
 for name in ('IStorageConnection3', 'IStorageConnection2', 'IStorageConnection'):
     IStorageConnection3 = getattr(ds_interfaces, name, Interface)
     if IStorageConnection3 is not Interface:
@@ -247,6 +279,8 @@ class Connection:
             if changes is not absent and relpath in changes:
                 (keyname, back_serial, value) = changes[relpath]
                 result = (serial, back_serial, value)
+        if result is absent and self.storage.current_values:
+            result = self._get_current_relpath_at(relpath, serial)
         if result is absent:
             result = get_relpath_at(self, relpath, serial)
         if gettotalsizeof(result, maxlen=100000) is None:
@@ -258,6 +292,32 @@ class Connection:
             self._relpath_cache.put((serial, relpath), result)
         return result
 
+    def _get_current_relpath_at(self, relpath, serial):
+        q = """
+            SELECT serial, back_serial, data
+            FROM kv_current
+            WHERE key = :relpath"""
+        res = self.fetchone(q, relpath=relpath)
+        if res is None:
+            raise KeyError(relpath)
+        (last_serial, back_serial, data) = res
+        if last_serial > serial:
+            # changed after the requested serial, use the changelog
+            return absent
+        return (last_serial, back_serial, ensure_deeply_readonly(loads(data)))
+
+    def db_write_current_value(self, relpath, serial, back_serial, value):
+        q = """
+            INSERT INTO kv_current(key, serial, back_serial, data)
+                VALUES (:relpath, :serial, :back_serial, :data)
+            ON CONFLICT (key) DO UPDATE
+                SET serial = EXCLUDED.serial,
+                    back_serial = EXCLUDED.back_serial,
+                    data = EXCLUDED.data;"""
+        self._sqlconn.run(
+            q, relpath=relpath, serial=serial, back_serial=back_serial,
+            data=pg8000.Binary(dumps(value)))
+
     def iter_relpaths_at(self, typedkeys, at_serial):
         keynames = frozenset(k.name for k in typedkeys)
         keyname_id_values = {"keynameid%i" % i: k for i, k in enumerate(keynames)}
@@ -273,17 +333,58 @@ class Connection:
                 continue
             changes = self.get_changes(serial)
             for relpath, keyname, serial in rows:
-                (keyname, back_serial, val) = changes[relpath]
+                change = changes.get(relpath)
+                if change is None:
+                    change = self.get_snapshot_change(serial, relpath)
+                (keyname, back_serial, val) = change
                 yield RelpathInfo(
                     relpath=relpath, keyname=keyname,
                     serial=serial, back_serial=back_serial,
                     value=val)
 
+    def iter_relpaths_with_prefix(self, prefix, at_serial, typedkeys=None):
+        """ Iterate over the relpaths starting with ``prefix`` which exist
+            at ``at_serial`` in sorted order, optionally limited to the
+            given typed keys. This is a scan on the primary key of the
+            kv table instead of a walk through the changelog. """
+        pattern = "%s%%" % (
+            prefix.replace("\\", "\\\\")
+            .replace("%", "\\%").replace("_", "\\_"))
+        kw = dict(pattern=pattern)
+        q = "SELECT key, keyname, serial FROM kv WHERE key LIKE :pattern"
+        if typedkeys is not None:
+            keynames = sorted(frozenset(k.name for k in typedkeys))
+            keyname_id_values = {
+                "keynameid%i" % i: k for i, k in enumerate(keynames)}
+            q = "%s AND keyname IN (%s)" % (
+                q, ", ".join(':' + x for x in keyname_id_values))
+            kw.update(keyname_id_values)
+        q = f'{q} ORDER BY key COLLATE "C"'
+        for relpath, keyname, _serial in self._sqlconn.run(q, **kw):
+            try:
+                (serial, back_serial, val) = self.get_relpath_at(
+                    relpath, at_serial)
+            except KeyError:
+                # created after at_serial
+                continue
+            if val is None:
+                # deleted
+                continue
+            yield RelpathInfo(
+                relpath=relpath, keyname=keyname,
+                serial=serial, back_serial=back_serial,
+                value=val)
+
     def write_changelog_entry(self, serial, entry):
         threadlog.debug("writing changelog for serial %s", serial)
         q = """
             INSERT INTO changelog (serial, data) VALUES (:serial, :data);"""
-        data = dumps(entry)
+        if self.storage.indexed_changelog:
+            data = dumps_indexed_entry(*entry)
+        else:
+            data = dumps(entry)
+        if self.storage.compress_changelog:
+            data = compress_entry(data)
         self._sqlconn.run(q, serial=serial, data=pg8000.Binary(data))
 
     def io_file_os_path(self, path):  # noqa: ARG002
@@ -416,6 +517,18 @@ class Connection:
         self.dirty_files[path] = None
 
     def get_raw_changelog_entry(self, serial):
+        data = self.get_stored_changelog_entry(serial)
+        if data is not None:
+            return plain_entry(data)
+        return None
+
+    def _get_entry(self, serial):
+        data = self.get_stored_changelog_entry(serial)
+        if data is None:
+            return None
+        return decompress_entry(data)
+
+    def get_stored_changelog_entry(self, serial):
         # because a sequence is used for the next serial, there might be
         # missing serials in the changelog table if there was a conflict
         # during commit
@@ -437,20 +550,101 @@ class Connection:
             ON changelog.serial=serial.serial;"""
         return self.fetchscalar(q, serial=serial)
 
+    def _get_changes_from_entry(self, serial, data):
+        changes, rel_renames = loads_entry(data)
+        # make values in changes read only so no calling site accidentally
+        # modifies data
+        changes = ensure_deeply_readonly(changes)
+        assert isinstance(changes, ReadonlyView)
+        self._changelog_cache.put(serial, changes)
+        return changes
+
     def get_changes(self, serial):
         changes = self._changelog_cache.get(serial, absent)
         if changes is absent:
-            data = self.get_raw_changelog_entry(serial)
-            changes, rel_renames = loads(data)
-            # make values in changes read only so no calling site accidentally
-            # modifies data
-            changes = ensure_deeply_readonly(changes)
-            assert isinstance(changes, ReadonlyView)
-            self._changelog_cache.put(serial, changes)
+            changes = self._get_changes_from_entry(
+                serial, self._get_entry(serial))
         return changes
 
-    def write_transaction(self):
-        return Writer(self.storage, self)
+    def get_change(self, serial, relpath):
+        changes = self._changelog_cache.get(serial, absent)
+        if changes is absent:
+            data = self._get_entry(serial)
+            if not is_indexed_entry(data):
+                changes = self._get_changes_from_entry(serial, data)
+        if changes is absent:
+            try:
+                return ensure_deeply_readonly(loads_entry_value(data, relpath))
+            except KeyError:
+                return self.get_snapshot_change(serial, relpath)
+        result = changes.get(relpath)
+        if result is None:
+            result = self.get_snapshot_change(serial, relpath)
+        return result
+
+    def get_snapshot_change(self, serial, relpath):
+        """ Returns ``(keyname, back_serial, value)`` for relpath if it
+        was imported from a snapshot at serial or None. """
+        q = """
+            SELECT keyname, data FROM kv_snapshot
+            WHERE serial = :serial AND key = :relpath"""
+        res = self.fetchone(q, serial=serial, relpath=relpath)
+        if res is None:
+            return None
+        (keyname, data) = res
+        return (keyname, -1, ensure_deeply_readonly(loads(data)))
+
+    def get_snapshot_changes(self, serial, after_relpath, limit):
+        """ Returns up to ``limit`` items of ``(relpath, (keyname,
+        back_serial, value))`` imported from a snapshot at serial,
+        sorted by relpath and starting after ``after_relpath``. """
+        q = """
+            SELECT key, keyname, data FROM kv_snapshot
+            WHERE serial = :serial AND key > :relpath
+            ORDER BY key LIMIT :limit"""
+        rows = self._sqlconn.run(
+            q, serial=serial, relpath=after_relpath, limit=limit)
+        return [
+            (relpath, (keyname, -1, ensure_deeply_readonly(loads(data))))
+            for relpath, keyname, data in rows]
+
+    def db_clear_snapshot_values(self):
+        """ Remove all keys, used to clean up after an incomplete
+        snapshot import into an empty storage. """
+        self.begin()
+        self._lock()
+        self._sqlconn.run("DELETE FROM kv")
+        self._sqlconn.run("DELETE FROM kv_snapshot")
+        if self.storage.current_values:
+            self._sqlconn.run("DELETE FROM kv_current")
+
+    def db_write_snapshot_values(self, serial, items):
+        """ Write the ``(relpath, keyname, value)`` items of a snapshot at
+        serial. The values are stored outside of the changelog, so the
+        snapshot can be written in several batches. """
+        q_kv = """
+            INSERT INTO kv(key, keyname, serial)
+                VALUES (:relpath, :keyname, :serial)
+            ON CONFLICT (key) DO UPDATE
+                SET keyname = EXCLUDED.keyname, serial = EXCLUDED.serial;"""
+        q_snapshot = """
+            INSERT INTO kv_snapshot(key, keyname, serial, data)
+                VALUES (:relpath, :keyname, :serial, :data)
+            ON CONFLICT (serial, key) DO UPDATE
+                SET keyname = EXCLUDED.keyname, data = EXCLUDED.data;"""
+        self.begin()
+        self._lock()
+        for relpath, keyname, value in items:
+            self._sqlconn.run(
+                q_kv, relpath=relpath, keyname=keyname, serial=serial)
+            self._sqlconn.run(
+                q_snapshot, relpath=relpath, keyname=keyname, serial=serial,
+                data=pg8000.Binary(dumps(value)))
+            if self.storage.current_values:
+                self.db_write_current_value(relpath, serial, -1, value)
+
+    def write_transaction(self, serial=None):
+        return Writer(self.storage, self, serial=serial)
 
     def _copy_file_write(self, path, f):
         assert not os.path.isabs(path)
@@ -561,8 +755,31 @@ class Storage:
                     data BYTEA NOT NULL
                 )
             """))
+    current_values_schema = dict(
+        table=dict(
+            kv_current="""
+                CREATE TABLE kv_current (
+                    key TEXT NOT NULL PRIMARY KEY,
+                    serial INTEGER NOT NULL,
+                    back_serial INTEGER NOT NULL,
+                    data BYTEA NOT NULL
+                )
+            """))
+    snapshot_schema = dict(
+        table=dict(
+            kv_snapshot="""
+                CREATE TABLE kv_snapshot (
+                    key TEXT NOT NULL,
+                    keyname TEXT NOT NULL,
+                    serial INTEGER NOT NULL,
+                    data BYTEA NOT NULL,
+                    PRIMARY KEY (serial, key)
+                )
+            """))
 
-    def __init__(self, basedir, notify_on_commit, cache_size, settings=None):
+    def __init__(self, basedir, notify_on_commit, cache_size, settings=None,
+                 current_values=False, compress_changelog=False,
+                 indexed_changelog=False, cache_memory=None):
         if settings is None:
             settings = {}
         for key in ("database", "host", "port", "unix_sock", "user", "password"):
@@ -583,16 +800,30 @@ class Storage:
 
         self.use_copy = as_bool(settings.get("use_copy", os.environ.get(
             "DEVPI_PG_USE_COPY", self.use_copy)))
+        self.current_values = as_bool(settings.get(
+            "current_values", current_values))
+        self.compress_changelog = compress_entry is not None and as_bool(
+            settings.get("compress_changelog", compress_changelog))
+        self.indexed_changelog = dumps_indexed_entry is not None and as_bool(
+            settings.get("indexed_changelog", indexed_changelog))
         self.basedir = basedir
         self._notify_on_commit = notify_on_commit
-        if gettotalsizeof(0) is None:
-            # old devpi_server version doesn't have a working gettotalsizeof
-            changelog_cache_size = cache_size
+        self._keyname_matcher = None
+        if cache_memory and SizedLRUCache is not None:
+            # a single cache for both, as the size of the values
+            # is taken into account
+            self._keyname_matcher = KeynameMatcher()
+            self._changelog_cache = self._relpath_cache = SizedLRUCache(
+                cache_memory, get_keyname=self._keyname_matcher)
         else:
-            changelog_cache_size = max(1, cache_size // 20)
-        relpath_cache_size = max(1, cache_size - changelog_cache_size)
-        self._changelog_cache = LRUCache(changelog_cache_size)  # is thread safe
-        self._relpath_cache = LRUCache(relpath_cache_size)  # is thread safe
+            if gettotalsizeof(0) is None:
+                # old devpi_server version doesn't have a working gettotalsizeof
+                changelog_cache_size = cache_size
+            else:
+                changelog_cache_size = max(1, cache_size // 20)
+            relpath_cache_size = max(1, cache_size - changelog_cache_size)
+            self._changelog_cache = LRUCache(changelog_cache_size)  # is thread safe
+            self._relpath_cache = LRUCache(relpath_cache_size)  # is thread safe
         self.last_commit_timestamp = time.time()
         self.ensure_tables_exist()
 
@@ -600,7 +831,8 @@ class Storage:
         pass
 
     def add_key(self, key):
-        pass
+        if self._keyname_matcher is not None:
+            self._keyname_matcher.add_key(key)
 
     def get_connection(self, *, closing=True, write=False, timeout=30):  # noqa: ARG002
         sqlconn = pg8000.native.Connection(
@@ -637,10 +869,50 @@ class Storage:
                 result.setdefault("sequence", {})[row[0]] = ""
         return result
 
+    def _get_expected_schema(self):
+        expected_schema = {
+            kind: dict(objs) for kind, objs in self.expected_schema.items()}
+        for kind, objs in self.snapshot_schema.items():
+            expected_schema.setdefault(kind, {}).update(objs)
+        if self.current_values:
+            for kind, objs in self.current_values_schema.items():
+                expected_schema.setdefault(kind, {}).update(objs)
+        return expected_schema
+
+    def _drop_current_values(self, schema):
+        names = [
+            name for name in self.current_values_schema.get("table", {})
+            if name in schema.get("table", {})]
+        if not names:
+            return
+        # the table isn't updated anymore, so it would be stale
+        # if the option is enabled again later
+        threadlog.info("DB: Removing current values table")
+        with self.get_connection() as conn:
+            sqlconn = conn.begin()
+            for name in names:
+                sqlconn.run(f"DROP TABLE {pg8000.native.identifier(name)}")
+            conn.commit()
+
+    def _fill_current_values(self):
+        with self.get_connection() as conn:
+            sqlconn = conn.begin()
+            conn._lock()
+            rows = sqlconn.run("SELECT key, serial FROM kv ORDER BY serial")
+            if rows:
+                threadlog.info(
+                    "DB: Filling current values table for %s keys", len(rows))
+            for relpath, serial in rows:
+                (_keyname, back_serial, value) = conn.get_change(serial, relpath)
+                conn.db_write_current_value(relpath, serial, back_serial, value)
+            conn.commit()
+
     def ensure_tables_exist(self):
         schema = self._reflect_schema()
+        if not self.current_values:
+            self._drop_current_values(schema)
         missing = dict()
-        for kind, objs in self.expected_schema.items():
+        for kind, objs in self._get_expected_schema().items():
             for name, q in objs.items():
                 if name not in schema.get(kind, set()):
                     missing.setdefault(kind, dict())[name] = q
@@ -666,6 +938,19 @@ class Storage:
                 assert not objs
             conn.commit()
         assert not missing
+        if self.current_values and "kv_current" not in schema.get("table", {}):
+            self._fill_current_values()
+
+
+@devpiserver_hookimpl
+def devpiserver_metrics(request):
+    xom = request.registry["xom"]
+    storage = xom.keyfs._storage
+    if not isinstance(storage, Storage) or SizedLRUCache is None:
+        return []
+    if not isinstance(storage._relpath_cache, SizedLRUCache):
+        return []
+    return get_sized_cache_metrics(storage._relpath_cache)
 
 
 @devpiserver_hookimpl
@@ -677,9 +962,10 @@ def devpiserver_storage_backend(settings):
 
 
 class Writer:
-    def __init__(self, storage, conn):
+    def __init__(self, storage, conn, serial=None):
         self.conn = conn
         self.storage = storage
+        self.serial = serial
 
     def record_set(self, typedkey, value=None, back_serial=None):
         """ record setting typedkey to value (None means it's deleted) """
@@ -700,8 +986,14 @@ class Writer:
     def __enter__(self):
         self.conn.begin()
         self.conn._lock()
-        q = """SELECT nextval('changelog_serial_seq');"""
-        self.commit_serial = self.conn.fetchscalar(q)
+        if self.serial is None:
+            q = """SELECT nextval('changelog_serial_seq');"""
+            self.commit_serial = self.conn.fetchscalar(q)
+        else:
+            # when importing a snapshot there are no previous serials,
+            # the sequence continues after the given serial
+            q = """SELECT setval('changelog_serial_seq', :serial);"""
+            self.commit_serial = self.conn.fetchscalar(q, serial=self.serial)
         self.log = thread_push_log("fswriter%s:" % self.commit_serial)
         self.changes = {}
         return self
@@ -721,6 +1013,9 @@ class Writer:
                         # update back_serial for write_changelog_entry
                         self.changes[relpath] = (keyname, back_serial, value)
                     self._db_write_typedkey(relpath, keyname, commit_serial)
+                    if self.storage.current_values:
+                        self.conn.db_write_current_value(
+                            relpath, commit_serial, back_serial, value)
                 entry = (self.changes, [])
                 self.conn.write_changelog_entry(commit_serial, entry)
                 self.conn.commit()
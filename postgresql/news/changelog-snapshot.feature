@@ -0,0 +1 @@
+Support importing a changelog snapshot from the primary in batches. The imported values are stored in a new ``kv_snapshot`` table instead of a single changelog entry.
@@ -0,0 +1 @@
+Support the ``--keyfs-cache-memory`` option of devpi-server including metrics per key name.
@@ -0,0 +1 @@
+Support compressed changelog entries with the ``--keyfs-compress-changelog`` option of devpi-server or the ``compress_changelog`` storage setting.
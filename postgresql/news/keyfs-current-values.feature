@@ -0,0 +1 @@
+Support the ``--keyfs-current-values`` option of devpi-server, which can also be enabled with the ``current_values=yes`` storage setting.
@@ -0,0 +1 @@
+Support indexed changelog entries with the ``--keyfs-indexed-changelog`` option of devpi-server or the ``indexed_changelog`` storage setting.
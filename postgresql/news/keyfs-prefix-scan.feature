@@ -0,0 +1 @@
+Support ``iter_relpaths_with_prefix`` for scanning keys below a relpath prefix.
@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+from .sizeof import gettotalsizeof
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+import threading
+
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+    from collections.abc import Hashable
+    from typing import Any
+
+
+# approximate memory used per entry for the key and the bookkeeping
+ENTRY_OVERHEAD = 200
+
+
+class KeynameStats:
+    __slots__ = ("evictions", "hits", "misses", "size")
+
+    def __init__(self) -> None:
+        self.evictions = 0
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+
+
+class KeynameMatcher:
+    """ Returns the key name for keys of the storage caches, which are
+    either a serial for whole changelog entries, or a tuple of serial and
+    relpath. The key names are looked up from the registered keys. """
+
+    def __init__(self) -> None:
+        self.names: dict[str, str] = {}
+        self.patterns: list[tuple[Any, str]] = []
+
+    def add_key(self, key: Any) -> None:
+        rex_reverse = getattr(key, "rex_reverse", None)
+        if rex_reverse is None:
+            self.names[key.relpath] = key.name
+        else:
+            self.patterns.append((rex_reverse, key.name))
+
+    def __call__(self, cache_key: Hashable) -> str | None:
+        if not isinstance(cache_key, tuple):
+            return None
+        relpath = cache_key[1]
+        name = self.names.get(relpath)
+        if name is not None:
+            return name
+        for rex_reverse, name in self.patterns:
+            if rex_reverse.match(relpath) is not None:
+                return name
+        return "unknown"
+
+
+class SizedLRUCache:
+    """ A LRU cache bounded by the approximate memory used by the values
+    instead of the number of entries.
+
+    It has the same interface and statistics as ``repoze.lru.LRUCache``,
+    the ``size`` attribute is the maximum memory in bytes though.
+    If ``get_keyname`` is given, it is called with cache keys to
+    collect statistics per key name in ``keyname_stats``.
+    """
+
+    def __init__(
+        self,
+        size: int,
+        get_keyname: Callable[[Hashable], str] | None = None,
+    ) -> None:
+        size = int(size)
+        if size < 1:
+            raise ValueError("size must be greater than zero")
+        self.size = size
+        self.get_keyname = get_keyname
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self) -> None:
+        """ Remove all entries from the cache. """
+        with self.lock:
+            self.data: OrderedDict[Hashable, tuple[Any, int, str | None]] = OrderedDict()
+            self.memory = 0
+            self.evictions = 0
+            self.hits = 0
+            self.misses = 0
+            self.lookups = 0
+            self.keyname_stats: dict[str | None, KeynameStats] = {}
+
+    def _get_stats(self, keyname: str | None) -> KeynameStats:
+        stats = self.keyname_stats.get(keyname)
+        if stats is None:
+            stats = self.keyname_stats[keyname] = KeynameStats()
+        return stats
+
+    def _get_keyname(self, key: Hashable) -> str | None:
+        if self.get_keyname is None:
+            return None
+        return self.get_keyname(key)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """ Return value for key. If not in cache, return default. """
+        with self.lock:
+            self.lookups += 1
+            entry = self.data.get(key)
+            if entry is None:
+                self.misses += 1
+                if self.get_keyname is not None:
+                    self._get_stats(self._get_keyname(key)).misses += 1
+                return default
+            self.hits += 1
+            self.data.move_to_end(key)
+            (val, _size, keyname) = entry
+            if self.get_keyname is not None:
+                self._get_stats(keyname).hits += 1
+            return val
+
+    def put(self, key: Hashable, val: Any) -> None:
+        """ Add key to the cache with value val.
+        Values which are bigger than the whole cache aren't added. """
+        size = gettotalsizeof(val, maxlen=self.size)
+        if size is None:
+            self.invalidate(key)
+            return
+        size += ENTRY_OVERHEAD
+        keyname = self._get_keyname(key)
+        with self.lock:
+            old_entry = self.data.pop(key, None)
+            if old_entry is not None:
+                self._remove_entry(old_entry)
+            self.data[key] = (val, size, keyname)
+            self.memory += size
+            if self.get_keyname is not None:
+                self._get_stats(keyname).size += size
+            while self.memory > self.size:
+                (_key, entry) = self.data.popitem(last=False)
+                self._remove_entry(entry)
+                self.evictions += 1
+                if self.get_keyname is not None:
+                    self._get_stats(entry[2]).evictions += 1
+
+    def _remove_entry(self, entry: tuple[Any, int, str | None]) -> None:
+        (_val, size, keyname) = entry
+        self.memory -= size
+        if self.get_keyname is not None:
+            self._get_stats(keyname).size -= size
+
+    def invalidate(self, key: Hashable) -> None:
+        """ Remove key from the cache. """
+        with self.lock:
+            entry = self.data.pop(key, None)
+            if entry is not None:
+                self._remove_entry(entry)
@@ -41,7 +41,15 @@ hookimpl = HookimplMarker("devpiserver")
 DEFAULT_MIRROR_CACHE_EXPIRY = 1800
 DEFAULT_PROXY_TIMEOUT = 30
 DEFAULT_REQUEST_TIMEOUT = 5
+DEFAULT_DOWNLOAD_CHUNK_SIZE = 65536
+DEFAULT_DOWNLOAD_MAX_RESUMES = 3
+DEFAULT_HTTP_MAX_CONNECTIONS_PER_HOST = 100
+DEFAULT_HTTP_MAX_KEEPALIVE_CONNECTIONS_PER_HOST = 20
+DEFAULT_HTTP_KEEPALIVE_EXPIRY = 30.0
+DEFAULT_REPLICATION_COMPRESSION_LEVEL = 1
 DEFAULT_FILE_REPLICATION_THREADS = 5
+DEFAULT_FILE_REPLICATION_CONCURRENCY = 0
+DEFAULT_FILE_REPLICATION_BATCH_SIZE = 0
 DEFAULT_ARGON2_MEMORY_COST = 524288
 DEFAULT_ARGON2_PARALLELISM = 8
 DEFAULT_ARGON2_TIME_COST = 16
@@ -234,6 +242,34 @@ def add_mirror_options(parser, pluginmanager):
         default=DEFAULT_MIRROR_CACHE_EXPIRY,
         help="(experimental) time after which projects in mirror indexes "
              "are checked for new releases.")
+    parser.addoption(
+        "--mirror-not-found-cache-size", type=int, metavar="NUM",
+        default=10000,
+        help="maximum number of projects per mirror index which are "
+             "remembered as not found upstream, so requests for them don't "
+             "have to ask upstream again until the 'mirror_not_found_expiry' "
+             "of the index is reached. Use 0 to disable.")
+    parser.addoption(
+        "--mirror-changelog-interval", type=int, metavar="SECS",
+        default=0,
+        help="(primary only) check the upstream changelog of mirror indexes "
+             "with 'mirror_changelog_url' set every SECS seconds and expire "
+             "the cache of projects which changed upstream. This allows "
+             "a high 'mirror_cache_expiry' while staying up to date. "
+             "By default the changelog isn't checked.")
+    parser.addoption(
+        "--mirror-cache-eviction-interval", type=int, metavar="SECS",
+        default=600,
+        help="(primary only) interval in which the cached files of mirror "
+             "indexes with 'mirror_cache_quota' set are checked. The least "
+             "recently used files exceeding the quota are deleted, they "
+             "are fetched again when requested. Use 0 to disable.")
+    parser.addoption(
+        "--mirror-refresh-hot-projects", type=int, metavar="NUM",
+        default=0,
+        help="(primary only) refresh the NUM most requested projects of "
+             "each mirror index in the background shortly before their "
+             "cache expires, so requests don't have to wait for upstream.")
 
 
 def add_replica_options(parser, pluginmanager):
@@ -253,6 +289,27 @@ def add_replica_options(parser, pluginmanager):
         default=DEFAULT_FILE_REPLICATION_THREADS,
         help="number of threads for file download from primary")
 
+    parser.addoption(
+        "--file-replication-concurrency", type=int, metavar="NUM",
+        default=DEFAULT_FILE_REPLICATION_CONCURRENCY,
+        help="maximum number of concurrent file downloads from primary. "
+             "If set, the downloads run asynchronously and the number of "
+             "concurrent downloads adapts to the latency of the primary, "
+             "the file replication threads are then only used for "
+             "storing the files. "
+             "With the default of 0 each file replication thread "
+             "downloads one file at a time.")
+
+    parser.addoption(
+        "--file-replication-batch-size", type=int, metavar="NUM",
+        default=DEFAULT_FILE_REPLICATION_BATCH_SIZE,
+        help="number of files the file replication threads request from "
+             "the primary with one request. Only small files are sent "
+             "this way, others are still downloaded one by one. "
+             "This speeds up the initial sync of replicas with many "
+             "small files. With the default of 0 every file is "
+             "downloaded with its own request.")
+
     parser.addoption(
         "--file-replication-skip-indexes",
         action="store",
@@ -279,6 +336,38 @@ def add_replica_options(parser, pluginmanager):
         default=True, action="store_false",
         help="use separate requests instead of replica streaming protocol")
 
+    parser.addoption(
+        "--replica-snapshot", action="store_true",
+        help="when starting a new replica, load the latest changelog "
+             "snapshot from the primary and only replicate the changes "
+             "after it, instead of replaying the whole changelog. "
+             "The changelog before the snapshot isn't available on the "
+             "replica. Falls back to replaying the whole changelog if the "
+             "primary has no snapshot.")
+
+    parser.addoption(
+        "--serve-replication", action="store_true",
+        help="(replica only) serve the replication protocol to other "
+             "replicas, which use this replica as their --primary-url. "
+             "This allows a tree of replicas to reduce the load on the "
+             "primary. The replicas need to use the same secret as the "
+             "primary.")
+
+    parser.addoption(
+        "--changelog-snapshot-interval", type=int, metavar="NUM",
+        default=0,
+        help="(primary only) write a snapshot of the current state after "
+             "every NUM serials, so new replicas started with "
+             "--replica-snapshot don't have to replay the whole changelog. "
+             "By default no snapshots are written.")
+
+    parser.addoption(
+        "--replication-compression-level", type=int, metavar="NUM",
+        default=DEFAULT_REPLICATION_COMPRESSION_LEVEL,
+        help="zlib compression level from 1 to 9 used for "
+             "changelog data sent to replicas which accept gzip or deflate "
+             "encoded responses. Use 0 to disable compression.")
+
 
 def add_request_options(parser, pluginmanager):
     parser.addoption(
@@ -287,6 +376,43 @@ def add_request_options(parser, pluginmanager):
         help="Number of seconds before request being terminated "
              "(such as connections to pypi, etc.).")
 
+    parser.addoption(
+        "--download-chunk-size", type=int, metavar="BYTES",
+        default=DEFAULT_DOWNLOAD_CHUNK_SIZE,
+        help="Size of the chunks in which files are read from upstream "
+             "servers and passed on to clients while being downloaded.")
+
+    parser.addoption(
+        "--download-max-resumes", type=int, metavar="NUM",
+        default=DEFAULT_DOWNLOAD_MAX_RESUMES,
+        help="Number of times an interrupted download from an upstream "
+             "server is resumed with a HTTP range request before giving up.")
+
+    parser.addoption(
+        "--http-max-connections-per-host", type=int, metavar="NUM",
+        default=DEFAULT_HTTP_MAX_CONNECTIONS_PER_HOST,
+        help="Maximum number of concurrent connections to each upstream "
+             "host (mirror upstreams, the primary etc).")
+
+    parser.addoption(
+        "--http-max-keepalive-connections-per-host", type=int, metavar="NUM",
+        default=DEFAULT_HTTP_MAX_KEEPALIVE_CONNECTIONS_PER_HOST,
+        help="Maximum number of idle connections kept open to each "
+             "upstream host for reuse.")
+
+    parser.addoption(
+        "--http-keepalive-expiry", type=float, metavar="SECONDS",
+        default=DEFAULT_HTTP_KEEPALIVE_EXPIRY,
+        help="Number of seconds an idle connection to an upstream host is "
+             "kept open for reuse. Reusing connections avoids repeated "
+             "TLS handshakes.")
+
+    parser.addoption(
+        "--mirror-http2", action="store_true",
+        help="use HTTP/2 for connections to mirror upstreams which support "
+             "it. Requires the 'h2' package, which is installed with "
+             "'httpx[http2]'.")
+
     parser.addoption(
         "--offline-mode", action="store_true",
         help="(experimental) prevents connections to any upstream server "
@@ -319,6 +445,63 @@ def add_storage_options(parser, pluginmanager):
              "improve performance. Each entry uses 1kb of memory on "
              "average. So by default about 10MB are used.")
 
+    parser.addoption(
+        "--keyfs-cache-memory", type=int, metavar="MB",
+        action="store", default=None,
+        help="maximum memory in megabytes used by the keyfs cache, "
+             "based on the approximate size of the cached values. "
+             "If set, this is used instead of --keyfs-cache-size. "
+             "Statistics per key name are added to the metrics.")
+
+    parser.addoption(
+        "--keyfs-value-cache-size", type=int, metavar="NUM",
+        action="store", default=0,
+        help="number of values kept in a cache shared by all "
+             "transactions, so concurrent requests for the same data "
+             "at any serial after its last change reuse the same "
+             "readonly value instead of decoding it again. "
+             "Use 0 to disable.")
+
+    parser.addoption(
+        "--keyfs-current-values", action="store_true",
+        help="maintain a table with the current value of each key in the "
+             "storage, so reads at the latest serial don't have to decode "
+             "changelog entries. This uses additional disk space. The table "
+             "is created on first start with this option and removed "
+             "again when started without it.")
+
+    parser.addoption(
+        "--keyfs-compress-changelog", action="store_true",
+        help="store new changelog entries zlib compressed. Existing "
+             "entries are kept as is and both kinds can be read "
+             "regardless of this option. Replicas receive the entries "
+             "as stored, so the compression also reduces the bandwidth "
+             "used for replication.")
+
+    parser.addoption(
+        "--keyfs-indexed-changelog", action="store_true",
+        help="store new changelog entries with an index of the contained "
+             "keys, so the value of a single key can be read without "
+             "decoding the whole entry. Existing entries are kept as is "
+             "and both kinds can be read regardless of this option.")
+
+    parser.addoption(
+        "--keyfs-read-connections", type=int, metavar="NUM",
+        action="store", default=None,
+        help="number of idle read connections kept open per thread for "
+             "reuse by the SQLite storage backends, so requests don't "
+             "have to open a new connection. Use 0 to disable reuse. "
+             "If not set, the backend default of 2 is used.")
+
+    parser.addoption(
+        "--keyfs-group-commit-window", type=float, metavar="SECONDS",
+        action="store", default=0,
+        help="time to wait for concurrent writes of mirror data, like "
+             "cached release files and simple links, which are then "
+             "committed together with a single serial. This reduces "
+             "the number of serials and replication round-trips when "
+             "many files are fetched at once. Use 0 to disable.")
+
 
 def add_init_options(parser, pluginmanager):
     parser.addoption(
@@ -950,6 +1133,22 @@ class Config:
     def mirror_cache_expiry(self):
         return getattr(self.args, 'mirror_cache_expiry', DEFAULT_MIRROR_CACHE_EXPIRY)
 
+    @property
+    def mirror_not_found_cache_size(self):
+        return getattr(self.args, 'mirror_not_found_cache_size', 10000)
+
+    @property
+    def mirror_changelog_interval(self):
+        return getattr(self.args, 'mirror_changelog_interval', 0)
+
+    @property
+    def mirror_cache_eviction_interval(self):
+        return getattr(self.args, 'mirror_cache_eviction_interval', 600)
+
+    @property
+    def mirror_refresh_hot_projects(self):
+        return getattr(self.args, 'mirror_refresh_hot_projects', 0)
+
     @property
     def no_root_pypi(self):
         return getattr(self.args, 'no_root_pypi', False)
@@ -968,6 +1167,18 @@ class Config:
             self.args,
             'file_replication_threads', DEFAULT_FILE_REPLICATION_THREADS)
 
+    @property
+    def file_replication_batch_size(self):
+        return max(0, getattr(
+            self.args,
+            'file_replication_batch_size', DEFAULT_FILE_REPLICATION_BATCH_SIZE))
+
+    @property
+    def file_replication_concurrency(self):
+        return max(0, getattr(
+            self.args,
+            'file_replication_concurrency', DEFAULT_FILE_REPLICATION_CONCURRENCY))
+
     @property
     def file_replication_skip_indexes(self):
         from .main import Fatal
@@ -996,6 +1207,33 @@ class Config:
     def replica_streaming(self):
         return getattr(self.args, 'replica_streaming', True)
 
+    @property
+    def replica_snapshot(self):
+        return getattr(self.args, 'replica_snapshot', False)
+
+    @property
+    def serve_replication(self):
+        return getattr(self.args, 'serve_replication', False)
+
+    @property
+    def changelog_snapshot_interval(self):
+        return getattr(self.args, 'changelog_snapshot_interval', 0)
+
+    @property
+    def replication_compression_level(self):
+        level = getattr(
+            self.args, 'replication_compression_level',
+            DEFAULT_REPLICATION_COMPRESSION_LEVEL)
+        return max(0, min(level, 9))
+
+    @property
+    def keyfs_cache_memory(self):
+        """ Maximum memory for the keyfs cache in bytes or None. """
+        megabytes = getattr(self.args, 'keyfs_cache_memory', None)
+        if not megabytes:
+            return None
+        return megabytes * 1024 * 1024
+
     @property
     def requests_only(self):
         return getattr(self.args, 'requests_only', False)
@@ -1004,6 +1242,35 @@ class Config:
     def request_timeout(self):
         return getattr(self.args, 'request_timeout', DEFAULT_REQUEST_TIMEOUT)
 
+    @property
+    def download_chunk_size(self):
+        return getattr(self.args, 'download_chunk_size', DEFAULT_DOWNLOAD_CHUNK_SIZE)
+
+    @property
+    def download_max_resumes(self):
+        return getattr(self.args, 'download_max_resumes', DEFAULT_DOWNLOAD_MAX_RESUMES)
+
+    @property
+    def http_max_connections_per_host(self):
+        return getattr(
+            self.args, 'http_max_connections_per_host',
+            DEFAULT_HTTP_MAX_CONNECTIONS_PER_HOST)
+
+    @property
+    def http_max_keepalive_connections_per_host(self):
+        return getattr(
+            self.args, 'http_max_keepalive_connections_per_host',
+            DEFAULT_HTTP_MAX_KEEPALIVE_CONNECTIONS_PER_HOST)
+
+    @property
+    def http_keepalive_expiry(self):
+        return getattr(
+            self.args, 'http_keepalive_expiry', DEFAULT_HTTP_KEEPALIVE_EXPIRY)
+
+    @property
+    def mirror_http2(self):
+        return getattr(self.args, 'mirror_http2', False)
+
     @property
     def root_passwd(self):
         return getattr(self.args, 'root_passwd', "")
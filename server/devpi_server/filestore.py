@@ -19,6 +19,8 @@ from wsgiref.handlers import format_date_time
 import hashlib
 import mimetypes
 import re
+import threading
+import time
 import warnings
 
 
@@ -364,11 +366,65 @@ def unicode_if_bytes(val):
     return val
 
 
+class FileDownload:
+    """ A download of a file which is currently in progress. """
+
+    __slots__ = ("_event", "last_progress", "relpath")
+
+    def __init__(self, relpath: str) -> None:
+        self._event = threading.Event()
+        self.last_progress = time.monotonic()
+        self.relpath = relpath
+
+    def progress(self) -> None:
+        self.last_progress = time.monotonic()
+
+    def wait(self, timeout: float) -> bool:
+        """ Wait until the download is finished.
+
+        Returns ``False`` if there was no progress for ``timeout`` seconds."""
+        while not self._event.wait(timeout):
+            if (time.monotonic() - self.last_progress) >= timeout:
+                return False
+        return True
+
+
+class FileDownloads:
+    """ Registry of file downloads in progress, so concurrent requests
+        for the same file only fetch it once. """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._relpath2download: dict[str, FileDownload] = {}
+
+    def __contains__(self, relpath: str) -> bool:
+        with self._lock:
+            return relpath in self._relpath2download
+
+    def start(self, relpath: str) -> tuple[FileDownload, bool]:
+        """ Returns the download for ``relpath`` and whether it was
+            started by this call, in which case the caller has to
+            call ``finish`` after fetching the file. """
+        with self._lock:
+            download = self._relpath2download.get(relpath)
+            if download is not None:
+                return (download, False)
+            download = self._relpath2download[relpath] = FileDownload(relpath)
+            return (download, True)
+
+    def finish(self, download: FileDownload) -> None:
+        with self._lock:
+            if self._relpath2download.get(download.relpath) is download:
+                del self._relpath2download[download.relpath]
+        download._event.set()
+
+
 class FileStore:
     attachment_encoding = "utf-8"
 
     def __init__(self, keyfs):
         self.keyfs = keyfs
+        self.downloads = FileDownloads()
 
     def __repr__(self):
         return f"<{self.__class__.__name__} {self.keyfs!r}>"
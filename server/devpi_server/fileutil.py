@@ -11,6 +11,7 @@ from typing import TYPE_CHECKING
 import errno
 import os.path
 import sys
+import zlib
 
 
 if TYPE_CHECKING:
@@ -219,6 +220,7 @@ _dispatch: dict[type, Callable] = {
     frozenset: _dump_frozenset,
     int: _dump_int,
     dict: _dump_dict,
+    readonly.CopyOnWriteDict: _dump_dict,
     filestore.Digests: _dump_dict,
     readonly.DictViewReadonly: _dump_dict,
     list: _dump_list,
@@ -284,6 +286,131 @@ def dumps(obj):
     return fp.getvalue()
 
 
+# Stored changelog entries are either plain ``dumps`` output, which
+# always starts with an opcode, or start with one of the following
+# format tags which never is a valid opcode.
+INDEXED_ENTRY_TAG = b"X"
+ZLIB_ENTRY_TAG = b"Z"
+
+# Preset dictionary for zlib compressed entries.  It contains the
+# serialization of commonly used keys and values, so even small entries
+# compress well.  It must never change, otherwise already stored entries
+# can't be decompressed anymore, a new dictionary needs a new format tag.
+# The most common strings are at the end, as those are cheaper to reference.
+ZLIB_ENTRY_DICTIONARY = dumps((
+    {
+        "name": "", "version": "", "metadata_version": "", "summary": "",
+        "home_page": "", "author": "", "author_email": "", "maintainer": "",
+        "maintainer_email": "", "license": "", "description": "",
+        "keywords": "", "platform": [], "classifiers": [],
+        "download_url": "", "supported_platform": [], "comment": "",
+        "provides": [], "requires": [], "obsoletes": [], "project_urls": [],
+        "provides_dist": [], "obsoletes_dist": [], "requires_dist": [],
+        "requires_external": [], "requires_python": "",
+        "description_content_type": "text/markdown", "provides_extras": [],
+        "dynamic": [], "license_expression": "", "license_file": []},
+    {
+        "pwhash": "$argon2id$v=19$m=65536,t=3,p=4$", "email": "",
+        "created": "", "indexes": {}, "type": "stage", "volatile": True,
+        "bases": (), "acl_upload": [], "acl_toxresult_upload": [":ANONYMOUS:"],
+        "mirror_whitelist": [], "mirror_whitelist_inheritance": "intersection",
+        "mirror_url": "https://pypi.org/simple/"},
+    "https://files.pythonhosted.org/packages/",
+    ("USER", "USERLIST", "PROJVERSIONS", "PROJNAMES", "MIRRORNAMESINIT"),
+    {"rel": "releasefile", "entrypath": "", "hash_spec": "sha256=",
+     "hashes": {"sha256": ""},
+     "_log": [{"what": "upload", "who": "", "when": (), "dst": ""}]},
+    {"url": "", "hash_spec": "sha256=", "project": "", "version": ""},
+    {"last_modified": "", "hash_spec": "sha256=", "hashes": {"sha256": ""},
+     "project": "", "version": ""},
+    {"etag": None, "links": [], "requires_python": [], "serial": 0,
+     "yanked": []},
+    ("PROJVERSION", "PYPIFILE_NOMD5", "STAGEFILE", "PROJSIMPLELINKS"),
+    (".tar.gz", ".zip", "-py3-none-any.whl", "/.config", "/.simple", "/+f/",
+     "/+e/https_pypi.org_"),
+))
+
+
+def compress_entry(data, level=zlib.Z_DEFAULT_COMPRESSION):
+    """ Return serialized ``data`` compressed and tagged with
+    its format, so it can be stored instead of ``data``. """
+    compressor = zlib.compressobj(level, zdict=ZLIB_ENTRY_DICTIONARY)
+    return b"".join((ZLIB_ENTRY_TAG, compressor.compress(data), compressor.flush()))
+
+
+def decompress_entry(data):
+    """ Return the serialized data for a stored entry, which may be
+    compressed by ``compress_entry`` or not. """
+    if data[:1] == ZLIB_ENTRY_TAG:
+        decompressor = zlib.decompressobj(zdict=ZLIB_ENTRY_DICTIONARY)
+        return decompressor.decompress(data[1:]) + decompressor.flush()
+    return data
+
+
+def dumps_indexed_entry(changes, rel_renames):
+    """ Serialize a changelog entry like ``dumps((changes, rel_renames))``,
+    but with a header containing the byte range of each value, so a
+    single value can be loaded without decoding the whole entry. """
+    index = {}
+    values = []
+    offset = 0
+    for relpath, (keyname, back_serial, value) in changes.items():
+        data = dumps(value)
+        index[relpath] = (keyname, back_serial, offset, len(data))
+        values.append(data)
+        offset += len(data)
+    header = dumps((index, rel_renames))
+    return b"".join((
+        INDEXED_ENTRY_TAG, pack("!i", len(header)), header, *values))
+
+
+def _loads_indexed_header(data):
+    (header_size,) = unpack("!i", data[1:5])
+    (index, rel_renames) = loads(data[5:5 + header_size])
+    return (5 + header_size, index, rel_renames)
+
+
+def loads_entry(data):
+    """ Return ``(changes, rel_renames)`` of a plain or indexed
+    changelog entry. """
+    if data[:1] != INDEXED_ENTRY_TAG:
+        return loads(data)
+    (start, index, rel_renames) = _loads_indexed_header(data)
+    changes = {}
+    for relpath, (keyname, back_serial, offset, size) in index.items():
+        offset += start
+        changes[relpath] = (
+            keyname, back_serial, loads(data[offset:offset + size]))
+    return (changes, rel_renames)
+
+
+def loads_entry_value(data, relpath):
+    """ Return ``(keyname, back_serial, value)`` for relpath from a
+    plain or indexed changelog entry.  For indexed entries only the
+    header and the value itself are decoded.
+    Raises KeyError if relpath isn't in the entry. """
+    if data[:1] != INDEXED_ENTRY_TAG:
+        (changes, _rel_renames) = loads(data)
+        return changes[relpath]
+    (start, index, _rel_renames) = _loads_indexed_header(data)
+    (keyname, back_serial, offset, size) = index[relpath]
+    offset += start
+    return (keyname, back_serial, loads(data[offset:offset + size]))
+
+
+def is_indexed_entry(data):
+    return data[:1] == INDEXED_ENTRY_TAG
+
+
+def plain_entry(data):
+    """ Return the plain ``dumps`` output for a stored changelog entry
+    in any of the supported formats. """
+    data = decompress_entry(data)
+    if is_indexed_entry(data):
+        return dumps(loads_entry(data))
+    return data
+
+
 def read_int_from_file(path, default=0):
     try:
         with open(path, "rb") as f:
@@ -42,17 +42,14 @@ def fsck():
         got_errors = False
         with xom.keyfs.read_transaction() as tx:
             log.info("Checking at serial %s", tx.at_serial)
-            relpaths = tx.iter_relpaths_at(keys, tx.at_serial)
+            relpaths = tx.iter_relpaths_with_prefix("", typedkeys=keys)
             for item in relpaths:
-                if item.value is None:
-                    continue
                 if time.time() - last_time > 5:
                     last_time = time.time()
                     log.info(
-                        "Processed a total of %s files (serial %s/%s) so far.",
+                        "Processed a total of %s files (at %s) so far.",
                         processed,
-                        tx.at_serial - item.serial,
-                        tx.at_serial,
+                        item.relpath,
                     )
                 processed = processed + 1
                 key = keyfs.get_key_instance(item.keyname, item.relpath)
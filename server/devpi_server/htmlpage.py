@@ -54,15 +54,20 @@ class HTMLPage:
 
             pyrequire = anchor.get("data-requires-python")
             yanked = anchor.get("data-yanked")
-            yield Link(url, self, requires_python=pyrequire, yanked=yanked)
+            core_metadata = anchor.get(
+                "data-core-metadata", anchor.get("data-dist-info-metadata"))
+            yield Link(
+                url, self, requires_python=pyrequire, yanked=yanked,
+                core_metadata=core_metadata)
 
 
 class Link:
-    def __init__(self, url, comes_from=None, *, requires_python, yanked):
+    def __init__(self, url, comes_from=None, *, requires_python, yanked, core_metadata=None):
         self.url = url
         self.comes_from = comes_from
         self.requires_python = requires_python if requires_python else None
         self.yanked = yanked
+        self.core_metadata = core_metadata
 
     def __repr__(self):
         rp = (
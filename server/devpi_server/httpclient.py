@@ -1,25 +1,35 @@
 from __future__ import annotations
 
 from . import __version__ as server_version
+from .config import DEFAULT_HTTP_KEEPALIVE_EXPIRY
+from .config import DEFAULT_HTTP_MAX_CONNECTIONS_PER_HOST
+from .config import DEFAULT_HTTP_MAX_KEEPALIVE_CONNECTIONS_PER_HOST
 from .exceptions import lazy_format_exception_only
 from .log import threadlog
 from devpi_common.types import cached_property
 from devpi_common.url import URL
 from requests.utils import DEFAULT_CA_BUNDLE_PATH
 from typing import TYPE_CHECKING
+import asyncio
 import httpx
+import importlib.util
 import inspect
 import os
 import ssl
 import sys
+import threading
+import time
 import warnings
+import weakref
 
 
 AGENT_PYTHON_VERSION = f"(py{sys.version.split()[0]}; {sys.platform})"
 
 
 if TYPE_CHECKING:
+    from collections.abc import Callable
     from collections.abc import Iterator
+    from contextlib import AsyncExitStack
     from contextlib import ExitStack
     from typing import Union
 
@@ -69,7 +79,129 @@ class FatalResponse:
         return self.reason_phrase
 
 
+class PoolStats:
+    """ Counts new connections and TLS handshakes of the connection pools
+    of a client via the ``trace`` request extension of httpcore. """
+
+    def __init__(self) -> None:
+        self.connects = 0
+        self.connect_time = 0.0
+        self.tls_handshakes = 0
+        self.tls_handshake_time = 0.0
+
+    def _record(self, started: dict[str, float], event_name: str) -> None:
+        (prefix, _, state) = event_name.rpartition(".")
+        if prefix not in ("connection.connect_tcp", "connection.start_tls"):
+            return
+        now = time.monotonic()
+        if state == "started":
+            started[prefix] = now
+            return
+        if state != "complete":
+            return
+        duration = now - started.pop(prefix, now)
+        if prefix == "connection.connect_tcp":
+            self.connects += 1
+            self.connect_time += duration
+        else:
+            self.tls_handshakes += 1
+            self.tls_handshake_time += duration
+
+    def make_trace(self) -> Callable:
+        started: dict[str, float] = {}
+
+        def trace(event_name: str, info: dict) -> None:  # noqa: ARG001
+            self._record(started, event_name)
+
+        return trace
+
+    def make_async_trace(self) -> Callable:
+        started: dict[str, float] = {}
+
+        async def trace(event_name: str, info: dict) -> None:  # noqa: ARG001
+            self._record(started, event_name)
+
+        return trace
+
+
+def count_pool_connections(transport: httpx.BaseTransport | httpx.AsyncBaseTransport) -> tuple[int, int]:
+    """ Return the number of active and idle connections of a transport. """
+    active = idle = 0
+    pool = getattr(transport, "_pool", None)
+    for connection in getattr(pool, "connections", ()):
+        if connection.is_closed():
+            continue
+        if connection.is_idle():
+            idle += 1
+        else:
+            active += 1
+    return (active, idle)
+
+
+class PerHostTransport(httpx.BaseTransport):
+    """ Uses a separate connection pool for each upstream host, so the
+    pool limits apply per host and busy hosts don't starve others. """
+
+    def __init__(self, create_transport: Callable[[], httpx.HTTPTransport], stats: PoolStats) -> None:
+        self._create_transport = create_transport
+        self._lock = threading.Lock()
+        self._transports: dict[tuple, httpx.HTTPTransport] = {}
+        self.stats = stats
+
+    def _get_transport(self, url: httpx.URL) -> httpx.HTTPTransport:
+        origin = (url.scheme, url.host, url.port)
+        with self._lock:
+            transport = self._transports.get(origin)
+            if transport is None:
+                transport = self._transports[origin] = self._create_transport()
+        return transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        request.extensions.setdefault("trace", self.stats.make_trace())
+        return self._get_transport(request.url).handle_request(request)
+
+    def iter_transports(self) -> Iterator[httpx.HTTPTransport]:
+        with self._lock:
+            yield from list(self._transports.values())
+
+    def close(self) -> None:
+        with self._lock:
+            (transports, self._transports) = (self._transports, {})
+        for transport in transports.values():
+            transport.close()
+
+
+class AsyncPerHostTransport(httpx.AsyncBaseTransport):
+    """ The async variant of PerHostTransport. """
+
+    def __init__(self, create_transport: Callable[[], httpx.AsyncHTTPTransport], stats: PoolStats) -> None:
+        self._create_transport = create_transport
+        self._transports: dict[tuple, httpx.AsyncHTTPTransport] = {}
+        self.stats = stats
+
+    def _get_transport(self, url: httpx.URL) -> httpx.AsyncHTTPTransport:
+        origin = (url.scheme, url.host, url.port)
+        transport = self._transports.get(origin)
+        if transport is None:
+            transport = self._transports[origin] = self._create_transport()
+        return transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        request.extensions.setdefault("trace", self.stats.make_async_trace())
+        return await self._get_transport(request.url).handle_async_request(request)
+
+    def iter_transports(self) -> Iterator[httpx.AsyncHTTPTransport]:
+        yield from list(self._transports.values())
+
+    async def aclose(self) -> None:
+        (transports, self._transports) = (self._transports, {})
+        for transport in transports.values():
+            await transport.aclose()
+
+
 class HTTPClient:
+    CLOSE_TIMEOUT = 5
+
     Errors = (
         OSError,
         httpx.HTTPError,
@@ -77,11 +209,41 @@ class HTTPClient:
         httpx.StreamError,
     )
 
-    def __init__(self, *, component_name: str, timeout: float | None) -> None:
+    def __init__(
+        self,
+        *,
+        component_name: str,
+        timeout: float | None,
+        max_connections_per_host: int | None = DEFAULT_HTTP_MAX_CONNECTIONS_PER_HOST,
+        max_keepalive_connections_per_host: int | None = (
+            DEFAULT_HTTP_MAX_KEEPALIVE_CONNECTIONS_PER_HOST),
+        keepalive_expiry: float | None = DEFAULT_HTTP_KEEPALIVE_EXPIRY,
+        http2: bool = False,
+    ) -> None:
         self.headers = {
             "User-Agent": f"devpi-{component_name}/{server_version} {AGENT_PYTHON_VERSION}"
         }
-        self.client = httpx.Client(headers=self.headers, verify=self._ssl_context)
+        if http2 and importlib.util.find_spec("h2") is None:
+            threadlog.warning(
+                "HTTP/2 requested, but the 'h2' package isn't installed, "
+                "using HTTP/1.1 instead.")
+            http2 = False
+        self.http2 = http2
+        self.limits = httpx.Limits(
+            max_connections=max_connections_per_host,
+            max_keepalive_connections=max_keepalive_connections_per_host,
+            keepalive_expiry=keepalive_expiry)
+        self.pool_stats = PoolStats()
+        self.transport = PerHostTransport(
+            lambda: httpx.HTTPTransport(
+                verify=self._ssl_context, http2=self.http2, limits=self.limits),
+            self.pool_stats)
+        self.client = httpx.Client(
+            headers=self.headers, verify=self._ssl_context,
+            http2=self.http2, limits=self.limits, transport=self.transport)
+        # async clients are bound to the event loop they are used in
+        self._async_clients: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, httpx.AsyncClient] = weakref.WeakKeyDictionary()
         self.timeout = timeout
 
     @cached_property
@@ -102,7 +264,42 @@ class HTTPClient:
         return ssl.create_default_context(cafile=cafile)
 
     def async_client(self) -> httpx.AsyncClient:
-        return httpx.AsyncClient(headers=self.headers, verify=self._ssl_context)
+        transport = AsyncPerHostTransport(
+            lambda: httpx.AsyncHTTPTransport(
+                verify=self._ssl_context, http2=self.http2, limits=self.limits),
+            self.pool_stats)
+        return httpx.AsyncClient(
+            headers=self.headers, verify=self._ssl_context,
+            http2=self.http2, limits=self.limits, transport=transport)
+
+    def _get_async_client(self) -> httpx.AsyncClient:
+        # reusing the client keeps connections alive between requests
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = self._async_clients[loop] = self.async_client()
+        return client
+
+    def get_pool_metrics(self, prefix: str) -> list[tuple[str, str, object]]:
+        transports: list = list(self.transport.iter_transports())
+        for client in list(self._async_clients.values()):
+            transport = client._transport
+            if isinstance(transport, AsyncPerHostTransport):
+                transports.extend(transport.iter_transports())
+        active = idle = 0
+        for transport in transports:
+            (transport_active, transport_idle) = count_pool_connections(transport)
+            active += transport_active
+            idle += transport_idle
+        stats = self.pool_stats
+        return [
+            (f"{prefix}_connections_active", "gauge", active),
+            (f"{prefix}_connections_idle", "gauge", idle),
+            (f"{prefix}_connects", "counter", stats.connects),
+            (f"{prefix}_connect_time_seconds", "counter", stats.connect_time),
+            (f"{prefix}_pools", "gauge", len(transports)),
+            (f"{prefix}_tls_handshakes", "counter", stats.tls_handshakes),
+            (f"{prefix}_tls_handshake_time_seconds", "counter", stats.tls_handshake_time)]
 
     async def async_get(
         self,
@@ -113,15 +310,15 @@ class HTTPClient:
         extra_headers: dict | None = None,
     ) -> AsyncGetResponse:
         try:
-            async with self.async_client() as client:
-                response = await client.get(
-                    url.url if isinstance(url, URL) else url,
-                    follow_redirects=allow_redirects,
-                    headers=extra_headers,
-                    timeout=timeout or self.timeout,
-                )
-                text = response.text if response.status_code < 300 else None
-                return (response, text)
+            client = self._get_async_client()
+            response = await client.get(
+                url.url if isinstance(url, URL) else url,
+                follow_redirects=allow_redirects,
+                headers=extra_headers,
+                timeout=timeout or self.timeout,
+            )
+            text = response.text if response.status_code < 300 else None
+            return (response, text)
         except self.Errors as e:
             location = get_caller_location()
             threadlog.warn(
@@ -135,6 +332,27 @@ class HTTPClient:
 
     def close(self) -> None:
         self.client.close()
+        try:
+            current_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            current_loop = None
+        for loop, client in list(self._async_clients.items()):
+            try:
+                if loop is current_loop:
+                    # we can't block the loop we are running in
+                    loop.create_task(client.aclose())
+                elif loop.is_running():
+                    asyncio.run_coroutine_threadsafe(
+                        client.aclose(), loop).result(self.CLOSE_TIMEOUT)
+                elif not loop.is_closed():
+                    loop.run_until_complete(client.aclose())
+                else:
+                    asyncio.run(client.aclose())
+            except Exception as e:  # noqa: BLE001
+                threadlog.warn(
+                    "Error closing async http client: %s",
+                    lazy_format_exception_only(e))
+        self._async_clients.clear()
 
     def get(
         self,
@@ -171,6 +389,7 @@ class HTTPClient:
         self,
         url: URL | str,
         *,
+        content: bytes | None = None,
         data: dict | None = None,
         files: dict | None = None,
         timeout: float | None = None,
@@ -182,6 +401,7 @@ class HTTPClient:
         try:
             resp = self.client.post(
                 url.url if isinstance(url, URL) else url,
+                content=content,
                 data=data,
                 files=files,
                 headers=headers,
@@ -237,6 +457,43 @@ class HTTPClient:
         else:
             return resp
 
+    async def async_stream(
+        self,
+        cstack: AsyncExitStack,
+        method: str,
+        url: URL | str,
+        *,
+        allow_redirects: bool,
+        timeout: float | None = None,
+        extra_headers: dict | None = None,
+    ) -> GetResponse:
+        headers = {}
+        if extra_headers:
+            headers.update(extra_headers)
+        try:
+            client = self._get_async_client()
+            request = client.build_request(
+                method,
+                url.url if isinstance(url, URL) else url,
+                headers=headers,
+                timeout=timeout or self.timeout,
+            )
+            resp = await client.send(
+                request, follow_redirects=allow_redirects, stream=True)
+            cstack.push_async_callback(resp.aclose)
+        except self.Errors as e:
+            location = get_caller_location()
+            threadlog.warn(
+                "%s during http.async_stream of %s at %s: %s",
+                e.__class__.__name__,
+                url,
+                location,
+                lazy_format_exception_only(e),
+            )
+            return FatalResponse(url, repr(sys.exc_info()[1]))
+        else:
+            return resp
+
 
 class OfflineHTTPClient:
     def close(self) -> None:
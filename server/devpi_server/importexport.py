@@ -625,12 +625,15 @@ class Importer:
                 links = [(url.basename, entrypath)]
                 requires_python = [versions[version].get('requires_python')]
                 yanked = [versions[version].get('yanked')]
-                for key, href, require_python, is_yanked in links_with_data:
+                core_metadata = [None]
+                for key, href, require_python, is_yanked, link_core_metadata in links_with_data:
                     links.append((key, href))
                     requires_python.append(require_python)
                     yanked.append(is_yanked)
+                    core_metadata.append(link_core_metadata)
                 stage._save_cache_links(
-                    project, links, requires_python, yanked, serial, None)
+                    project, links, requires_python, yanked, serial, None,
+                    core_metadata=core_metadata)
         elif filedesc["type"] == Rel.DocZip:
             version = filedesc["version"]
             # docs didn't always have entrymapping in export dump
@@ -28,12 +28,17 @@ from .log import threadlog
 from .markers import absent
 from .markers import deleted
 from .model import RootModel
+from .readonly import CopyOnWriteDict
 from .readonly import DictViewReadonly
 from .readonly import ensure_deeply_readonly
+from .readonly import get_mutable_copy_on_write
 from .readonly import get_mutable_deepcopy
 from .readonly import is_deeply_readonly
 from devpi_common.types import cached_property
+from itertools import islice
+from operator import attrgetter
 from pathlib import Path
+from repoze.lru import LRUCache
 from typing import TYPE_CHECKING
 from typing import overload
 import contextlib
@@ -59,6 +64,10 @@ if TYPE_CHECKING:
     KeyFSConnWithClosing = Union[KeyFSConn, KeyFSConnClosing]
 
 
+# number of keys written or read at once when importing a snapshot
+SNAPSHOT_BATCH_SIZE = 1000
+
+
 def __getattr__(name):
     if name == 'RelpathInfo':
         from .keyfs_types import RelpathInfo
@@ -197,12 +206,17 @@ class TxNotificationThread:
         self._get_ixconfig_cache[cache_key] = ixconfig
         return ixconfig
 
-    def _execute_hooks(self, event_serial, log, raising=False):
-        log.debug("calling hooks for tx%s", event_serial)
+    def _iter_changes(self, event_serial):
         with self.keyfs.get_connection() as conn:
             changes = conn.get_changes(event_serial)
+        yield from changes.items()
+        # the keys of an imported snapshot aren't in the changelog entry
+        yield from self.keyfs.iter_snapshot_changes(event_serial)
+
+    def _execute_hooks(self, event_serial, log, raising=False):
+        log.debug("calling hooks for tx%s", event_serial)
         # we first check for missing files before we call subscribers
-        for relpath, (keyname, _back_serial, val) in changes.items():
+        for relpath, (keyname, _back_serial, val) in self._iter_changes(event_serial):
             if keyname in ("STAGEFILE", "PYPIFILE_NOMD5"):
                 key = self.keyfs.get_key_instance(keyname, relpath)
                 entry = FileEntry(key, val)
@@ -252,7 +266,7 @@ class TxNotificationThread:
                 raise MissingFileException(relpath, event_serial)
         # all files exist or are deleted in a later serial,
         # call subscribers now
-        for relpath, (keyname, back_serial, val) in changes.items():
+        for relpath, (keyname, back_serial, val) in self._iter_changes(event_serial):
             subscribers = self._on_key_change.get(keyname, [])
             if not subscribers:
                 continue
@@ -277,6 +291,103 @@ class TxNotificationThread:
         log.debug("finished calling all hooks for tx%s", event_serial)
 
 
+class GroupWrite:
+    __slots__ = ("done", "error", "func", "result")
+
+    def __init__(self, func):
+        self.done = mythread.threading.Event()
+        self.error = None
+        self.func = func
+        self.result = None
+
+
+class GroupCommit:
+    """ Coalesces write functions submitted concurrently from different
+    threads within ``window`` seconds into a single write transaction,
+    so they share one serial.
+
+    The first thread to submit becomes the leader, waits for the
+    window to pass and then runs all submitted functions one after
+    another in its write transaction. The other threads wait for
+    the leader to commit.
+    """
+    MAX_SIZE = 100
+
+    def __init__(self, keyfs, window):
+        self.keyfs = keyfs
+        self.window = window
+        self.cv = mythread.threading.Condition()
+        self.pending = []
+        self.leading = False
+
+    def run(self, func):
+        item = GroupWrite(func)
+        with self.cv:
+            self.pending.append(item)
+            leader = not self.leading
+            if leader:
+                self.leading = True
+            elif len(self.pending) >= self.MAX_SIZE:
+                self.cv.notify_all()
+        if leader:
+            with self.cv:
+                deadline = time.monotonic() + self.window
+                while len(self.pending) < self.MAX_SIZE:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cv.wait(remaining)
+                (items, self.pending) = (self.pending, [])
+                self.leading = False
+            self.commit(items)
+        item.done.wait()
+        if item.error is not None:
+            raise item.error
+        return item.result
+
+    def commit(self, items):
+        keyfs = self.keyfs
+        # the leader might be in a read transaction of its own
+        outer_tx = keyfs._threadlocal.__dict__.pop("tx", None)
+        try:
+            with keyfs.write_transaction() as tx:
+                for item in items:
+                    self._run_item(tx, item)
+            threadlog.debug(
+                "committed %s grouped writes at %s",
+                len(items), tx.commit_serial)
+        except BaseException as e:
+            for item in items:
+                if item.error is None:
+                    item.error = e
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            if outer_tx is not None:
+                keyfs._threadlocal.tx = outer_tx
+            for item in items:
+                item.done.set()
+
+    def _run_item(self, tx, item):
+        cache = dict(tx.cache)
+        dirty = set(tx.dirty)
+        num_success_listeners = len(tx._success_listeners)
+        num_finished_listeners = len(tx._finished_listeners)
+        io_file_dirty = tx.io_file.is_dirty()
+        try:
+            item.result = item.func()
+        except Exception as e:  # noqa: BLE001
+            item.error = e
+            if tx.io_file.is_dirty() != io_file_dirty:
+                # written files can't be undone separately
+                raise
+            # undo the changes of the failed function only
+            tx.cache = cache
+            tx.dirty = dirty
+            del tx._success_listeners[num_success_listeners:]
+            del tx._finished_listeners[num_finished_listeners:]
+
+
 class KeyFS:
     """ singleton storage object. """
 
@@ -293,6 +404,13 @@ class KeyFS:
         io_file_factory=None,
         readonly=False,
         cache_size=10000,
+        cache_memory=None,
+        current_values=False,
+        compress_changelog=False,
+        indexed_changelog=False,
+        read_connection_pool_size=None,
+        group_commit_window=None,
+        value_cache_size=0,
     ):
         self.base_path = Path(basedir)
         self.base_path.mkdir(parents=True, exist_ok=True)
@@ -301,13 +419,35 @@ class KeyFS:
         self._cv_new_transaction = mythread.threading.Condition()
         self._import_subscriber = None
         self.notifier = TxNotificationThread(self)
+        storage_kw = dict(
+            notify_on_commit=self._notify_on_commit, cache_size=cache_size)
+        if cache_memory:
+            storage_kw["cache_memory"] = cache_memory
+        if current_values:
+            # only passed when enabled to stay compatible with
+            # storage plugins which don't support it
+            storage_kw["current_values"] = True
+        if compress_changelog:
+            storage_kw["compress_changelog"] = True
+        if indexed_changelog:
+            storage_kw["indexed_changelog"] = True
+        if read_connection_pool_size is not None:
+            storage_kw["read_connection_pool_size"] = read_connection_pool_size
         self._storage = IStorage(
-            storage(
-                py.path.local(self.base_path),
-                notify_on_commit=self._notify_on_commit,
-                cache_size=cache_size,
-            )
-        )
+            storage(py.path.local(self.base_path), **storage_kw))
+        # readonly values by relpath and the serial they were changed at,
+        # which never change and can be shared between transactions
+        self._value_cache = (
+            LRUCache(value_cache_size)  # is thread safe
+            if value_cache_size else None)
+        # the serial of the last change by relpath and the highest serial
+        # it was checked at, so cached values can be found without a query
+        self._last_serial_cache = (
+            LRUCache(value_cache_size)  # is thread safe
+            if value_cache_size else None)
+        self._group_commit = (
+            GroupCommit(self, group_commit_window)
+            if group_commit_window else None)
         self.io_file_factory = io_file_factory
         self._readonly = readonly
 
@@ -401,9 +541,19 @@ class KeyFS:
             subscriber_changes = {}
             for relpath, (keyname, back_serial, val) in changes.items():
                 try:
-                    (_, _, old_val) = conn.get_relpath_at(relpath, serial - 1)
+                    (last_serial, local_back_serial, old_val) = (
+                        conn.get_relpath_at(relpath, serial - 1))
                 except KeyError:
-                    old_val = absent
+                    (last_serial, local_back_serial, old_val) = (-1, -1, absent)
+                if (
+                    back_serial < last_serial
+                    and local_back_serial == -1
+                    and last_serial > 0
+                    and conn.get_raw_changelog_entry(last_serial - 1) is None
+                ):
+                    # the key was imported with a snapshot at last_serial,
+                    # its history before that doesn't exist locally
+                    back_serial = last_serial
                 typedkey = self.get_key_instance(keyname, relpath)
                 subscriber_changes[typedkey] = (val, back_serial)
                 records.append(
@@ -414,6 +564,72 @@ class KeyFS:
             with self.read_transaction(at_serial=serial):
                 self._import_subscriber(serial, subscriber_changes)
 
+    def import_snapshot(self, serial, items):
+        """ Import the state at ``serial`` into an empty storage.
+
+        The ``items`` are ``(relpath, keyname, value)`` tuples with the
+        current value of each key. They are written in batches outside
+        of the changelog, which only gets an empty entry at ``serial``,
+        the changelog before ``serial`` isn't available afterwards.
+        Returns the number of imported keys.
+        """
+        with self.get_connection() as conn:
+            if conn.last_changelog_serial != -1:
+                raise RuntimeError(
+                    "Can only import a snapshot into an empty storage.")
+        # remove leftovers of a previously interrupted import
+        self._clear_incomplete_snapshot()
+        event_serial = self.notifier.read_event_serial()
+        count = 0
+        items = iter(items)
+        try:
+            while batch := list(islice(items, SNAPSHOT_BATCH_SIZE)):
+                with self.get_connection(write=True) as conn:
+                    conn.db_write_snapshot_values(serial, batch)
+                    conn.commit()
+                count += len(batch)
+            # there are no events before the snapshot, this has to be
+            # written before the commit wakes up the notifier thread
+            self.notifier.write_event_serial(serial - 1)
+            with self.get_connection(write=True) as conn:
+                # the empty changelog entry completes the import
+                with conn.write_transaction(serial=serial):
+                    pass
+        except BaseException:
+            self.notifier.write_event_serial(event_serial)
+            # without a snapshot the changelog is replayed from the start
+            self._clear_incomplete_snapshot()
+            raise
+        if callable(self._import_subscriber):
+            changes = iter(self.iter_snapshot_changes(serial))
+            while batch := list(islice(changes, SNAPSHOT_BATCH_SIZE)):
+                subscriber_changes = {
+                    self.get_key_instance(keyname, relpath): (val, back_serial)
+                    for relpath, (keyname, back_serial, val) in batch}
+                with self.read_transaction(at_serial=serial):
+                    self._import_subscriber(serial, subscriber_changes)
+        return count
+
+    def _clear_incomplete_snapshot(self):
+        with self.get_connection(write=True) as conn:
+            if conn.last_changelog_serial == -1:
+                conn.db_clear_snapshot_values()
+                conn.commit()
+
+    def iter_snapshot_changes(self, serial):
+        """ Yield ``(relpath, (keyname, back_serial, value))`` for the keys
+        imported from a snapshot at ``serial``, in batches using short
+        lived connections. """
+        after_relpath = ""
+        while True:
+            with self.get_connection() as conn:
+                changes = conn.get_snapshot_changes(
+                    serial, after_relpath, SNAPSHOT_BATCH_SIZE)
+            yield from changes
+            if len(changes) < SNAPSHOT_BATCH_SIZE:
+                return
+            after_relpath = changes[-1][0]
+
     def subscribe_on_import(self, subscriber):
         assert self._import_subscriber is None
         self._import_subscriber = subscriber
@@ -660,6 +876,27 @@ class KeyFS:
             with self._transaction(write=True) as tx:
                 yield tx
 
+    def grouped_write(self, func):
+        """ Run ``func`` in a write transaction and return its result.
+
+        If group commit is enabled, ``func`` may run in another thread
+        together with functions submitted concurrently, which are all
+        committed with a single serial. An existing read transaction
+        of the current thread is restarted afterwards to see the changes.
+        Otherwise this is the same as calling ``func`` within
+        ``write_transaction(allow_restart=True)``.
+        """
+        tx = getattr(self._threadlocal, "tx", None)
+        if self._group_commit is None or (tx is not None and tx.write):
+            with self.write_transaction(allow_restart=True):
+                return func()
+        if self._readonly:
+            raise self.ReadOnly()
+        result = self._group_commit.run(func)
+        if tx is not None:
+            self.restart_read_transaction()
+        return result
+
 
 class KeyChangeEvent:
     def __init__(self, typedkey, value, at_serial, back_serial):
@@ -669,6 +906,16 @@ class KeyChangeEvent:
         self.back_serial = back_serial
 
 
+def get_prefix_end(prefix):
+    """ Returns the smallest string which is bigger than all strings
+        starting with ``prefix``, for use as exclusive end of a range.
+        Returns ``None`` if there is no such end. """
+    prefix = prefix.rstrip(chr(0x10ffff))
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
 def get_relpath_at(self, relpath, serial):
     """ Fallback method for legacy storage connections. """
     (keyname, last_serial) = self.db_read_typedkey(relpath)
@@ -687,8 +934,14 @@ def get_relpath_at(self, relpath, serial):
 
 
 def iter_serial_and_value_backwards(conn, relpath, last_serial):
+    # storages which can decode a single key of a changelog entry
+    # provide get_change, for others the whole entry is decoded
+    get_change = getattr(conn, "get_change", None)
     while last_serial >= 0:
-        tup = conn.get_changes(last_serial).get(relpath)
+        if get_change is None:
+            tup = conn.get_changes(last_serial).get(relpath)
+        else:
+            tup = get_change(last_serial, relpath)
         if tup is None:
             raise RuntimeError("no transaction entry at %s" % (last_serial))
         keyname, back_serial, val = tup
@@ -826,6 +1079,24 @@ class Transaction:
     def iter_relpaths_at(self, typedkeys, at_serial):
         return self.conn.iter_relpaths_at(typedkeys, at_serial)
 
+    def iter_relpaths_with_prefix(self, prefix, at_serial=None, typedkeys=None):
+        """ Iterate over the relpaths starting with ``prefix`` which exist
+            at ``at_serial`` (by default the serial of the transaction)
+            in sorted order, optionally limited to the given typed keys. """
+        if at_serial is None:
+            at_serial = self.at_serial
+        iter_relpaths = getattr(self.conn, "iter_relpaths_with_prefix", None)
+        if iter_relpaths is not None:
+            return iter_relpaths(prefix, at_serial, typedkeys=typedkeys)
+        # fallback for storages without a range scan on keys
+        if typedkeys is None:
+            typedkeys = self.keyfs._keys.values()
+        return iter(sorted(
+            (
+                info for info in self.conn.iter_relpaths_at(typedkeys, at_serial)
+                if info.relpath.startswith(prefix) and info.value is not None),
+            key=attrgetter("relpath")))
+
     def iter_serial_and_value_backwards(self, relpath, last_serial):
         while last_serial >= 0:
             (last_serial, back_serial, val) = self.conn.get_relpath_at(
@@ -862,7 +1133,7 @@ class Transaction:
     ) -> tuple[int, KeyFSTypesRO | None] | None:
         relpath = typedkey.relpath
         try:
-            (last_serial, back_serial, val) = self.conn.get_relpath_at(relpath, at_serial)
+            (last_serial, back_serial, val) = self._get_relpath_at(relpath, at_serial)
         except KeyError:
             if not raise_on_error:
                 return None
@@ -871,6 +1142,35 @@ class Transaction:
             raise KeyError(relpath)  # was deleted
         return (last_serial, val)
 
+    def _get_relpath_at(self, relpath, at_serial):
+        value_cache = self.keyfs._value_cache
+        if value_cache is None:
+            return self.conn.get_relpath_at(relpath, at_serial)
+        last_serial_cache = self.keyfs._last_serial_cache
+        (last_serial, checked_serial) = last_serial_cache.get(
+            relpath, (None, -1))
+        if last_serial is None or not (
+                last_serial <= at_serial <= checked_serial):
+            try:
+                (keyname, last_serial) = self.conn.db_read_typedkey(relpath)
+            except KeyError:
+                return self.conn.get_relpath_at(relpath, at_serial)
+            if last_serial <= at_serial:
+                # unchanged from last_serial up to at_serial
+                last_serial_cache.put(relpath, (last_serial, at_serial))
+        if last_serial <= at_serial:
+            result = value_cache.get((relpath, last_serial))
+            if result is not None:
+                return result
+        # if it changed since at_serial, we only know the serial
+        # of the value after looking it up
+        result = self.conn.get_relpath_at(relpath, at_serial)
+        cached = value_cache.get((relpath, result[0]))
+        if cached is not None:
+            return cached
+        value_cache.put((relpath, result[0]), result)
+        return result
+
     def get_value_at(self, typedkey: TypedKey, at_serial: int) -> KeyFSTypesRO | None:
         (last_serial, val) = self.get_last_serial_and_value_at(typedkey, at_serial)
         return val
@@ -944,8 +1244,10 @@ class Transaction:
         return get_mutable_deepcopy(self._get(typedkey))
 
     def get_mutable(self, typedkey):
-        """Return current mutable value referenced by typedkey."""
-        return get_mutable_deepcopy(self._get(typedkey))
+        """Return current mutable value referenced by typedkey.
+
+        Nested dictionaries are only copied when they are accessed."""
+        return get_mutable_copy_on_write(self._get(typedkey))
 
     def exists(self, typedkey):
         if typedkey in self.cache:
@@ -1078,7 +1380,11 @@ class Transaction:
 
 
 def check_unicode_keys(d):
-    for key, val in d.items():
+    # values still shared with stored data were checked before
+    shared = d._shared if isinstance(d, CopyOnWriteDict) else ()
+    for key, val in dict.items(d):
+        if key in shared:
+            continue
         assert not isinstance(key, bytes), repr(key)
         # not allowing bytes seems ok for now, we might need to relax that
         # it certainly helps to get unicode clean
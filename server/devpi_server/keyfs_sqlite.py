@@ -1,12 +1,22 @@
 from __future__ import annotations
 
+from .cache import KeynameMatcher
+from .cache import SizedLRUCache
 from .config import hookimpl
 from .filestore_fs_base import LazyChangesFormatter
+from .fileutil import compress_entry
+from .fileutil import decompress_entry
 from .fileutil import dumps
+from .fileutil import dumps_indexed_entry
+from .fileutil import is_indexed_entry
 from .fileutil import loads
+from .fileutil import loads_entry
+from .fileutil import loads_entry_value
+from .fileutil import plain_entry
 from .interfaces import IStorageConnection4
 from .interfaces import IWriter2
 from .keyfs import KeyfsTimeoutError
+from .keyfs import get_prefix_end
 from .keyfs import get_relpath_at
 from .keyfs_types import RelpathInfo
 from .log import thread_pop_log
@@ -16,7 +26,7 @@ from .markers import absent
 from .mythread import current_thread
 from .readonly import ReadonlyView
 from .readonly import ensure_deeply_readonly
-from .readonly import get_mutable_deepcopy
+from .readonly import get_detached_copy
 from .sizeof import gettotalsizeof
 from devpi_common.types import cached_property
 from io import BytesIO
@@ -28,6 +38,7 @@ import contextlib
 import os
 import shutil
 import sqlite3
+import threading
 import time
 
 
@@ -53,6 +64,8 @@ class SpooledTemporaryFile(SpooledTemporaryFileBase):
 
 class BaseConnection:
     _get_relpath_at = get_relpath_at
+    # set for read connections which are returned to the pool on close
+    _pool_info = None
 
     def __init__(self, sqlconn, basedir, storage):
         self._sqlconn = sqlconn
@@ -142,7 +155,10 @@ class BaseConnection:
         return result
 
     def close(self):
-        self._sqlconn.close()
+        if self._pool_info is None:
+            self._sqlconn.close()
+        else:
+            self.storage._release_read_sqlconn(self._sqlconn, *self._pool_info)
 
     def commit(self):
         self._sqlconn.commit()
@@ -176,35 +192,126 @@ class BaseConnection:
 
     def write_changelog_entry(self, serial, entry):
         threadlog.debug("writing changelog for serial %s", serial)
-        data = dumps(entry)
+        if self.storage.indexed_changelog:
+            data = dumps_indexed_entry(*entry)
+        else:
+            data = dumps(entry)
+        if self.storage.compress_changelog:
+            data = compress_entry(data)
         self.execute(
             "INSERT INTO changelog (serial, data) VALUES (?, ?)",
             (serial, sqlite3.Binary(data)))
 
-    def get_raw_changelog_entry(self, serial):
+    def get_stored_changelog_entry(self, serial):
+        """ Returns the changelog entry for serial as stored, it may be
+        compressed or indexed, see ``fileutil.plain_entry``. """
         q = "SELECT data FROM changelog WHERE serial = ?"
         row = self.fetchone(q, (serial,))
         if row is not None:
             return bytes(row[0])
         return None
 
+    def get_raw_changelog_entry(self, serial):
+        data = self.get_stored_changelog_entry(serial)
+        if data is not None:
+            return plain_entry(data)
+        return None
+
+    def _get_entry(self, serial):
+        data = self.get_stored_changelog_entry(serial)
+        if data is None:
+            return None
+        return decompress_entry(data)
+
+    def _get_changes_from_entry(self, serial, data):
+        changes, rel_renames = loads_entry(data)
+        # make values in changes read only so no calling site accidentally
+        # modifies data
+        changes = ensure_deeply_readonly(changes)
+        assert isinstance(changes, ReadonlyView)
+        self._changelog_cache.put(serial, changes)
+        return changes
+
     def get_changes(self, serial):
         changes = self._changelog_cache.get(serial, absent)
         if changes is absent:
-            data = self.get_raw_changelog_entry(serial)
-            changes, rel_renames = loads(data)
-            # make values in changes read only so no calling site accidentally
-            # modifies data
-            changes = ensure_deeply_readonly(changes)
-            assert isinstance(changes, ReadonlyView)
-            self._changelog_cache.put(serial, changes)
+            changes = self._get_changes_from_entry(
+                serial, self._get_entry(serial))
         return changes
 
+    def get_change(self, serial, relpath):
+        """ Returns ``(keyname, back_serial, value)`` for relpath from the
+        changelog entry at serial or None if it's not in the entry.
+        For indexed entries only the value for relpath is decoded. """
+        changes = self._changelog_cache.get(serial, absent)
+        if changes is absent:
+            data = self._get_entry(serial)
+            if not is_indexed_entry(data):
+                changes = self._get_changes_from_entry(serial, data)
+        if changes is absent:
+            try:
+                return ensure_deeply_readonly(loads_entry_value(data, relpath))
+            except KeyError:
+                return self.get_snapshot_change(serial, relpath)
+        result = changes.get(relpath)
+        if result is None:
+            result = self.get_snapshot_change(serial, relpath)
+        return result
+
+    def get_snapshot_change(self, serial, relpath):
+        """ Returns ``(keyname, back_serial, value)`` for relpath if it
+        was imported from a snapshot at serial or None. """
+        q = "SELECT keyname, data FROM kv_snapshot WHERE serial = ? AND key = ?"
+        row = self.fetchone(q, (serial, relpath))
+        if row is None:
+            return None
+        (keyname, data) = row
+        return (keyname, -1, ensure_deeply_readonly(loads(data)))
+
+    def get_snapshot_changes(self, serial, after_relpath, limit):
+        """ Returns up to ``limit`` items of ``(relpath, (keyname,
+        back_serial, value))`` imported from a snapshot at serial,
+        sorted by relpath and starting after ``after_relpath``. """
+        q = """
+            SELECT key, keyname, data FROM kv_snapshot
+            WHERE serial = ? AND key > ?
+            ORDER BY key LIMIT ?"""
+        return [
+            (relpath, (keyname, -1, ensure_deeply_readonly(loads(data))))
+            for relpath, keyname, data in self.fetchall(
+                q, (serial, after_relpath, limit))]
+
+    def db_clear_snapshot_values(self):
+        """ Remove all keys, used to clean up after an incomplete
+        snapshot import into an empty storage. """
+        self.execute("DELETE FROM kv")
+        self.execute("DELETE FROM kv_snapshot")
+        if self.storage.current_values:
+            self.execute("DELETE FROM kv_current")
+
+    def db_write_snapshot_values(self, serial, items):
+        """ Write the ``(relpath, keyname, value)`` items of a snapshot at
+        serial. The values are stored outside of the changelog, so the
+        snapshot can be written in several batches. """
+        rows = [
+            (relpath, keyname, serial, sqlite3.Binary(dumps(value)))
+            for relpath, keyname, value in items]
+        self.db_write_typedkeys(row[:3] for row in rows)
+        q = """
+            INSERT OR REPLACE INTO kv_snapshot (key, keyname, serial, data)
+            VALUES (?, ?, ?, ?)"""
+        self.executemany(q, rows)
+        if self.storage.current_values:
+            q = """
+                INSERT OR REPLACE INTO kv_current (key, serial, back_serial, data)
+                VALUES (?, ?, -1, ?)"""
+            self.executemany(q, (
+                (relpath, serial, data) for relpath, _, serial, data in rows))
+
     def get_rel_renames(self, serial):
         if serial == -1:
             return None
-        data = self.get_raw_changelog_entry(serial)
-        (_changes, rel_renames) = loads(data)
+        (_changes, rel_renames) = loads_entry(self._get_entry(serial))
         return rel_renames
 
     def get_relpath_at(self, relpath, serial):
@@ -216,6 +323,8 @@ class BaseConnection:
             if changes is not absent and relpath in changes:
                 (keyname, back_serial, value) = changes[relpath]
                 result = (serial, back_serial, value)
+        if result is absent and self.storage.current_values:
+            result = self._get_current_relpath_at(relpath, serial)
         if result is absent:
             result = self._get_relpath_at(relpath, serial)
         if gettotalsizeof(result, maxlen=100000) is None:
@@ -227,6 +336,25 @@ class BaseConnection:
             self._relpath_cache.put((serial, relpath), result)
         return result
 
+    def _get_current_relpath_at(self, relpath, serial):
+        q = "SELECT serial, back_serial, data FROM kv_current WHERE key = ?"
+        row = self.fetchone(q, (relpath,))
+        if row is None:
+            raise KeyError(relpath)
+        (last_serial, back_serial, data) = row
+        if last_serial > serial:
+            # changed after the requested serial, use the changelog
+            return absent
+        return (last_serial, back_serial, ensure_deeply_readonly(loads(data)))
+
+    def db_write_current_values(self, changes, serial):
+        q = """
+            INSERT OR REPLACE INTO kv_current (key, serial, back_serial, data)
+            VALUES (?, ?, ?, ?)"""
+        self.executemany(q, (
+            (relpath, serial, back_serial, sqlite3.Binary(dumps(value)))
+            for relpath, (keyname, back_serial, value) in changes.items()))
+
     def iter_relpaths_at(self, typedkeys, at_serial):
         keynames = frozenset(k.name for k in typedkeys)
         keyname_id_values = {"keynameid%i" % i: k for i, k in enumerate(keynames)}
@@ -244,14 +372,48 @@ class BaseConnection:
                 continue
             changes = self.get_changes(serial)
             for relpath, keyname, serial in rows:
-                (keyname, back_serial, val) = changes[relpath]
+                change = changes.get(relpath)
+                if change is None:
+                    change = self.get_snapshot_change(serial, relpath)
+                (keyname, back_serial, val) = change
                 yield RelpathInfo(
                     relpath=relpath, keyname=keyname,
                     serial=serial, back_serial=back_serial,
                     value=val)
 
-    def write_transaction(self):
-        return Writer(self.storage, self)
+    def iter_relpaths_with_prefix(self, prefix, at_serial, typedkeys=None):
+        """ Iterate over the relpaths starting with ``prefix`` which exist
+            at ``at_serial`` in sorted order, optionally limited to the
+            given typed keys. This is a range scan on the primary key
+            of the kv table instead of a walk through the changelog. """
+        q = "SELECT key, keyname, serial FROM kv WHERE key >= ?"
+        args = [prefix]
+        prefix_end = get_prefix_end(prefix)
+        if prefix_end is not None:
+            q = f"{q} AND key < ?"
+            args.append(prefix_end)
+        if typedkeys is not None:
+            keynames = sorted(frozenset(k.name for k in typedkeys))
+            q = "%s AND keyname IN (%s)" % (q, ", ".join("?" * len(keynames)))
+            args.extend(keynames)
+        q = f"{q} ORDER BY key"
+        for relpath, keyname, _serial in self.fetchall(q, args):
+            try:
+                (serial, back_serial, val) = self.get_relpath_at(
+                    relpath, at_serial)
+            except KeyError:
+                # created after at_serial
+                continue
+            if val is None:
+                # deleted
+                continue
+            yield RelpathInfo(
+                relpath=relpath, keyname=keyname,
+                serial=serial, back_serial=back_serial,
+                value=val)
+
+    def write_transaction(self, serial=None):
+        return Writer(self.storage, self, serial=serial)
 
 
 @implementer(IStorageConnection4)
@@ -379,17 +541,63 @@ class Connection(BaseConnection):
 
 
 class BaseStorage(object):
-    def __init__(self, basedir, notify_on_commit, cache_size):
+    current_values_schema = dict(
+        table=dict(
+            kv_current="""
+                CREATE TABLE kv_current (
+                    key TEXT NOT NULL PRIMARY KEY,
+                    serial INTEGER NOT NULL,
+                    back_serial INTEGER NOT NULL,
+                    data BLOB NOT NULL
+                )
+            """))
+    snapshot_schema = dict(
+        table=dict(
+            kv_snapshot="""
+                CREATE TABLE kv_snapshot (
+                    key TEXT NOT NULL,
+                    keyname TEXT NOT NULL,
+                    serial INTEGER NOT NULL,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (serial, key)
+                )
+            """))
+
+    def __init__(
+            self, basedir, notify_on_commit, cache_size,
+            current_values=False, compress_changelog=False,
+            indexed_changelog=False, cache_memory=None,
+            read_connection_pool_size=2):
         self.basedir = basedir
+        self.read_connection_pool_size = read_connection_pool_size
+        self._read_sqlconns = threading.local()
+        # changed whenever the schema is modified, so pooled
+        # read connections opened before are discarded
+        self._schema_generation = 0
+        self.current_values = current_values
+        self.compress_changelog = compress_changelog
+        self.indexed_changelog = indexed_changelog
         self.sqlpath = self.basedir.join(self.db_filename)
         self._notify_on_commit = notify_on_commit
-        changelog_cache_size = max(1, cache_size // 20)
-        relpath_cache_size = max(1, cache_size - changelog_cache_size)
-        self._changelog_cache = LRUCache(changelog_cache_size)  # is thread safe
-        self._relpath_cache = LRUCache(relpath_cache_size)  # is thread safe
+        if cache_memory:
+            # a single cache for both, as the size of the values
+            # is taken into account
+            self._keyname_matcher = KeynameMatcher()
+            self._changelog_cache = self._relpath_cache = SizedLRUCache(
+                cache_memory, get_keyname=self._keyname_matcher)
+        else:
+            changelog_cache_size = max(1, cache_size // 20)
+            relpath_cache_size = max(1, cache_size - changelog_cache_size)
+            self._changelog_cache = LRUCache(changelog_cache_size)  # is thread safe
+            self._relpath_cache = LRUCache(relpath_cache_size)  # is thread safe
         self.last_commit_timestamp = time.time()
         self.ensure_tables_exist()
 
+    def add_key(self, key):
+        keyname_matcher = getattr(self, "_keyname_matcher", None)
+        if keyname_matcher is not None:
+            keyname_matcher.add_key(key)
+
     def _get_sqlconn_uri_kw(self, uri):
         return sqlite3.connect(
             uri, timeout=60, isolation_level=None, uri=True)
@@ -451,7 +659,67 @@ class BaseStorage(object):
         else:
             return conn
 
+    def _get_file_id(self):
+        try:
+            st = os.stat(self.sqlpath.strpath)
+        except FileNotFoundError:
+            return None
+        return (st.st_dev, st.st_ino)
+
+    def _get_read_sqlconn_pool(self):
+        pool = getattr(self._read_sqlconns, "pool", None)
+        if pool is None:
+            pool = self._read_sqlconns.pool = []
+        return pool
+
+    def _pop_read_sqlconn(self, file_id):
+        pool = self._get_read_sqlconn_pool()
+        while pool:
+            (sqlconn, sqlconn_file_id, generation) = pool.pop()
+            if sqlconn_file_id == file_id and generation == self._schema_generation:
+                return sqlconn
+            # the database file was replaced or the schema changed
+            sqlconn.close()
+        return None
+
+    def _release_read_sqlconn(self, sqlconn, file_id, generation):
+        pool = self._get_read_sqlconn_pool()
+        reusable = (
+            not sqlconn.in_transaction
+            and generation == self._schema_generation
+            and len(pool) < self.read_connection_pool_size)
+        if reusable:
+            pool.append((sqlconn, file_id, generation))
+        else:
+            sqlconn.close()
+
+    def close_read_connections(self):
+        """ Close the pooled read connections of the current thread. """
+        pool = self._get_read_sqlconn_pool()
+        while pool:
+            (sqlconn, _file_id, _generation) = pool.pop()
+            sqlconn.close()
+
+    def _get_pooled_read_connection(self):
+        file_id = self._get_file_id()
+        if file_id is None:
+            return None
+        sqlconn = self._pop_read_sqlconn(file_id)
+        if sqlconn is None:
+            uri = "file:%s?mode=ro" % self.sqlpath
+            sqlconn = self._get_sqlconn(uri)
+            self._execute_conn_pragmas(sqlconn)
+        conn = self.Connection(sqlconn, self.basedir, self)
+        conn._pool_info = (file_id, self._schema_generation)
+        return conn
+
     def get_connection(self, closing=True, write=False, timeout=30):
+        if not write and self.read_connection_pool_size:
+            conn = self._get_pooled_read_connection()
+            if conn is not None:
+                if closing:
+                    return contextlib.closing(conn)
+                return conn
         # we let the database serialize all writers at connection time
         # to play it very safe (we don't have massive amounts of writes).
         mode = "ro"
@@ -494,10 +762,53 @@ class BaseStorage(object):
                 result.setdefault(row[0], {})[row[1]] = row[2]
         return result
 
+    def _get_expected_schema(self):
+        expected_schema = {
+            kind: dict(objs) for kind, objs in self.expected_schema.items()}
+        for kind, objs in self.snapshot_schema.items():
+            expected_schema.setdefault(kind, {}).update(objs)
+        if self.current_values:
+            for kind, objs in self.current_values_schema.items():
+                expected_schema.setdefault(kind, {}).update(objs)
+        return expected_schema
+
+    def _drop_current_values(self, schema):
+        names = [
+            name for name in self.current_values_schema.get('table', {})
+            if name in schema.get('table', {})]
+        if not names:
+            return
+        # the table isn't updated anymore, so it would be stale
+        # if the option is enabled again later
+        threadlog.info("DB: Removing current values table")
+        with self.get_connection(write=True) as conn:
+            for name in names:
+                conn.execute('DROP TABLE "%s"' % name)
+            conn.commit()
+        self._schema_generation += 1
+
+    def _fill_current_values(self):
+        with self.get_connection(write=True) as conn:
+            q = "SELECT key, serial FROM kv ORDER BY serial"
+            rows = conn.fetchall(q)
+            if not rows:
+                return
+            threadlog.info(
+                "DB: Filling current values table for %s keys", len(rows))
+            changes_at = {}
+            for relpath, serial in rows:
+                changes_at.setdefault(serial, {})[relpath] = conn.get_change(
+                    serial, relpath)
+            for serial, changes in changes_at.items():
+                conn.db_write_current_values(changes, serial)
+            conn.commit()
+
     def ensure_tables_exist(self):
         schema = self._reflect_schema()
+        if not self.current_values:
+            self._drop_current_values(schema)
         missing = dict()
-        for kind, objs in self.expected_schema.items():
+        for kind, objs in self._get_expected_schema().items():
             for name, q in objs.items():
                 if name not in schema.get(kind, set()):
                     missing.setdefault(kind, dict())[name] = q
@@ -517,7 +828,10 @@ class BaseStorage(object):
                 assert not objs
             c.close()
             conn.commit()
+        self._schema_generation += 1
         assert not missing
+        if self.current_values and 'kv_current' not in schema.get('table', {}):
+            self._fill_current_values()
 
 
 class Storage(BaseStorage):
@@ -576,6 +890,10 @@ def devpiserver_metrics(request):
     relpath_cache = getattr(storage, '_relpath_cache', None)
     if changelog_cache is None and relpath_cache is None:
         return result
+    if changelog_cache is relpath_cache:
+        # a single cache bounded by memory
+        result.extend(get_sized_cache_metrics(changelog_cache))
+        return result
     # get sizes for changelog_cache
     evictions = changelog_cache.evictions if changelog_cache else 0
     hits = changelog_cache.hits if changelog_cache else 0
@@ -615,9 +933,10 @@ def devpiserver_metrics(request):
 
 @implementer(IWriter2)
 class Writer:
-    def __init__(self, storage, conn):
+    def __init__(self, storage, conn, serial=None):
         self.conn = conn
         self.storage = storage
+        self.serial = serial
         self.changes = {}
         self.rel_renames = []
 
@@ -626,7 +945,7 @@ class Writer:
         assert not isinstance(value, ReadonlyView), value
         # at __exit__ time we write out changes to the _changelog_cache
         # so we protect here against the caller modifying the value later
-        value = get_mutable_deepcopy(value)
+        value = get_detached_copy(value)
         self.changes[typedkey.relpath] = (typedkey.name, back_serial, value)
 
     def records_set(self, records: Iterable[Record]) -> None:
@@ -638,6 +957,10 @@ class Writer:
 
     def __enter__(self):
         self.commit_serial = self.conn.last_changelog_serial + 1
+        if self.serial is not None:
+            # when importing a snapshot there are no previous serials
+            assert self.serial >= self.commit_serial
+            self.commit_serial = self.serial
         self.log = thread_push_log("fswriter%s:" % self.commit_serial)
         return self
 
@@ -673,6 +996,8 @@ class Writer:
             data.append((relpath, keyname, commit_serial))
         self.conn.db_write_typedkeys(data)
         del data
+        if self.storage.current_values:
+            self.conn.db_write_current_values(self.changes, commit_serial)
         entry = (self.changes, self.rel_renames)
         self.conn.write_changelog_entry(commit_serial, entry)
         (files_commit, files_del) = self.conn._write_dirty_files()
@@ -682,3 +1007,25 @@ class Writer:
 
     def rollback(self):
         self.conn.rollback()
+
+
+def get_sized_cache_metrics(cache):
+    result = [
+        ('devpi_server_storage_cache_evictions', 'counter', cache.evictions),
+        ('devpi_server_storage_cache_hits', 'counter', cache.hits),
+        ('devpi_server_storage_cache_lookups', 'counter', cache.lookups),
+        ('devpi_server_storage_cache_misses', 'counter', cache.misses),
+        ('devpi_server_storage_cache_size', 'gauge', cache.size),
+        ('devpi_server_storage_cache_items', 'gauge', len(cache.data)),
+        ('devpi_server_storage_cache_memory_bytes', 'gauge', cache.memory)]
+    for keyname, stats in sorted(
+            cache.keyname_stats.items(), key=lambda x: x[0] or ""):
+        # keyname is None for whole changelog entries
+        prefix = "devpi_server_storage_cache_%s" % (
+            "changelog" if keyname is None else keyname.lower())
+        result.extend([
+            (f'{prefix}_evictions', 'counter', stats.evictions),
+            (f'{prefix}_hits', 'counter', stats.hits),
+            (f'{prefix}_misses', 'counter', stats.misses),
+            (f'{prefix}_memory_bytes', 'gauge', stats.size)])
+    return result
@@ -46,6 +46,9 @@ if TYPE_CHECKING:
     import argparse
 
 
+SERVER_LOCK_FILENAME = ".server.lock"
+
+
 class Fatal(Exception):
     pass
 
@@ -160,6 +163,28 @@ def xom_from_config(config, init=False):
     return XOM(config)
 
 
+def lock_server_path(server_path, *, exclusive=False):
+    """ Return an open file with an advisory lock on the server directory,
+    the lock is released when the file is closed. Returns None if the
+    platform doesn't support file locks.
+
+    A running devpi-server holds a shared lock, commands which must not
+    run at the same time use an exclusive lock.
+    Raises BlockingIOError if another process holds a conflicting lock.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return None
+    f = open(os.path.join(server_path, SERVER_LOCK_FILENAME), "ab")  # noqa: SIM115
+    try:
+        fcntl.flock(f, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+    except BaseException:
+        f.close()
+        raise
+    return f
+
+
 def init_default_indexes(xom):
     # we deliberately call get_current_serial first to establish a connection
     # to the backend and in case of sqlite create the database
@@ -194,7 +219,16 @@ def _main(pluginmanager, argv=None):
 
     xom = xom_from_config(config)
 
-    return xom.main()
+    try:
+        server_lock = lock_server_path(config.server_path)
+    except BlockingIOError:
+        msg = f"The serverdir '{config.server_path}' is in use by devpi-warmup."
+        raise Fatal(msg) from None
+    try:
+        return xom.main()
+    finally:
+        if server_lock is not None:
+            server_lock.close()
 
 
 def make_application():
@@ -308,6 +342,33 @@ class XOM:
             if not self.config.requests_only:
                 self.replica_thread = ReplicaThread(self)
                 self.thread_pool.register(self.replica_thread)
+            if self.config.serve_replication and (
+                    self.config.changelog_snapshot_interval
+                    or self.config.replica_snapshot):
+                from devpi_server.replica import ChangelogSnapshotThread
+                if not self.config.requests_only:
+                    self.changelog_snapshot_thread = ChangelogSnapshotThread(self)
+                    self.thread_pool.register(self.changelog_snapshot_thread)
+        elif self.is_primary() and self.config.changelog_snapshot_interval:
+            from devpi_server.replica import ChangelogSnapshotThread
+            if not self.config.requests_only:
+                self.changelog_snapshot_thread = ChangelogSnapshotThread(self)
+                self.thread_pool.register(self.changelog_snapshot_thread)
+        if self.is_primary() and self.config.mirror_changelog_interval:
+            from devpi_server.mirror import MirrorChangelogThread
+            if not self.config.requests_only:
+                self.mirror_changelog_thread = MirrorChangelogThread(self)
+                self.thread_pool.register(self.mirror_changelog_thread)
+        if self.is_primary() and self.config.mirror_cache_eviction_interval:
+            from devpi_server.mirror import MirrorCacheEvictionThread
+            if not self.config.requests_only:
+                self.mirror_cache_eviction_thread = MirrorCacheEvictionThread(self)
+                self.thread_pool.register(self.mirror_cache_eviction_thread)
+        if self.is_primary() and self.config.mirror_refresh_hot_projects:
+            from devpi_server.mirror import HotProjectsRefreshThread
+            if not self.config.requests_only:
+                self.hot_projects_refresh_thread = HotProjectsRefreshThread(self)
+                self.thread_pool.register(self.hot_projects_refresh_thread)
 
     def create_future(self) -> asyncio.Future:
         return self.async_thread.loop.create_future()
@@ -377,6 +438,11 @@ class XOM:
                 s[key] = default
             return s[key]
 
+    def iter_singletons(self, key):
+        """ return the singletons for the given key of all indexpaths. """
+        with self._stagecache_lock:
+            return [s[key] for s in self._stagecache.values() if key in s]
+
     def del_singletons(self, indexpath):
         """ delete all singletones for the given indexpath """
         with self._stagecache_lock:
@@ -439,6 +505,13 @@ class XOM:
             io_file_factory=self.config.io_file_factory,
             readonly=self.is_replica(),
             cache_size=self.config.args.keyfs_cache_size,
+            cache_memory=self.config.keyfs_cache_memory,
+            current_values=self.config.args.keyfs_current_values,
+            compress_changelog=self.config.args.keyfs_compress_changelog,
+            indexed_changelog=self.config.args.keyfs_indexed_changelog,
+            read_connection_pool_size=self.config.args.keyfs_read_connections,
+            group_commit_window=self.config.args.keyfs_group_commit_window,
+            value_cache_size=self.config.args.keyfs_value_cache_size,
         )
         add_keys(self, keyfs)
         try:
@@ -450,12 +523,17 @@ class XOM:
             self.thread_pool.register(keyfs.notifier)
         return keyfs
 
-    def new_http_client(self, component_name):
+    def new_http_client(self, component_name, *, http2=False):
         if self.config.offline_mode:
             return OfflineHTTPClient()
+        config = self.config
         return HTTPClient(
             component_name=component_name,
-            timeout=getattr(self.config.args, "request_timeout", None),
+            timeout=getattr(config.args, "request_timeout", None),
+            max_connections_per_host=config.http_max_connections_per_host,
+            max_keepalive_connections_per_host=config.http_max_keepalive_connections_per_host,
+            keepalive_expiry=config.http_keepalive_expiry,
+            http2=http2,
         )
 
     def _new_http_session(self, component_name):
@@ -471,12 +549,21 @@ class XOM:
 
     @cached_property
     def _http(self):
-        return self.new_http_client("server")
+        # this is the client used for mirror upstreams
+        return self.new_http_client("server", http2=self.config.mirror_http2)
 
     @cached_property
     def _httpsession(self):
         return self._new_http_session("server")
 
+    def get_http_pool_metrics(self):
+        if "_http" not in self.__dict__:
+            # only if the client was already used
+            return []
+        if not isinstance(self._http, HTTPClient):
+            return []
+        return self._http.get_pool_metrics("devpi_server_http")
+
     def _close_sessions(self):
         self._http.close()
         self._httpsession.close()
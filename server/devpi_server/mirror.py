@@ -6,11 +6,15 @@ toxresult storage.
 """
 from __future__ import annotations
 
+from . import mythread
 from .config import hookimpl
 from .exceptions import lazy_format_exception
+from .filestore import Digests
+from .filestore import FileEntry
 from .filestore import key_from_link
 from .htmlpage import HTMLPage
 from .httpclient import FatalResponse
+from .log import thread_push_log
 from .log import threadlog
 from .markers import unknown
 from .model import BaseStage
@@ -18,43 +22,57 @@ from .model import BaseStageCustomizer
 from .model import Rel
 from .model import ensure_boolean
 from .model import join_links_data
+from .normalized import NormalizedName
 from .normalized import normalize_name
 from .readonly import ensure_deeply_readonly
 from .views import SIMPLE_API_V1_JSON
+from array import array
 from asyncio import Future
 from attrs import frozen
+from collections import Counter
+from collections.abc import Mapping
 from devpi_common.metadata import BasenameMeta
 from devpi_common.metadata import is_archive_of_project
 from devpi_common.metadata import parse_version
 from devpi_common.types import cached_property
 from devpi_common.url import URL
+from email.utils import parsedate_to_datetime
 from functools import partial
 from html.parser import HTMLParser
 from pyramid.authentication import b64encode
+from repoze.lru import ExpiringLRUCache
 from typing import TYPE_CHECKING
 from typing import TypedDict
 from typing import cast
+from xml.parsers.expat import ExpatError
 import asyncio
+import copy
 import json
 import re
 import threading
 import time
 import warnings
 import weakref
+import xmlrpc.client
 
 
 if TYPE_CHECKING:
-    from .filestore import FileEntry
+    from .filestore import MutableFileEntry
     from .httpclient import AsyncGetResponse
     from .httpclient import HTTPClient
     from .keyfs_types import PTypedKey
+    from .main import XOM
+    from .model import CoreMetadata
+    from .model import CoreMetadataList
     from .model import JoinedLinkList
     from .model import LinksList
     from .model import RequiresPythonList
     from .model import SimpleLinks
     from .model import YankedList
-    from .normalized import NormalizedName
     from collections.abc import Callable
+    from collections.abc import Iterable
+    from collections.abc import Iterator
+    from collections.abc import Sequence
     from typing import Any
     from typing_extensions import NotRequired
 
@@ -64,6 +82,7 @@ if TYPE_CHECKING:
         links: LinksList
         requires_python: RequiresPythonList
         yanked: YankedList
+        core_metadata: NotRequired[CoreMetadataList]
         serial: int
         etag: NotRequired[str | None]
 
@@ -75,6 +94,7 @@ class NewLinks:
     key_hrefs: LinksList
     requires_python: RequiresPythonList
     yanked: YankedList
+    core_metadata: CoreMetadataList
     devpi_serial: str | None
     etag: str | None
 
@@ -94,9 +114,25 @@ class Link(URL):
     def __init__(self, url="", *args, **kwargs):
         self.requires_python = kwargs.pop('requires_python', None)
         self.yanked = kwargs.pop('yanked', None)
+        self.core_metadata = kwargs.pop('core_metadata', None)
         URL.__init__(self, url, *args, **kwargs)
 
 
+def parse_core_metadata(value: Any) -> CoreMetadata:
+    """ Normalize the PEP 658/714 core metadata info of a link from the
+    HTML or JSON simple API to True, a hash spec or None. """
+    if isinstance(value, dict):
+        if not value:
+            return True
+        hash_type = "sha256" if "sha256" in value else next(iter(value))
+        return f"{hash_type}={value[hash_type]}"
+    if value is True or value == "true":
+        return True
+    if isinstance(value, str) and "=" in value:
+        return value
+    return None
+
+
 class ProjectHTMLParser(HTMLParser):
     def __init__(self, url):
         HTMLParser.__init__(self)
@@ -184,7 +220,10 @@ class IndexParser:
         p = HTMLPage(html, disturl.url)
         seen = set()
         for link in p.links:
-            newurl = Link(link.url, requires_python=link.requires_python, yanked=link.yanked)
+            newurl = Link(
+                link.url, requires_python=link.requires_python,
+                yanked=link.yanked,
+                core_metadata=parse_core_metadata(link.core_metadata))
             if not newurl.is_valid_http_url():
                 continue
             if is_archive_of_project(newurl, self.project):
@@ -224,10 +263,13 @@ def parse_index_v1_json(disturl: URL | str, text: str) -> ReleaseLinks:
         elif hashes:
             url = url.replace(fragment="=".join(next(iter(hashes.items()))))
         # the BasenameMeta wrapping essentially does link validation
+        core_metadata = item.get(
+            'core-metadata', item.get('dist-info-metadata'))
         result.append(BasenameMeta(Link(
             url,
             requires_python=item.get('requires-python'),
-            yanked=item.get('yanked'))).obj)
+            yanked=item.get('yanked'),
+            core_metadata=parse_core_metadata(core_metadata))).obj)
     return result
 
 
@@ -435,6 +477,18 @@ class MirrorStage(BaseStage):
         return self.ixconfig.get(
             'mirror_cache_expiry', self.xom.config.mirror_cache_expiry)
 
+    @property
+    def mirror_changelog_url(self):
+        return self.ixconfig.get("mirror_changelog_url")
+
+    @property
+    def cache_quota(self):
+        return self.ixconfig.get("mirror_cache_quota")
+
+    @property
+    def not_found_expiry(self):
+        return self.ixconfig.get("mirror_not_found_expiry", self.cache_expiry)
+
     @property
     def ignore_serial_header(self):
         return self.ixconfig.get("mirror_ignore_serial_header", False)
@@ -484,8 +538,11 @@ class MirrorStage(BaseStage):
             "custom_data",
             "description",
             "mirror_cache_expiry",
+            "mirror_cache_quota",
+            "mirror_changelog_url",
             "mirror_ignore_serial_header",
             "mirror_no_project_list",
+            "mirror_not_found_expiry",
             "mirror_url",
             "mirror_use_external_urls",
             "mirror_web_url_fmt",
@@ -503,13 +560,29 @@ class MirrorStage(BaseStage):
                 raise self.InvalidIndexconfig([
                     "'mirror_url' option must be a URL."])
             return value
-        if key == "mirror_cache_expiry":
+        if key == "mirror_changelog_url":
+            if not value:
+                return None
+            if not value.startswith(("http://", "https://")):
+                raise self.InvalidIndexconfig([
+                    "'mirror_changelog_url' option must be a URL."])
+            return value
+        if key in ("mirror_cache_expiry", "mirror_not_found_expiry"):
             try:
                 value = int(value)
             except (TypeError, ValueError) as e:
                 raise self.InvalidIndexconfig([
-                    "'mirror_cache_expiry' option must be an integer"]) from e
+                    f"{key!r} option must be an integer"]) from e
             return value
+        if key == "mirror_cache_quota":
+            if value in (None, "", 0, "0"):
+                return None
+            try:
+                return parse_size(value)
+            except ValueError as e:
+                raise self.InvalidIndexconfig([
+                    "'mirror_cache_quota' option must be a size in bytes "
+                    "with an optional K, M, G or T suffix"]) from e
         if key == "mirror_ignore_serial_header":
             return ensure_boolean(value)
         if key == "mirror_no_project_list":
@@ -567,6 +640,85 @@ class MirrorStage(BaseStage):
                 if entry.version == version and entry.file_exists():
                     entry.delete_file_only()
 
+    def get_core_metadata_entry(self, relpath: str) -> MutableFileEntry | None:
+        """ Return a new entry for the core metadata file (PEP 658) of the
+        release file at relpath without the ``.metadata`` suffix, if
+        upstream provides it."""
+        base_relpath = relpath.removesuffix(".metadata")
+        base_entry = self.filestore.get_file_entry(base_relpath)
+        if base_entry is None or not base_entry.meta or not base_entry.project:
+            return None
+        (_is_expired, links, _serial, _etag) = self._load_cache_links(
+            base_entry.project)
+        for link in links or ():
+            if link[1].split("#", 1)[0] == base_relpath:
+                core_metadata = link[4]
+                break
+        else:
+            return None
+        if not core_metadata:
+            return None
+        # the key doesn't exist yet, so derive it from the one of the base
+        key = self.keyfs.get_key_instance(base_entry.key.name, relpath)
+        meta = dict(url=f"{base_entry.url}.metadata", project=base_entry.project)
+        if base_entry.version is not None:
+            meta["version"] = base_entry.version
+        if isinstance(core_metadata, str):
+            meta["hash_spec"] = core_metadata
+            meta["hashes"] = dict(Digests.from_spec(core_metadata))
+        # nothing is written until the file is fetched
+        return self.filestore.get_file_entry_from_key(key, meta=meta)
+
+    def iter_cached_file_entries(self) -> Iterator[FileEntry]:
+        keyfs = self.keyfs
+        items = keyfs.tx.iter_relpaths_with_prefix(
+            f"{self.name}/+e/", typedkeys=(keyfs.get_key("PYPIFILE_NOMD5"),))
+        for item in items:
+            key = keyfs.get_key_instance(item.keyname, item.relpath)
+            entry = FileEntry(key, item.value)
+            if entry.last_modified and entry.file_exists():
+                yield entry
+
+    def get_eviction_candidates(self, quota: int) -> list[tuple[str, int]]:
+        """ Return relpaths and sizes of the least recently used files
+        which have to be deleted to get the cached files within quota."""
+        access_times = self.cache_file_access
+        downloads = self.xom.filestore.downloads
+        total = 0
+        files = []
+        for entry in self.iter_cached_file_entries():
+            size = entry.file_size() or 0
+            total += size
+            relpath = entry.relpath
+            if relpath in downloads:
+                continue
+            # files not accessed since the start of the process come first,
+            # ordered by the modification time reported by upstream
+            files.append((
+                access_times.get(relpath, 0.0),
+                http_date_to_timestamp(entry.last_modified),
+                relpath, size))
+        result = []
+        for _atime, _mtime, relpath, size in sorted(files):
+            if total <= quota:
+                break
+            result.append((relpath, size))
+            total -= size
+        return result
+
+    def evict_cached_files(self, relpaths: Iterable[str]) -> int:
+        """ Delete the files, but keep their metadata, so they are fetched
+        again on demand. Returns the number of deleted files."""
+        count = 0
+        for relpath in relpaths:
+            entry = self.xom.filestore.get_file_entry(relpath)
+            if entry is None or not entry.file_exists():
+                continue
+            entry.file_delete()
+            self.cache_file_access.discard(relpath)
+            count += 1
+        return count
+
     def del_entry(self, entry, cleanup=True):
         project = entry.project
         if project is None:
@@ -606,7 +758,28 @@ class MirrorStage(BaseStage):
         # we could keep this info in keyfs but it would lead to a write
         # for each remote check.
         return self.xom.setdefault_singleton(
-            self.name, "project_retrieve_times", factory=ProjectUpdateCache)
+            self.name, "project_retrieve_times", factory=partial(
+                ProjectUpdateCache,
+                not_found_size=self.xom.config.mirror_not_found_cache_size))
+
+    @property
+    def cache_changelog(self):
+        """ per-xom RAM state for following the upstream changelog. """
+        return self.xom.setdefault_singleton(
+            self.name, "changelog", factory=MirrorChangelog)
+
+    @property
+    def cache_file_access(self):
+        """ per-xom RAM cache of the last access time of mirror files. """
+        # kept out of keyfs to avoid a write for each download
+        return self.xom.setdefault_singleton(
+            self.name, "file_access_times", factory=FileAccessTimes)
+
+    @property
+    def cache_project_access(self):
+        """ per-xom RAM counter of requests for simplelinks per project. """
+        return self.xom.setdefault_singleton(
+            self.name, "project_access_counts", factory=ProjectAccessCounts)
 
     async def _get_remote_projects(self, projects_future: asyncio.Future) -> None:
         headers = {"Accept": SIMPLE_API_ACCEPT}
@@ -641,11 +814,7 @@ class MirrorStage(BaseStage):
             parser = ProjectHTMLParser(response.url)
             parser.feed(text)
         projects_future.set_result(
-            (
-                {normalize_name(x): x for x in parser.projects},
-                response.headers.get("ETag"),
-            )
-        )
+            (ProjectNames(parser.projects), response.headers.get("ETag")))
 
     def _stale_list_projects_perstage(self):
         return {normalize_name(x): x for x in self.key_projects.get()}
@@ -723,9 +892,13 @@ class MirrorStage(BaseStage):
 
     def list_projects_perstage(self):
         """ Return the project names. """
+        projects = self._list_projects_perstage()
+        if isinstance(projects, ProjectNames):
+            # already immutable
+            return projects
         # return a read-only version of the cached data,
         # so it can't be modified accidentally and we avoid a copy
-        return ensure_deeply_readonly(self._list_projects_perstage())
+        return ensure_deeply_readonly(projects)
 
     def is_project_cached(self, project):
         """ return True if we have some cached simpelinks information. """
@@ -739,6 +912,7 @@ class MirrorStage(BaseStage):
         yanked: YankedList,
         serial: int,
         etag: str | None,
+        core_metadata: CoreMetadataList | None = None,
     ) -> None:
         assert isinstance(serial, int)
         assert project == normalize_name(project), project
@@ -749,6 +923,8 @@ class MirrorStage(BaseStage):
             "serial": serial,
             "yanked": yanked,
         }
+        if core_metadata and any(core_metadata):
+            data["core_metadata"] = core_metadata
         key = self.key_projsimplelinks(project)
         old = cast("CacheLinks", key.get())
         if old != data:
@@ -780,7 +956,8 @@ class MirrorStage(BaseStage):
             links_with_data = join_links_data(
                 cache["links"],
                 cache.get("requires_python", []),
-                cache.get("yanked", []))
+                cache.get("yanked", []),
+                cache.get("core_metadata", []))
             if self.offline and links_with_data:
                 links_with_data = ensure_deeply_readonly(list(
                     filter(self._is_file_cached, links_with_data)))
@@ -828,8 +1005,6 @@ class MirrorStage(BaseStage):
                 etag=etag)
         if response.status_code != 200 or isinstance(response, FatalResponse):
             if response.status_code == 404:
-                # immediately cache the not found with no ETag
-                self.cache_retrieve_times.refresh(project, None)
                 raise self.UpstreamNotFoundError(
                     "not found on GET %r" % url)
 
@@ -878,6 +1053,7 @@ class MirrorStage(BaseStage):
         key_hrefs: list = [None] * num_releaselinks
         requires_python: RequiresPythonList = [None] * num_releaselinks
         yanked: YankedList = [None] * num_releaselinks
+        core_metadata: CoreMetadataList = [None] * num_releaselinks
         for index, releaselink in enumerate(releaselinks):
             key = _key_from_link(releaselink)
             href = key.relpath
@@ -886,6 +1062,7 @@ class MirrorStage(BaseStage):
             key_hrefs[index] = (releaselink.basename, href)
             requires_python[index] = releaselink.requires_python
             yanked[index] = None if releaselink.yanked is False else releaselink.yanked
+            core_metadata[index] = releaselink.core_metadata
         newlinks_future.set_result(
             NewLinks(
                 serial=serial,
@@ -893,6 +1070,7 @@ class MirrorStage(BaseStage):
                 key_hrefs=key_hrefs,
                 requires_python=requires_python,
                 yanked=yanked,
+                core_metadata=core_metadata,
                 devpi_serial=response.headers.get("X-DEVPI-SERIAL"),
                 etag=response.headers.get("ETag"),
             )
@@ -934,7 +1112,7 @@ class MirrorStage(BaseStage):
             raise self.UpstreamError("no cache links from primary for %s" %
                                      project)
 
-        with self.keyfs.write_transaction(allow_restart=True):
+        def save_links():
             # on the master we need to write the updated links.
             maplink = partial(
                 self.filestore.maplink,
@@ -953,8 +1131,11 @@ class MirrorStage(BaseStage):
                 info.yanked,
                 info.serial,
                 info.etag,
+                core_metadata=info.core_metadata,
             )
-            return self.SimpleLinks(newlinks)
+
+        self.keyfs.grouped_write(save_links)
+        return self.SimpleLinks(newlinks)
 
     async def _update_simplelinks_in_future(
         self,
@@ -966,7 +1147,8 @@ class MirrorStage(BaseStage):
         info = await newlinks_future
         threadlog.debug("Got simple links for %r", project)
 
-        newlinks = join_links_data(info.key_hrefs, info.requires_python, info.yanked)
+        newlinks = join_links_data(
+            info.key_hrefs, info.requires_python, info.yanked, info.core_metadata)
         with self.keyfs.write_transaction():
             self.keyfs.tx.on_finished(lock.release)
             # fetch current links
@@ -977,8 +1159,149 @@ class MirrorStage(BaseStage):
                 threadlog.debug(
                     "Updated simplelinks for %r in background", project)
             else:
+                self.cache_retrieve_times.refresh(project, info.etag)
                 threadlog.debug("Unchanged simplelinks for %r", project)
 
+    async def _refresh_simplelinks_in_background(
+        self,
+        project: NormalizedName,
+        cache_serial: int,
+        etag: str | None,
+        _key_from_link: Callable,
+        lock: ProjectUpdateInnerLock,
+    ) -> None:
+        newlinks_future = cast("NewLinksFuture", self.xom.create_future())
+        try:
+            await self._async_fetch_releaselinks(
+                newlinks_future, project, cache_serial, etag, _key_from_link
+            )
+        except self.UpstreamNotModified as e:
+            self.cache_retrieve_times.refresh(project, e.etag)
+            lock.release()
+        except (self.UpstreamNotFoundError, self.UpstreamError) as e:
+            if isinstance(e, self.UpstreamNotFoundError):
+                # keep serving the existing links until they expire again
+                self.cache_retrieve_times.refresh(project, None)
+            lock.release()
+            threadlog.warn(
+                "refreshing simplelinks for %r failed: %s",
+                project, lazy_format_exception(e))
+        except BaseException:
+            lock.release()
+            raise
+        else:
+            # the lock is released when the write transaction is finished
+            await self._update_simplelinks_in_future(newlinks_future, project, lock)
+
+    def refresh_simplelinks_perstage(self, project: NormalizedName | str) -> bool:
+        """ fetch the releaselinks of an already cached project in the
+        background, without waiting for the result.
+
+        Returns False if the project isn't cached or is already being
+        updated.
+        """
+        project = normalize_name(project)
+        lock = self.cache_retrieve_times.acquire(project, 0)
+        if lock is None:
+            return False
+        # releases the lock if it wasn't deferred to the background task
+        self.keyfs.tx.on_finished(lock.release)
+        (is_expired, links, cache_serial, etag) = self._load_cache_links(project)
+        inner_lock = lock.defer()
+        if inner_lock is None:
+            return False
+        if links is None:
+            inner_lock.release()
+            return False
+        _key_from_link = partial(
+            key_from_link, self.keyfs, user=self.user.name, index=self.index)
+        self.xom.run_coroutine_in_background(
+            self._refresh_simplelinks_in_background(
+                project, cache_serial, etag, _key_from_link, inner_lock))
+        return True
+
+    def _changelog_call(self, method: str, *params: Any) -> Any:
+        url = URL(self.mirror_changelog_url)
+        headers = {"Content-Type": "text/xml"}
+        if url.username or url.password:
+            auth = f"{url.username or ''}:{url.password or ''}".encode()
+            headers["Authorization"] = f"Basic {b64encode(auth).decode()}"
+            url = url.replace(username=None, password=None)
+        response = self.xom.http.post(
+            url.url,
+            content=xmlrpc.client.dumps(params, method).encode(),
+            extra_headers=headers)
+        if response.status_code != 200 or isinstance(response, FatalResponse):
+            raise self.UpstreamError(
+                f"{response.status_code} status on {method} {url.url!r}")
+        try:
+            ((result,), _method) = xmlrpc.client.loads(response.text)
+        except (ExpatError, ValueError, xmlrpc.client.Error) as e:
+            raise self.UpstreamError(
+                f"invalid response for {method} from {url.url!r}: {e}") from e
+        return result
+
+    def update_from_changelog(self) -> list[NormalizedName]:
+        """ expire the cached simplelinks of projects which changed upstream
+        since the last call, according to the changelog at
+        ``mirror_changelog_url``.
+
+        Returns the list of expired projects.
+        """
+        changelog = self.cache_changelog
+        if changelog.serial is None:
+            # start following the changelog from now on
+            changelog.serial = int(self._changelog_call("changelog_last_serial"))
+            return []
+        changes = self._changelog_call("changelog_since_serial", changelog.serial)
+        serial = changelog.serial
+        project2serial: dict[NormalizedName, int] = {}
+        for name, _version, _timestamp, action, change_serial in changes:
+            project = normalize_name(name)
+            project2serial[project] = max(
+                project2serial.get(project, -1), change_serial)
+            serial = max(serial, change_serial)
+            if action == "create" and self.cache_projectnames.exists():
+                self.cache_projectnames.add(name)
+        expired = []
+        retrieve_times = self.cache_retrieve_times
+        for project, change_serial in project2serial.items():
+            (is_expired, links, cache_serial, etag) = self._load_cache_links(project)
+            if links is None:
+                # a cached not found
+                if retrieve_times.get_timestamp(project) > 0:
+                    retrieve_times.expire(project)
+                    expired.append(project)
+                continue
+            if cache_serial >= change_serial:
+                continue
+            retrieve_times.expire(project, etag=retrieve_times.get_etag(project))
+            expired.append(project)
+        changelog.serial = serial
+        return expired
+
+    def refresh_hot_projects(self, num: int, lead_time: float) -> list[NormalizedName]:
+        """ refresh the simplelinks of the ``num`` most requested projects
+        if their cache expires within ``lead_time`` seconds.
+
+        Returns the list of projects for which a refresh was started.
+        """
+        if self.offline:
+            return []
+        cache_expiry = self.cache_expiry
+        projects = self.cache_project_access.most_common(
+            num, half_life=cache_expiry)
+        refresh_after = max(cache_expiry - lead_time, 0)
+        now = time.time()
+        result = []
+        for project in projects:
+            ts = self.cache_retrieve_times.get_timestamp(project)
+            if ts < 0 or (now - ts) < refresh_after:
+                continue
+            if self.refresh_simplelinks_perstage(project):
+                result.append(project)
+        return result
+
     def get_simplelinks_perstage(self, project: NormalizedName | str) -> SimpleLinks:  # noqa: PLR0911, PLR0912
         """ return all releaselinks from the index, returning cached entries
         if we have a recent enough request stored locally.
@@ -988,6 +1311,8 @@ class MirrorStage(BaseStage):
         exist.
         """
         project = normalize_name(project)
+        if self.xom.config.mirror_refresh_hot_projects:
+            self.cache_project_access.hit(project)
         lock = self.cache_retrieve_times.acquire(project, self.timeout)
         if lock is not None:
             self.keyfs.tx.on_finished(lock.release)
@@ -1014,20 +1339,17 @@ class MirrorStage(BaseStage):
             return self.SimpleLinks(links, stale=True)
 
         if links is None:
-            is_retrieval_expired = self.cache_retrieve_times.is_expired(
-                project, self.cache_expiry)
-            if not is_retrieval_expired:
+            if self.cache_retrieve_times.is_not_found(project):
                 raise self.UpstreamNotFoundError(
                     "cached not found for project %s" % project)
-            else:
-                exists = self.has_project_perstage(project)
-                if exists is unknown and self.no_project_list:
-                    pass
-                elif not exists:
-                    # immediately cache the not found with no ETag
-                    self.cache_retrieve_times.refresh(project, None)
-                    raise self.UpstreamNotFoundError(
-                        "project %s not found" % project)
+            exists = self.has_project_perstage(project)
+            if exists is unknown and self.no_project_list:
+                pass
+            elif not exists:
+                self.cache_retrieve_times.set_not_found(
+                    project, self.not_found_expiry)
+                raise self.UpstreamNotFoundError(
+                    "project %s not found" % project)
 
         newlinks_future = cast("NewLinksFuture", self.xom.create_future())
         # we need to set this up here, as these access the database and
@@ -1068,19 +1390,27 @@ class MirrorStage(BaseStage):
             self.cache_retrieve_times.expire(project, etag=None)
             return self.get_simplelinks_perstage(project)
         except (self.UpstreamNotFoundError, self.UpstreamError) as e:
+            is_not_found = isinstance(e, self.UpstreamNotFoundError)
             # if we have an old result, return it. While this will
             # miss the rare event of actual project deletions it allows
             # to stay resilient against server misconfigurations.
             if links is not None:
+                if is_not_found:
+                    # don't ask again until the links expire
+                    self.cache_retrieve_times.refresh(project, None)
                 threadlog.warn(
                     "serving stale links, because of exception %s",
                     lazy_format_exception(e))
                 return self.SimpleLinks(links, stale=True)
+            if is_not_found:
+                self.cache_retrieve_times.set_not_found(
+                    project, self.not_found_expiry)
             raise
 
         info = newlinks_future.result()
 
-        newlinks = join_links_data(info.key_hrefs, info.requires_python, info.yanked)
+        newlinks = join_links_data(
+            info.key_hrefs, info.requires_python, info.yanked, info.core_metadata)
         if links is not None and set(links) == set(newlinks):
             # no changes
             self.cache_retrieve_times.refresh(project, info.etag)
@@ -1169,10 +1499,191 @@ def devpiserver_get_stage_customizer_classes():
         ("mirror", MirrorCustomizer)]
 
 
+SIZE_SUFFIXES = dict(K=1 << 10, M=1 << 20, G=1 << 30, T=1 << 40)
+
+
+def parse_size(value: int | str) -> int:
+    """ Parse a size in bytes with an optional K, M, G or T suffix. """
+    if isinstance(value, int):
+        size = value
+    else:
+        value = value.strip().upper().removesuffix("B").removesuffix("I")
+        factor = SIZE_SUFFIXES.get(value[-1:], 1)
+        if factor != 1:
+            value = value[:-1]
+        size = int(float(value) * factor)
+    if size < 0:
+        msg = f"negative size {value!r}"
+        raise ValueError(msg)
+    return size
+
+
+def http_date_to_timestamp(value: str | None) -> float:
+    if not value:
+        return 0.0
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class ProjectNames(Mapping[NormalizedName, str]):
+    """ Immutable mapping of normalized project names to the names as
+    given by the mirror.
+
+    The normalized names are stored sorted in one bytes object with an
+    array of offsets, the original names only where they differ. For the
+    hundreds of thousands of names on PyPI this needs a fraction of the
+    memory of a dict. Lookups use binary search. Changes are kept in a
+    small overlay which is merged once it gets too big."""
+
+    MAX_OVERLAY = 1000
+
+    _changes: dict[str, str | None]
+    _keys: bytes
+    _key_offsets: array[int]
+    _len: int
+    _names: bytes
+    _name_offsets: array[int]
+
+    def __init__(self, names: Iterable[str] = ()) -> None:
+        self._set_base(
+            sorted({normalize_name(x): x for x in names}.items()))
+
+    def _set_base(self, items: Sequence[tuple[str, str]]) -> None:
+        keys = bytearray()
+        key_offsets = array("L", [0])
+        names = bytearray()
+        name_offsets = array("L", [0])
+        for key, name in items:
+            keys += key.encode()
+            key_offsets.append(len(keys))
+            if name != key:
+                names += name.encode()
+            name_offsets.append(len(names))
+        self._changes = {}
+        self._keys = bytes(keys)
+        self._key_offsets = key_offsets
+        self._len = len(items)
+        self._names = bytes(names)
+        self._name_offsets = name_offsets
+
+    def _key_at(self, index: int) -> bytes:
+        offsets = self._key_offsets
+        return self._keys[offsets[index]:offsets[index + 1]]
+
+    def _name_at(self, index: int) -> str:
+        offsets = self._name_offsets
+        (start, end) = (offsets[index], offsets[index + 1])
+        if start == end:
+            return self._key_at(index).decode()
+        return self._names[start:end].decode()
+
+    def _bisect(self, key: bytes) -> int:
+        (lo, hi) = (0, len(self._key_offsets) - 1)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _base_get(self, key: str) -> str | None:
+        _key = key.encode()
+        index = self._bisect(_key)
+        if index < len(self._key_offsets) - 1 and self._key_at(index) == _key:
+            return self._name_at(index)
+        return None
+
+    def _iter_items(self, start: str = "") -> Iterator[tuple[str, str]]:
+        """ Yield the sorted items with keys greater or equal to start. """
+        changes = self._changes
+        added = sorted(
+            (k, v) for k, v in changes.items() if v is not None and k >= start)
+        pos = 0
+        for index in range(self._bisect(start.encode()), len(self._key_offsets) - 1):
+            key = self._key_at(index).decode()
+            while pos < len(added) and added[pos][0] < key:
+                yield added[pos]
+                pos += 1
+            if key in changes:
+                continue
+            yield (key, self._name_at(index))
+        yield from added[pos:]
+
+    def __contains__(self, key: object) -> bool:
+        if not isinstance(key, str):
+            return False
+        if key in self._changes:
+            return self._changes[key] is not None
+        return self._base_get(key) is not None
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, ProjectNames):
+            return super().__eq__(other)
+        if not self._changes and not other._changes:
+            return (
+                self._keys == other._keys
+                and self._key_offsets == other._key_offsets
+                and self._names == other._names
+                and self._name_offsets == other._name_offsets)
+        return len(self) == len(other) and all(
+            a == b for a, b in zip(self._iter_items(), other._iter_items()))
+
+    def __getitem__(self, key: str) -> str:
+        if key in self._changes:
+            result = self._changes[key]
+        else:
+            result = self._base_get(key)
+        if result is None:
+            raise KeyError(key)
+        return result
+
+    def __iter__(self) -> Iterator[NormalizedName]:
+        for key, _name in self._iter_items():
+            yield cast("NormalizedName", key)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} with {self._len} names>"
+
+    def iter_prefix(self, prefix: str) -> Iterator[NormalizedName]:
+        """ Yield the sorted normalized names starting with prefix. """
+        for key, _name in self._iter_items(prefix):
+            if not key.startswith(prefix):
+                break
+            yield cast("NormalizedName", key)
+
+    def _with_change(self, key: str, name: str | None) -> ProjectNames:
+        if self._changes.get(key, self._base_get(key)) == name:
+            return self
+        result = copy.copy(self)
+        result._changes = dict(self._changes)
+        if name == self._base_get(key):
+            del result._changes[key]
+        else:
+            result._changes[key] = name
+        result._len = self._len + (key in result) - (key in self)
+        if len(result._changes) > self.MAX_OVERLAY:
+            result._set_base(list(result._iter_items()))
+        return result
+
+    def with_name(self, project: NormalizedName | str) -> ProjectNames:
+        """ Return a copy with the project added. """
+        return self._with_change(normalize_name(project), project)
+
+    def without_name(self, project: NormalizedName | str) -> ProjectNames:
+        """ Return a copy with the project removed. """
+        return self._with_change(normalize_name(project), None)
+
+
 class ProjectNamesCache:
     """ Helper class for maintaining project names from a mirror. """
 
-    _data: dict[NormalizedName, str]
+    _data: ProjectNames
     _etag: str | None
     _lock: threading.RLock
     _timestamp: float
@@ -1180,7 +1691,7 @@ class ProjectNamesCache:
     def __init__(self) -> None:
         self._lock = threading.RLock()
         self._timestamp = -1
-        self._data = dict()
+        self._data = ProjectNames()
         self._etag = None
 
     def exists(self) -> bool:
@@ -1195,7 +1706,7 @@ class ProjectNamesCache:
         with self._lock:
             return (time.time() - self._timestamp) >= expiry_time
 
-    def get(self) -> dict[NormalizedName, str]:
+    def get(self) -> ProjectNames:
         return self._data
 
     def get_etag(self) -> str | None:
@@ -1204,27 +1715,212 @@ class ProjectNamesCache:
     def add(self, project: NormalizedName | str) -> None:
         """ Add project to cache. """
         with self._lock:
-            self._data[normalize_name(project)] = project
+            self._data = self._data.with_name(project)
 
     def discard(self, project: NormalizedName | str) -> None:
         """ Remove project from cache. """
         with self._lock:
-            del self._data[normalize_name(project)]
+            self._data = self._data.without_name(project)
 
-    def set(self, data: dict[NormalizedName, str], etag: str) -> None:
+    def set(self, data: ProjectNames, etag: str | None) -> None:
         """ Set data and update timestamp. """
         with self._lock:
             if data != self._data:
-                assert isinstance(data, dict)
+                assert isinstance(data, ProjectNames)
                 self._data = data
             self.mark_current(etag)
 
-    def mark_current(self, etag: str) -> None:
+    def mark_current(self, etag: str | None) -> None:
         with self._lock:
             self._timestamp = time.time()
             self._etag = etag
 
 
+class FileAccessTimes:
+    """ Last access times of files by relpath. """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._times: dict[str, float] = {}
+
+    def discard(self, relpath: str) -> None:
+        with self._lock:
+            self._times.pop(relpath, None)
+
+    def get(self, relpath: str, default: float) -> float:
+        return self._times.get(relpath, default)
+
+    def touch(self, relpath: str) -> None:
+        with self._lock:
+            self._times[relpath] = time.time()
+
+
+class ProjectAccessCounts:
+    """ Counts requests per project to find the most requested ones.
+
+    The counts are halved regularly, so recent requests weigh more."""
+
+    _counts: Counter[NormalizedName]
+
+    def __init__(self) -> None:
+        self._counts = Counter()
+        self._decayed_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def hit(self, project: NormalizedName) -> None:
+        with self._lock:
+            self._counts[project] += 1
+
+    def most_common(self, num: int, half_life: float) -> list[NormalizedName]:
+        with self._lock:
+            result = [x for x, count in self._counts.most_common(num)]
+            now = time.monotonic()
+            if (now - self._decayed_at) >= half_life:
+                self._decayed_at = now
+                self._counts = Counter({
+                    project: count // 2
+                    for project, count in self._counts.items()
+                    if count > 1})
+        return result
+
+
+class MirrorChangelog:
+    """ State of following the upstream changelog of a mirror. """
+
+    __slots__ = ("serial",)
+
+    serial: int | None
+
+    def __init__(self) -> None:
+        self.serial = None
+
+
+class MirrorCacheEvictionThread:
+    """ Deletes the least recently used files of mirror indexes which
+    exceed their 'mirror_cache_quota'."""
+    thread: mythread.MyThread
+
+    def __init__(self, xom: XOM) -> None:
+        self.xom = xom
+        self.interval = xom.config.mirror_cache_eviction_interval
+
+    def tick(self) -> None:
+        keyfs = self.xom.keyfs
+        with keyfs.read_transaction():
+            quotas = [
+                (stage.name, stage.cache_quota)
+                for user in self.xom.model.get_userlist()
+                for stage in user.getstages()
+                if isinstance(stage, MirrorStage) and stage.cache_quota]
+        for stagename, quota in quotas:
+            with keyfs.read_transaction():
+                stage = self.xom.model.getstage(stagename)
+                if stage is None:
+                    continue
+                candidates = stage.get_eviction_candidates(quota)
+            if not candidates:
+                continue
+            with keyfs.write_transaction():
+                stage = self.xom.model.getstage(stagename)
+                if stage is None:
+                    continue
+                count = stage.evict_cached_files(x[0] for x in candidates)
+            threadlog.info(
+                "evicted %s files with %s bytes from %s",
+                count, sum(x[1] for x in candidates), stagename)
+
+    def thread_run(self) -> None:
+        thread_push_log("[EVICT]")
+        while 1:
+            try:
+                self.tick()
+            except mythread.Shutdown:
+                raise
+            except Exception:  # noqa: BLE001
+                threadlog.exception("Unhandled exception in mirror cache eviction thread.")
+            self.thread.sleep(self.interval)
+
+
+class MirrorChangelogThread:
+    """ Regularly checks the upstream changelog of mirror indexes with
+    ``mirror_changelog_url`` set and expires the cache of changed projects."""
+    thread: mythread.MyThread
+
+    def __init__(self, xom: XOM) -> None:
+        self.xom = xom
+        self.interval = xom.config.mirror_changelog_interval
+
+    def tick(self) -> None:
+        with self.xom.keyfs.read_transaction():
+            for user in self.xom.model.get_userlist():
+                for stage in user.getstages():
+                    if not isinstance(stage, MirrorStage):
+                        continue
+                    if not stage.mirror_changelog_url or stage.offline:
+                        continue
+                    try:
+                        projects = stage.update_from_changelog()
+                    except stage.UpstreamError as e:
+                        threadlog.warn(
+                            "checking changelog of %s failed: %s",
+                            stage.name, lazy_format_exception(e))
+                        continue
+                    if projects:
+                        threadlog.info(
+                            "expired %s changed projects in %s",
+                            len(projects), stage.name)
+
+    def thread_run(self) -> None:
+        thread_push_log("[CHLOG]")
+        while 1:
+            try:
+                self.tick()
+            except mythread.Shutdown:
+                raise
+            except Exception:  # noqa: BLE001
+                threadlog.exception("Unhandled exception in mirror changelog thread.")
+            self.thread.sleep(self.interval)
+
+
+class HotProjectsRefreshThread:
+    """ Refreshes the simplelinks of the most requested projects of all
+    mirror indexes in the background shortly before their cache expires,
+    so requests don't have to wait for upstream."""
+    CHECK_INTERVAL = 10
+    thread: mythread.MyThread
+
+    def __init__(self, xom: XOM) -> None:
+        self.xom = xom
+        self.num_projects = xom.config.mirror_refresh_hot_projects
+
+    def tick(self) -> None:
+        # refresh early enough, so the next check isn't too late
+        lead_time = 3 * self.CHECK_INTERVAL
+        with self.xom.keyfs.read_transaction():
+            for user in self.xom.model.get_userlist():
+                for stage in user.getstages():
+                    if not isinstance(stage, MirrorStage):
+                        continue
+                    projects = stage.refresh_hot_projects(
+                        self.num_projects,
+                        max(lead_time, stage.cache_expiry / 10))
+                    if projects:
+                        threadlog.debug(
+                            "refreshing simplelinks of %s in %s",
+                            ", ".join(projects), stage.name)
+
+    def thread_run(self) -> None:
+        thread_push_log("[HOT]")
+        while 1:
+            try:
+                self.tick()
+            except mythread.Shutdown:
+                raise
+            except Exception:  # noqa: BLE001
+                threadlog.exception("Unhandled exception in hot projects refresh thread.")
+            self.thread.sleep(self.CHECK_INTERVAL)
+
+
 class ProjectUpdateInnerLock:
     # this is the object which is stored in the cache
     # it is needed to add the is_from_current_thread method
@@ -1281,14 +1977,31 @@ class ProjectUpdateLock:
 
 
 class ProjectUpdateCache:
-    """ Helper class to manage when we last updated something project specific. """
+    """ Helper class to manage when we last updated something project specific.
+
+    Projects which were not found upstream are kept separately in a
+    size limited cache with their own expiry time."""
 
     _project2lock: weakref.WeakValueDictionary[str, ProjectUpdateInnerLock]
     _project2time: dict[str, tuple[float, str | None]]
+    not_found_cache: ExpiringLRUCache | None
 
-    def __init__(self):
+    def __init__(self, not_found_size: int = 10000) -> None:
         self._project2time = {}
         self._project2lock = weakref.WeakValueDictionary()
+        self.not_found_cache = (
+            ExpiringLRUCache(not_found_size) if not_found_size > 0 else None)
+
+    def is_not_found(self, project: NormalizedName) -> bool:
+        if self.not_found_cache is None:
+            return False
+        return self.not_found_cache.get(str(project)) is not None
+
+    def set_not_found(self, project: NormalizedName, expiry_time: float) -> None:
+        _project = str(project)
+        self._project2time.pop(_project, None)
+        if self.not_found_cache is not None:
+            self.not_found_cache.put(_project, time.time(), timeout=expiry_time)
 
     def is_expired(self, project: NormalizedName, expiry_time: float) -> bool:
         _project = str(project)
@@ -1305,14 +2018,22 @@ class ProjectUpdateCache:
     def get_timestamp(self, project: NormalizedName) -> float:
         _project = str(project)
         (ts, _etag) = self._project2time.get(_project, (-1, None))
+        if ts == -1 and self.not_found_cache is not None:
+            # look at the data directly to not skew the statistics
+            (_pos, ts, _expires) = self.not_found_cache.data.get(
+                _project, (None, -1, None))
         return ts
 
     def refresh(self, project: NormalizedName, etag: str | None) -> None:
         _project = str(project)
         self._project2time[_project] = (time.time(), etag)
+        if self.not_found_cache is not None:
+            self.not_found_cache.invalidate(_project)
 
     def expire(self, project: NormalizedName, etag: str | None = None) -> None:
         _project = str(project)
+        if self.not_found_cache is not None:
+            self.not_found_cache.invalidate(_project)
         if etag is None:
             self._project2time.pop(_project, None)
         else:
@@ -1339,3 +2060,24 @@ class ProjectUpdateCache:
         lock = self._project2lock.pop(_project, None)
         if lock is not None and lock.locked():
             lock.release()
+
+
+@hookimpl
+def devpiserver_metrics(request):
+    xom = request.registry["xom"]
+    evictions = hits = items = lookups = misses = 0
+    for cache in xom.iter_singletons("project_retrieve_times"):
+        not_found_cache = cache.not_found_cache
+        if not_found_cache is None:
+            continue
+        evictions += not_found_cache.evictions
+        hits += not_found_cache.hits
+        items += len(not_found_cache.data)
+        lookups += not_found_cache.lookups
+        misses += not_found_cache.misses
+    return [
+        ("devpi_server_mirror_not_found_cache_evictions", "counter", evictions),
+        ("devpi_server_mirror_not_found_cache_hits", "counter", hits),
+        ("devpi_server_mirror_not_found_cache_items", "gauge", items),
+        ("devpi_server_mirror_not_found_cache_lookups", "counter", lookups),
+        ("devpi_server_mirror_not_found_cache_misses", "counter", misses)]
@@ -7,6 +7,8 @@ from .config import hookimpl
 from .filestore import Digests
 from .filestore import FileEntry
 from .filestore import get_hash_spec
+from .filestore import get_hashes
+from .filestore import get_seekable_content_or_file
 from .log import threadlog
 from .markers import unknown
 from .normalized import normalize_name
@@ -20,6 +22,7 @@ from devpi_common.types import parse_hash_spec
 from devpi_common.url import URL
 from devpi_common.validation import validate_metadata
 from functools import total_ordering
+from io import BytesIO
 from itertools import zip_longest
 from operator import iconcat
 from pathlib import Path
@@ -35,10 +38,12 @@ import getpass
 import json
 import re
 import warnings
+import zipfile
 
 
 if TYPE_CHECKING:
     from .filestore import FileStore
+    from .interfaces import ContentOrFile
     from .keyfs import KeyFS
     from .keyfs_types import PTypedKey
     from .keyfs_types import TypedKey
@@ -54,7 +59,9 @@ if TYPE_CHECKING:
     RequiresPythonList = list[RequiresPython]
     Yanked = Union[Literal[True], str, None]
     YankedList = list[Yanked]
-    JoinedLink = tuple[str, str, RequiresPython, Yanked]
+    CoreMetadata = Union[Literal[True], str, None]
+    CoreMetadataList = list[CoreMetadata]
+    JoinedLink = tuple[str, str, RequiresPython, Yanked, CoreMetadata]
     JoinedLinkList = list[JoinedLink]
 
 
@@ -62,24 +69,45 @@ notset = object()
 
 
 class Rel(StrEnum):
+    CoreMetadata = "coremetadata"
     DocZip = "doczip"
     ReleaseFile = "releasefile"
     ToxResult = "toxresult"
 
 
 def join_links_data(
-    links: LinksList, requires_python: RequiresPythonList, yanked: YankedList
+    links: LinksList,
+    requires_python: RequiresPythonList,
+    yanked: YankedList,
+    core_metadata: CoreMetadataList = (),  # type: ignore[assignment]
 ) -> JoinedLinkList:
-    # build list of (key, href, require_python, yanked) tuples
+    # build list of (key, href, require_python, yanked, core_metadata) tuples
     result = []
-    for link, require_python, link_yanked in zip_longest(
-        links, requires_python, yanked, fillvalue=None
+    for link, require_python, link_yanked, link_core_metadata in zip_longest(
+        links, requires_python, yanked, core_metadata, fillvalue=None
     ):
         assert link is not None
-        result.append((*link, require_python, link_yanked))
+        result.append((*link, require_python, link_yanked, link_core_metadata))
     return result
 
 
+def get_wheel_metadata(content_or_file: ContentOrFile) -> bytes | None:
+    """ Return the METADATA file of a wheel or None if there is none. """
+    content_or_file = get_seekable_content_or_file(content_or_file)
+    if isinstance(content_or_file, bytes):
+        content_or_file = BytesIO(content_or_file)
+    try:
+        with zipfile.ZipFile(content_or_file) as zf:
+            names = [
+                x for x in zf.namelist()
+                if x.count("/") == 1 and x.endswith(".dist-info/METADATA")]
+            if len(names) != 1:
+                return None
+            return zf.read(names[0])
+    except (zipfile.BadZipFile, OSError):
+        return None
+
+
 def apply_filter_iter(items, filter_iter):
     for item in items:
         if next(filter_iter, True):
@@ -1522,13 +1550,15 @@ class PrivateStage(BaseStage):
         links = cast("LinksList", data.get("links", []))
         requires_python = cast("RequiresPythonList", data.get("requires_python", []))
         yanked: YankedList = []  # PEP 592 isn't supported for private stages yet
+        core_metadata = cast("CoreMetadataList", data.get("core_metadata", []))
         return self.SimpleLinks(
-            join_links_data(links, requires_python, yanked))
+            join_links_data(links, requires_python, yanked, core_metadata))
 
     def _regen_simplelinks(self, project_input):
         project = normalize_name(project_input)
         links: list = []
         requires_python = []
+        core_metadata = []
         for version in self.list_versions_perstage(project):
             linkstore = self.get_linkstore_perstage(project, version)
             releases = linkstore.get_links(Rel.ReleaseFile)
@@ -1536,7 +1566,15 @@ class PrivateStage(BaseStage):
             require_python = self.get_versiondata_perstage(project,
                     version).get('requires_python')
             requires_python.extend([require_python] * len(releases))
+            for release in releases:
+                metadata_links = linkstore.get_links(
+                    rel=Rel.CoreMetadata, for_entrypath=release)
+                core_metadata.append(
+                    metadata_links[0].best_available_hash_spec
+                    if metadata_links else None)
         data_dict = {u"links":links, u"requires_python":requires_python}
+        if any(core_metadata):
+            data_dict["core_metadata"] = core_metadata
         self.key_projsimplelinks(project).set(data_dict)
 
     def list_projects_perstage(self):
@@ -1568,6 +1606,17 @@ class PrivateStage(BaseStage):
             hashes=hashes,
             last_modified=last_modified,
         )
+        if filename.endswith(".whl"):
+            # serve the core metadata separately (PEP 658)
+            with link.entry.file_open_read() as f:
+                metadata = get_wheel_metadata(f)
+            if metadata is not None:
+                linkstore.new_reflink(
+                    rel=Rel.CoreMetadata,
+                    content_or_file=metadata,
+                    for_entrypath=link,
+                    filename=f"{filename}.metadata",
+                    hashes=get_hashes(metadata))
         self._regen_simplelinks(project)
         return link
 
@@ -1998,13 +2047,14 @@ class SimplelinkMeta:
         "__path",
         "__url",
         "__version",
+        "core_metadata",
         "href",
         "key",
         "require_python",
         "yanked",
     )
 
-    def __init__(self, link_info: tuple[str, str, RequiresPython, Yanked]) -> None:
+    def __init__(self, link_info: JoinedLink) -> None:
         self.__basename = notset
         self.__cmpval = notset
         self.__ext = notset
@@ -2014,7 +2064,8 @@ class SimplelinkMeta:
         self.__path = notset
         self.__url = notset
         self.__version = notset
-        (self.key, self.href, self.require_python, self.yanked) = link_info
+        (self.key, self.href, self.require_python, self.yanked, *rest) = link_info
+        self.core_metadata = rest[0] if rest else None
 
     def __hash__(self):
         return hash(
@@ -2032,6 +2083,7 @@ class SimplelinkMeta:
                 self.key,
                 self.require_python,
                 self.yanked,
+                self.core_metadata,
             )
         )
 
@@ -2132,7 +2184,8 @@ class SimplelinkMeta:
             f"key={self.key!r} "
             f"href={self.href!r} "
             f"require_python={self.require_python!r} "
-            f"yanked={self.yanked!r}>")
+            f"yanked={self.yanked!r} "
+            f"core_metadata={self.core_metadata!r}>")
 
 
 def make_key_and_href(entry):
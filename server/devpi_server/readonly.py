@@ -334,3 +334,184 @@ def is_deeply_readonly(val: Any) -> bool:
 def is_sequence(val: Any) -> bool:
     """ Return True if the value is a readonly or normal sequence (list, tuple)"""
     return isinstance(val, (SeqViewReadonly, list, tuple))
+
+
+def _is_deeply_immutable(val: Any) -> bool:
+    if isinstance(val, tuple):
+        return all(_is_deeply_immutable(x) for x in val)
+    return isinstance(val, _immutable)
+
+
+def _copy_on_write(data: Any) -> Any:
+    # data is the unwrapped data of a readonly view, which is never modified
+    if isinstance(data, dict):
+        return CopyOnWriteDict(data)
+    if isinstance(data, list):
+        return [
+            x if _is_deeply_immutable(x) else _copy_on_write(x)
+            for x in data]
+    if isinstance(data, tuple):
+        if _is_deeply_immutable(data):
+            return data
+        return tuple(_copy_on_write(x) for x in data)
+    if isinstance(data, set):
+        return set(data)
+    return get_mutable_deepcopy(data)
+
+
+class CopyOnWriteDict(dict):
+    """ A mutable copy of the data of a readonly view.
+
+    Only the top level is copied, nested mutable values are shared with
+    the readonly data until they are accessed. Any method which returns
+    nested values copies them first, so the shared data is never exposed.
+    """
+    __slots__ = ("_shared",)
+
+    def __init__(self, data: dict) -> None:
+        dict.__init__(self, data)
+        self._shared = {
+            key for key, val in data.items()
+            if not _is_deeply_immutable(val)}
+
+    def _unshare(self, key: Hashable) -> None:
+        if key in self._shared:
+            self._shared.discard(key)
+            dict.__setitem__(
+                self, key, _copy_on_write(dict.__getitem__(self, key)))
+
+    def _unshare_all(self) -> None:
+        for key in list(self._shared):
+            self._unshare(key)
+
+    def __getitem__(self, key: Hashable) -> Any:
+        self._unshare(key)
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key: Hashable, val: Any) -> None:
+        self._shared.discard(key)
+        dict.__setitem__(self, key, val)
+
+    def __delitem__(self, key: Hashable) -> None:
+        self._shared.discard(key)
+        dict.__delitem__(self, key)
+
+    def __iter__(self) -> Iterator:
+        # overridden so copying with dict(...) or {**...} uses __getitem__
+        return dict.__iter__(self)
+
+    def __or__(self, other: Any) -> dict:
+        result = self.copy()
+        result.update(other)
+        return result
+
+    def __ror__(self, other: Any) -> dict:
+        result = dict(other)
+        result.update(self)
+        return result
+
+    def __ior__(self, other: Any) -> CopyOnWriteDict:
+        self.update(other)
+        return self
+
+    def __reduce__(self) -> Any:
+        return (dict, (dict(self),))
+
+    def clear(self) -> None:
+        self._shared.clear()
+        dict.clear(self)
+
+    def copy(self) -> dict:
+        self._unshare_all()
+        return dict(dict.items(self))
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        if key in self:
+            return self[key]
+        return default
+
+    def items(self) -> Any:
+        self._unshare_all()
+        return dict.items(self)
+
+    def pop(self, key: Hashable, *args: Any) -> Any:
+        self._unshare(key)
+        self._shared.discard(key)
+        return dict.pop(self, key, *args)
+
+    def popitem(self) -> tuple[Hashable, Any]:
+        self._unshare_all()
+        return dict.popitem(self)
+
+    def setdefault(self, key: Hashable, default: Any = None) -> Any:
+        self._unshare(key)
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args: Any, **kw: Any) -> None:
+        for key, val in dict(*args, **kw).items():
+            self[key] = val
+
+    def values(self) -> Any:
+        self._unshare_all()
+        return dict.values(self)
+
+
+@singledispatch
+def get_mutable_copy_on_write(val: Any) -> Any:
+    """ return a mutable copy of ``val`` like ``get_mutable_deepcopy``.
+    For readonly views dictionaries are only copied when accessed,
+    so modifying one part of a big value doesn't copy all of it."""
+    return get_mutable_deepcopy(val)
+
+
+@get_mutable_copy_on_write.register
+def _(val: ReadonlyView) -> object:
+    return _copy_on_write(val._data)
+
+
+@get_mutable_copy_on_write.register
+def _(val: CopyOnWriteDict) -> CopyOnWriteDict:
+    result = CopyOnWriteDict({})
+    for key, item in dict.items(val):
+        if key in val._shared:
+            dict.__setitem__(result, key, item)
+            result._shared.add(key)
+        else:
+            dict.__setitem__(result, key, get_mutable_copy_on_write(item))
+    return result
+
+
+@get_mutable_deepcopy.register
+def _(val: CopyOnWriteDict) -> dict:
+    return {k: get_mutable_deepcopy(v) for k, v in dict.items(val)}
+
+
+@singledispatch
+def get_detached_copy(val: Any) -> Any:
+    """ return a copy of ``val`` which shares no data with it which
+    might still be modified. Unlike ``get_mutable_deepcopy`` the nested
+    values a ``CopyOnWriteDict`` still shares with readonly data are
+    kept, so the result must not be modified."""
+    return get_mutable_deepcopy(val)
+
+
+@get_detached_copy.register
+def _(val: CopyOnWriteDict) -> dict:
+    return {
+        k: v if k in val._shared else get_detached_copy(v)
+        for k, v in dict.items(val)}
+
+
+@get_detached_copy.register
+def _(val: list) -> list:
+    return [get_detached_copy(item) for item in val]
+
+
+@get_detached_copy.register
+def _(val: tuple) -> tuple:
+    return tuple(get_detached_copy(item) for item in val)
+
+
+@get_detached_copy.register
+def _(val: dict) -> dict:
+    return {k: get_detached_copy(v) for k, v in val.items()}
@@ -5,11 +5,17 @@ from .config import hookimpl
 from .exceptions import format_exception_only
 from .exceptions import lazy_format_exception
 from .filestore import ChecksumError
+from .filestore import Digests
 from .filestore import FileEntry
+from .filestore import RunningHashes
 from .fileutil import buffered_iterator
+from .fileutil import decompress_entry
+from .fileutil import LoadError
 from .fileutil import dumps
 from .fileutil import load
 from .fileutil import loads
+from .fileutil import loads_entry
+from .fileutil import rename
 from .httpclient import FatalResponse
 from .log import thread_push_log
 from .log import threadlog
@@ -21,19 +27,25 @@ from .normalized import normalize_name
 from .views import FileStreamer
 from .views import H_MASTER_UUID
 from .views import H_PRIMARY_UUID
+from concurrent.futures import ThreadPoolExecutor
+from devpi_common.metadata import parse_version
 from devpi_common.types import cached_property
 from devpi_common.url import URL
+from functools import partial
 from pluggy import HookimplMarker
 from pyramid.httpexceptions import HTTPAccepted
 from pyramid.httpexceptions import HTTPBadRequest
 from pyramid.httpexceptions import HTTPForbidden
 from pyramid.httpexceptions import HTTPNotFound
+from pyramid.httpexceptions import HTTPServiceUnavailable
+from pyramid.response import FileIter
 from pyramid.response import Response
 from pyramid.view import view_config
 from repoze.lru import LRUCache
 from typing import TYPE_CHECKING
 from webob.headers import EnvironHeaders
 from webob.headers import ResponseHeaders
+import asyncio
 import contextlib
 import io
 import itsdangerous
@@ -44,14 +56,19 @@ import threading
 import time
 import traceback
 import warnings
+import zlib
 
 
 if TYPE_CHECKING:
+    from .filestore import FileDownload
     from .httpclient import GetResponse
     from .httpclient import HTTPClient
     from .keyfs_types import KeyFSTypesRO
     from .keyfs_types import TypedKey
     from .main import XOM
+    from .model import SimplelinkMeta
+    from collections.abc import Iterable
+    from contextlib import AsyncExitStack
     from contextlib import ExitStack
 
 
@@ -71,27 +88,44 @@ REPLICA_MULTIPLE_TIMEOUT = REPLICA_REQUEST_TIMEOUT / 2
 REPLICA_AUTH_MAX_AGE = REPLICA_REQUEST_TIMEOUT + 0.1
 REPLICA_CHUNK_SIZE = 65536
 REPLICA_CONTENT_TYPE = "application/x-devpi-replica-changes"
-REPLICA_ACCEPT_STREAMING = f"{REPLICA_CONTENT_TYPE}, application/octet-stream; q=0.9"
+# like REPLICA_CONTENT_TYPE, but the entries are sent as stored, possibly
+# compressed, wrapped in a bytes object
+REPLICA_STORED_CONTENT_TYPE = "application/x-devpi-replica-stored-changes"
+REPLICA_ACCEPT_STREAMING = f"{REPLICA_STORED_CONTENT_TYPE}, {REPLICA_CONTENT_TYPE}, application/octet-stream; q=0.9"
 MAX_REPLICA_CHANGES_SIZE = 5 * 1024 * 1024
+REPLICA_SNAPSHOT_CONTENT_TYPE = "application/x-devpi-replica-snapshot"
+REPLICA_FILES_CONTENT_TYPE = "application/x-devpi-replica-files"
+MAX_REPLICA_FILES_BATCH = 1000
+MAX_REPLICA_FILES_BATCH_FILE_SIZE = 1024 * 1024
+CHANGELOG_SNAPSHOT_FILENAME = ".changelog_snapshot"
 
 
 class IndexType:
     # class for the index type to get correct sort order
-    def __init__(self, index_type: IndexType | str | None) -> None:
+    def __init__(
+        self, index_type: IndexType | str | None, *, boosted: bool = False
+    ) -> None:
         if isinstance(index_type, IndexType):
             index_type = index_type._index_type
         self._index_type: str | None = index_type
+        # files likely requested by clients are boosted to the front
+        self.boosted = boosted
 
     def __hash__(self):
         return hash(self._index_type)
 
     def __repr__(self):
+        if self.boosted:
+            return f"<IndexType {self._index_type!r} boosted>"
         return f"<IndexType {self._index_type!r}>"
 
     def __str__(self):
         return self._index_type
 
     def __lt__(self, other):
+        if self.boosted != other.boosted:
+            # boosted come first regardless of the type
+            return self.boosted
         if self._index_type == other._index_type:
             return False
         if self._index_type is None:
@@ -110,13 +144,21 @@ class IndexType:
         return self._index_type < other._index_type
 
     def __eq__(self, other):
-        return self._index_type == other._index_type
+        return (
+            self._index_type == other._index_type
+            and self.boosted == other.boosted)
 
 
 def get_auth_serializer(config):
     return itsdangerous.TimedSerializer(config.get_replica_secret())
 
 
+def serves_replication(xom):
+    """ Return whether the replication protocol is served by this node. """
+    return xom.is_primary() or (
+        xom.is_replica() and xom.config.serve_replication)
+
+
 def log_replica_token_error(request, msg):
     if getattr(request, '__devpi_replica_token_warned', None) is None:
         request.log.error(msg)
@@ -139,9 +181,11 @@ def devpiserver_get_identity(request, credentials):
         return None
     if H_REPLICA_UUID not in request.headers:
         return None
-    if not request.registry["xom"].is_primary():
+    if not serves_replication(request.registry["xom"]):
         log_replica_token_error(
-            request, "Replica token detected, but role isn't primary.")
+            request,
+            "Replica token detected, but role isn't primary "
+            "and replication isn't served.")
         return None
     auth_serializer = get_auth_serializer(request.registry["xom"].config)
     try:
@@ -191,6 +235,8 @@ class ReadableIterabel(io.RawIOBase):
 class PrimaryChangelogRequest:
     MAX_REPLICA_BLOCK_TIME = MAX_REPLICA_BLOCK_TIME
     MAX_REPLICA_CHANGES_SIZE = MAX_REPLICA_CHANGES_SIZE
+    MAX_REPLICA_FILES_BATCH = MAX_REPLICA_FILES_BATCH
+    MAX_REPLICA_FILES_BATCH_FILE_SIZE = MAX_REPLICA_FILES_BATCH_FILE_SIZE
     REPLICA_MULTIPLE_TIMEOUT = REPLICA_MULTIPLE_TIMEOUT
 
     def __init__(self, request):
@@ -221,13 +267,30 @@ class PrimaryChangelogRequest:
         else:  # just a regular request
             yield
 
+    def get_content_encoding(self):
+        """ Return the content encoding for compressing changelog data
+        or None if the replica doesn't accept a supported one. """
+        if not self.xom.config.replication_compression_level:
+            return None
+        if "Accept-Encoding" not in self.request.headers:
+            # without the header any encoding would be acceptable,
+            # but we only compress when explicitly asked for
+            return None
+        offers = self.request.accept_encoding.acceptable_offers(
+            ["gzip", "deflate"])
+        return offers[0][0] if offers else None
+
     def verify_primary(self):
-        if not self.xom.is_primary():
+        if not serves_replication(self.xom):
             raise HTTPForbidden("Replication protocol disabled")
         expected_uuid = self.request.headers.get(
             H_EXPECTED_PRIMARY_ID,
             self.request.headers.get(H_EXPECTED_MASTER_ID))
         primary_uuid = self.xom.config.get_primary_uuid()
+        if not primary_uuid:
+            # a replica only knows the primary UUID after it
+            # successfully replicated from its own primary
+            raise HTTPServiceUnavailable("Primary UUID not known yet")
         # we require the header but it is allowed to be empty
         # (during initialization)
         if expected_uuid is None:
@@ -269,7 +332,7 @@ class PrimaryChangelogRequest:
             keyfs = self.xom.keyfs
             self._wait_for_serial(serial)
 
-            raw_entry = keyfs.tx.conn.get_raw_changelog_entry(serial)
+            raw_entry = self._get_raw_changelog_entry(keyfs.tx.conn, serial)
 
             devpi_serial = keyfs.get_current_serial()
             return Response(body=raw_entry, status=200, headers={
@@ -279,14 +342,15 @@ class PrimaryChangelogRequest:
     @view_config(route_name="/+changelog/{serial}-")
     def get_multiple_changes(self):
         acceptable = self.request.accept.acceptable_offers(
-            [REPLICA_CONTENT_TYPE, "application/octet-stream"])
-        preferres_streaming = (
-            (REPLICA_CONTENT_TYPE, 1.0) in acceptable
-            and ("application/octet-stream", 1.0) not in acceptable)
-        if preferres_streaming:
+            [REPLICA_STORED_CONTENT_TYPE, REPLICA_CONTENT_TYPE,
+             "application/octet-stream"])
+        if ("application/octet-stream", 1.0) not in acceptable:
             # a replica which accepts streams has a lower priority for
             # "application/octet-stream" as the old default "Accept: */*"
-            return self.get_streaming_changes()
+            if (REPLICA_STORED_CONTENT_TYPE, 1.0) in acceptable:
+                return self.get_streaming_changes(stored=True)
+            if (REPLICA_CONTENT_TYPE, 1.0) in acceptable:
+                return self.get_streaming_changes()
 
         self.verify_primary()
 
@@ -300,7 +364,7 @@ class PrimaryChangelogRequest:
             raw_size = 0
             start_time = time.time()
             for serial in range(start_serial, devpi_serial + 1):
-                raw_entry = keyfs.tx.conn.get_raw_changelog_entry(serial)
+                raw_entry = self._get_raw_changelog_entry(keyfs.tx.conn, serial)
                 raw_size += len(raw_entry)
                 (changes, rel_renames) = loads(raw_entry)
                 all_changes.append((serial, changes))
@@ -312,11 +376,18 @@ class PrimaryChangelogRequest:
                     threadlog.debug('Changelog timeout %s', raw_size)
                     break
             raw_entry = dumps(all_changes)
-            return Response(body=raw_entry, status=200, headers={
+            headers = {
                 "Content-Type": "application/octet-stream",
-                "X-DEVPI-SERIAL": str(devpi_serial)})
-
-    def get_streaming_changes(self):
+                "Vary": "Accept, Accept-Encoding",
+                "X-DEVPI-SERIAL": str(devpi_serial)}
+            if encoding := self.get_content_encoding():
+                raw_entry = b"".join(iter_compressed(
+                    [raw_entry], encoding,
+                    self.xom.config.replication_compression_level))
+                headers["Content-Encoding"] = encoding
+            return Response(body=raw_entry, status=200, headers=headers)
+
+    def get_streaming_changes(self, *, stored=False):
         self.verify_primary()
 
         start_serial = int(self.request.matchdict["serial"])
@@ -324,12 +395,25 @@ class PrimaryChangelogRequest:
         keyfs = self.xom.keyfs
         self._wait_for_serial(start_serial)
         devpi_serial = keyfs.get_current_serial()
+        if start_serial <= devpi_serial:
+            with keyfs.get_connection() as conn:
+                # fail early if the changelog isn't available
+                self._get_raw_changelog_entry(conn, start_serial)
         threadlog.info("Streaming from %s to %s", start_serial, devpi_serial)
 
         def iter_changelog_entries():
             for serial in range(start_serial, devpi_serial + 1):
                 with keyfs.get_connection() as conn:
-                    raw = conn.get_raw_changelog_entry(serial)
+                    if stored:
+                        # send entries as stored to avoid decompressing
+                        # them here, storage plugins without support for
+                        # compression only store uncompressed entries
+                        get_entry = getattr(
+                            conn, "get_stored_changelog_entry",
+                            conn.get_raw_changelog_entry)
+                        raw = dumps(get_entry(serial))
+                    else:
+                        raw = conn.get_raw_changelog_entry(serial)
                 threadlog.debug("Sending serial %s", serial)
                 with self.update_replica_status(serial, streaming=True):
                     yield dumps(serial)
@@ -338,11 +422,105 @@ class PrimaryChangelogRequest:
             with self.update_replica_status(devpi_serial + 1, streaming=False):
                 pass
 
+        app_iter = buffered_iterator(iter_changelog_entries())
+        headers = {
+            "Content-Type": (
+                REPLICA_STORED_CONTENT_TYPE if stored
+                else REPLICA_CONTENT_TYPE),
+            "Vary": "Accept, Accept-Encoding",
+            "X-DEVPI-SERIAL": str(devpi_serial)}
+        if encoding := self.get_content_encoding():
+            # each buffered chunk is flushed, so the replica can decode
+            # and import the entries while the stream is still running
+            app_iter = iter_compressed(
+                app_iter, encoding,
+                self.xom.config.replication_compression_level)
+            headers["Content-Encoding"] = encoding
+        return Response(app_iter=app_iter, status=200, headers=headers)
+
+    @view_config(route_name="/+changelog/+snapshot")
+    def get_snapshot(self):
+        self.verify_primary()
+
+        path = self.xom.config.server_path / CHANGELOG_SNAPSHOT_FILENAME
+        try:
+            f = path.open("rb")
+        except FileNotFoundError:
+            raise HTTPNotFound("no changelog snapshot available")
+        # read the serial from the same file we send, as the snapshot
+        # might be replaced in the meantime
+        serial = _read_changelog_snapshot_serial(f)
+        if serial is None:
+            f.close()
+            raise HTTPNotFound("no changelog snapshot available")
+        f.seek(0)
         return Response(
-            app_iter=buffered_iterator(iter_changelog_entries()),
+            app_iter=FileIter(f, REPLICA_CHUNK_SIZE),
             status=200, headers={
-                "Content-Type": REPLICA_CONTENT_TYPE,
-                "X-DEVPI-SERIAL": str(devpi_serial)})
+                "Content-Type": REPLICA_SNAPSHOT_CONTENT_TYPE,
+                "X-DEVPI-SERIAL": str(serial)})
+
+    @view_config(
+        route_name="/+replica-files", request_method="POST",
+        is_mutating=False)
+    def get_files(self):
+        # returns the content of multiple files in one response for
+        # faster replication of many small files, for each requested
+        # relpath a header (relpath, status, size, hashes) is sent,
+        # followed by size bytes of file content if the status is 200
+        self.verify_primary()
+        if not isinstance(self.request.identity, ReplicaIdentity):
+            raise HTTPForbidden("Only replicas can fetch multiple files.")
+        try:
+            relpaths = loads(self.request.body)
+        except LoadError:
+            raise HTTPBadRequest("Couldn't load list of files.")
+        if not isinstance(relpaths, list) or not all(
+                isinstance(x, str) for x in relpaths):
+            raise HTTPBadRequest("Expected a list of files.")
+        if len(relpaths) > self.MAX_REPLICA_FILES_BATCH:
+            raise HTTPBadRequest(
+                f"Can only send up to {self.MAX_REPLICA_FILES_BATCH} files.")
+
+        keyfs = self.xom.keyfs
+        filestore = self.xom.filestore
+        max_file_size = self.MAX_REPLICA_FILES_BATCH_FILE_SIZE
+
+        def read_file(relpath):
+            # the transaction of the request is already finished
+            # when the response is sent, the content is read in a
+            # new one which isn't kept open while sending it
+            with keyfs.read_transaction():
+                entry = filestore.get_file_entry(relpath)
+                if entry is None or not entry.meta or not entry.file_exists():
+                    return ((relpath, 404, 0, {}), b"")
+                size = entry.file_size()
+                if size > max_file_size:
+                    # the replica has to fetch it on its own
+                    return ((relpath, 413, size, {}), b"")
+                content = entry.file_get_content()
+                return ((relpath, 200, len(content), dict(entry.hashes)), content)
+
+        def iter_files():
+            for relpath in relpaths:
+                (header, content) = read_file(relpath)
+                yield dumps(header)
+                if content:
+                    yield content
+
+        return Response(
+            app_iter=buffered_iterator(iter_files()),
+            status=200, headers={
+                "Content-Type": REPLICA_FILES_CONTENT_TYPE,
+                "X-DEVPI-SERIAL": str(keyfs.get_current_serial())})
+
+    def _get_raw_changelog_entry(self, conn, serial):
+        raw_entry = conn.get_raw_changelog_entry(serial)
+        if raw_entry is None:
+            # replicas started from a changelog snapshot
+            # don't have the changelog before it
+            raise HTTPNotFound(f"changelog entry {serial} not available")
+        return raw_entry
 
     def _wait_for_serial(self, serial):
         keyfs = self.xom.keyfs
@@ -417,11 +595,33 @@ class ReplicaHTTPClient:
         url: URL | str,
         *,
         allow_redirects: bool,
+        content: bytes | None = None,
         timeout: float | None = None,
         extra_headers: dict | None = None,
     ) -> GetResponse:
         extra_headers = self.get_extra_headers(extra_headers)
         return self.http.stream(
+            cstack,
+            method,
+            URL(url).url,
+            allow_redirects=allow_redirects,
+            content=content,
+            timeout=timeout,
+            extra_headers=extra_headers,
+        )
+
+    async def async_stream(
+        self,
+        cstack: AsyncExitStack,
+        method: str,
+        url: URL | str,
+        *,
+        allow_redirects: bool,
+        timeout: float | None = None,
+        extra_headers: dict | None = None,
+    ) -> GetResponse:
+        extra_headers = self.get_extra_headers(extra_headers)
+        return await self.http.async_stream(
             cstack,
             method,
             URL(url).url,
@@ -450,18 +650,34 @@ class ReplicaThread:
         keyfs = self.xom.keyfs
         keyfs.subscribe_on_import(self.shared_data.on_import)
         self.file_replication_threads = []
+        self.async_file_replication_thread = None
         num_threads = xom.config.file_replication_threads
-        self.shared_data.num_threads = num_threads
+        concurrency = xom.config.file_replication_concurrency
+        batch_size = xom.config.file_replication_batch_size
+        self.shared_data.file_batch_size = batch_size
+        # used as the limit when filling the queue initially
+        self.shared_data.num_threads = max(
+            num_threads * max(batch_size, 1), concurrency)
         self.shared_data.skip_indexes = set(xom.config.file_replication_skip_indexes)
-        threadlog.info("Using %s file download threads.", num_threads)
-        for i in range(num_threads):
-            frt = FileReplicationThread(xom, self.shared_data)
-            self.file_replication_threads.append(frt)
-            xom.thread_pool.register(frt)
+        if concurrency:
+            threadlog.info(
+                "Using up to %s concurrent file downloads with %s threads.",
+                concurrency, num_threads)
+            self.async_file_replication_thread = AsyncFileReplicationThread(
+                xom, self.shared_data,
+                concurrency=concurrency, num_threads=num_threads)
+            xom.thread_pool.register(self.async_file_replication_thread)
+        else:
+            threadlog.info("Using %s file download threads.", num_threads)
+            for i in range(num_threads):
+                frt = FileReplicationThread(xom, self.shared_data)
+                self.file_replication_threads.append(frt)
+                xom.thread_pool.register(frt)
         self.initial_queue_thread = InitialQueueThread(xom, self.shared_data)
         xom.thread_pool.register(self.initial_queue_thread)
         self.primary_url = xom.config.primary_url
         self.use_streaming = xom.config.replica_streaming
+        self.use_snapshot = xom.config.replica_snapshot
         self._primary_serial = None
         self._primary_serial_timestamp = None
         self.started_at = None
@@ -676,7 +892,9 @@ class ReplicaThread:
             return False
 
     def handler_multi(self, response):
-        if response.headers.get("content-type", "") == REPLICA_CONTENT_TYPE:
+        content_type = response.headers.get("content-type", "")
+        if content_type in (REPLICA_CONTENT_TYPE, REPLICA_STORED_CONTENT_TYPE):
+            stored = content_type == REPLICA_STORED_CONTENT_TYPE
             with contextlib.closing(response):
                 readableiterable = ReadableIterabel(
                     response.iter_bytes(REPLICA_CHUNK_SIZE)
@@ -687,7 +905,11 @@ class ReplicaThread:
                 try:
                     while True:
                         serial = load(stream)
-                        (changes, rel_renames) = load(stream)
+                        if stored:
+                            (changes, rel_renames) = loads_entry(
+                                decompress_entry(load(stream)))
+                        else:
+                            (changes, rel_renames) = load(stream)
                         self.xom.keyfs.import_changes(serial, changes)
                         self.update_primary_serial(serial, update_sync=False, ignore_lower=True)
                 except StopIteration:
@@ -704,11 +926,41 @@ class ReplicaThread:
         url = self.primary_url.joinpath("+changelog", "%s-" % serial).url
         return self.fetch(self.handler_multi, url)
 
+    def handler_snapshot(self, response):
+        with contextlib.closing(response):
+            stream = io.BufferedReader(
+                ReadableIterabel(iter_decompressed(
+                    response.iter_bytes(REPLICA_CHUNK_SIZE))),
+                buffer_size=REPLICA_CHUNK_SIZE)
+            serial = load(stream)
+            threadlog.info("loading changelog snapshot at serial %s", serial)
+            # the items are written in batches while they are received
+            count = self.xom.keyfs.import_snapshot(
+                serial, iter(partial(load, stream), None))
+        threadlog.info(
+            "imported %s keys from changelog snapshot at serial %s",
+            count, serial)
+        self.update_primary_serial(serial, update_sync=False, ignore_lower=True)
+
+    def fetch_snapshot(self):
+        url = self.primary_url.joinpath("+changelog", "+snapshot").url
+        return self.fetch(self.handler_snapshot, url)
+
     def tick(self):
         self.thread.exit_if_shutdown()
         serial = self.xom.keyfs.get_next_serial()
+        if serial == 0 and self.use_snapshot:
+            # only tried once, if there is no snapshot or it fails,
+            # the whole changelog is replayed
+            self.use_snapshot = False
+            self.fetch_snapshot()
+            serial = self.xom.keyfs.get_next_serial()
         result = self.fetch_multi(serial)
         if not result:
+            if serial == 0 and self.xom.config.replica_snapshot:
+                # the upstream might be a replica which was bootstrapped
+                # from a snapshot itself, so try again until it has one
+                self.use_snapshot = True
             # we got an error, let's wait a bit
             self.thread.sleep(5.0)
         else:
@@ -742,6 +994,113 @@ class ReplicaThread:
         self.shared_data.wait(error_queue=error_queue)
 
 
+def iter_compressed(iterable, encoding, level):
+    """ Compress the chunks of iterable with zlib for the given HTTP
+    content encoding ("gzip" or "deflate"), flushing after each chunk."""
+    wbits = 31 if encoding == "gzip" else 15
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    for chunk in iterable:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def iter_decompressed(iterable):
+    decompressor = zlib.decompressobj()
+    for chunk in iterable:
+        # empty chunks would signal the end of data to ReadableIterabel
+        if data := decompressor.decompress(chunk):
+            yield data
+    if data := decompressor.flush():
+        yield data
+
+
+def iter_snapshot_items(tx):
+    """ Yield ``(relpath, keyname, value)`` of all existing keys
+    at the serial of the transaction."""
+    # a single scan over all keys, the values are resolved at the serial
+    for info in tx.iter_relpaths_with_prefix(""):
+        yield (info.relpath, info.keyname, info.value)
+
+
+def write_changelog_snapshot(keyfs, path):
+    """ Write a zlib compressed stream of the serial, followed by an item
+    for each existing key and ``None`` as end marker to path. """
+    tmp_path = path.with_name(f"{path.name}-tmp")
+    with keyfs.read_transaction() as tx:
+        compressor = zlib.compressobj()
+        with tmp_path.open("wb") as f:
+            f.write(compressor.compress(dumps(tx.at_serial)))
+            for item in iter_snapshot_items(tx):
+                f.write(compressor.compress(dumps(item)))
+            f.write(compressor.compress(dumps(None)))
+            f.write(compressor.flush())
+        rename(str(tmp_path), str(path))
+        return tx.at_serial
+
+
+def read_changelog_snapshot_serial(path):
+    try:
+        with path.open("rb") as f:
+            return _read_changelog_snapshot_serial(f)
+    except FileNotFoundError:
+        return None
+
+
+def _read_changelog_snapshot_serial(f):
+    stream = io.BufferedReader(ReadableIterabel(
+        iter_decompressed(iter(lambda: f.read(REPLICA_CHUNK_SIZE), b""))))
+    try:
+        return load(stream)
+    except (EOFError, zlib.error):
+        return None
+
+
+class ChangelogSnapshotThread:
+    """ Regularly writes a snapshot of the current state on the primary
+    or a replica serving the replication protocol, which new replicas can
+    use instead of replaying the whole changelog."""
+    CHECK_INTERVAL = 60
+    thread: mythread.MyThread
+
+    def __init__(self, xom: XOM) -> None:
+        self.xom = xom
+        self.interval = xom.config.changelog_snapshot_interval
+        self.path = xom.config.server_path / CHANGELOG_SNAPSHOT_FILENAME
+        self.snapshot_serial = None
+
+    def tick(self):
+        if self.snapshot_serial is None:
+            self.snapshot_serial = read_changelog_snapshot_serial(self.path)
+            if self.snapshot_serial is None:
+                self.snapshot_serial = -1
+        serial = self.xom.keyfs.get_current_serial()
+        if serial < 0:
+            return
+        if self.snapshot_serial < 0 and self.xom.is_replica():
+            # a replica bootstrapped from a snapshot has no changelog
+            # before it, so downstream replicas need a snapshot right away
+            due = True
+        else:
+            due = bool(self.interval) and (
+                serial - self.snapshot_serial >= self.interval)
+        if due:
+            with threadlog.around(
+                    "info", "writing changelog snapshot at serial %s", serial):
+                self.snapshot_serial = write_changelog_snapshot(
+                    self.xom.keyfs, self.path)
+
+    def thread_run(self):
+        thread_push_log("[SNAP]")
+        while 1:
+            try:
+                self.tick()
+            except mythread.Shutdown:
+                raise
+            except Exception:  # noqa: BLE001
+                threadlog.exception("Unhandled exception in changelog snapshot thread.")
+            self.thread.sleep(self.CHECK_INTERVAL)
+
+
 def register_key_subscribers(xom):
     xom.keyfs.PROJSIMPLELINKS.on_key_change(SimpleLinksChanged(xom))
 
@@ -751,8 +1110,11 @@ class FileReplicationSharedData:
     ERROR_QUEUE_DELAY_MULTIPLIER = 1.5
     ERROR_QUEUE_REPORT_DELAY = 2 * 60
     ERROR_QUEUE_MAX_DELAY = 60 * 60
+    boosted: set[str]
+    boosted_count: int
     files_in_sync_at: float | None
     init_queue_finished_at: float | None
+    file_batch_size: int
     initial_processed: int | None
     last_added: float | None
     last_errored: float | None
@@ -783,7 +1145,12 @@ class FileReplicationSharedData:
         self.last_added = None
         self.last_errored = None
         self.last_processed = None
+        self.file_batch_size = 0
         self.skip_indexes = set()
+        # relpaths queued in front because clients requested them
+        self.boosted = set()
+        self.boosted_count = 0
+        self._boosted_lock = threading.Lock()
 
     def on_import(self, serial, changes):
         keyfs = self.xom.keyfs
@@ -808,16 +1175,7 @@ class FileReplicationSharedData:
                 "Skipping %s because %r in %s.", key, index_name, skip_indexes
             )
             return
-        try:
-            index_type = self.get_index_type_for(key)
-        except KeyError:
-            stage = self.xom.model.getstage(index_name)
-            if stage is None:
-                # deleted stage
-                self.set_index_type_for(index_name, None)
-            else:
-                self.set_index_type_for(stage.name, stage.ixconfig['type'])
-            index_type = self.get_index_type_for(key)
+        index_type = self.lookup_index_type_for(key)
         if index_type != IndexType(None) and str(index_type) in skip_indexes:
             threadlog.debug(
                 "Skipping %s because %r in %s.", key, index_type, skip_indexes
@@ -840,6 +1198,74 @@ class FileReplicationSharedData:
             index_type, -serial, key.relpath, key.name, val, back_serial))
         self.last_added = time.time()
 
+    def boost(self, key: TypedKey) -> bool:
+        """ Queue the file for ``key`` in front of all other files.
+
+        Used for files clients are about to request, so they are fetched
+        next instead of after everything queued before them. The regular
+        queue entry stays where it is and is skipped once the file exists.
+        Must be called within a transaction. Returns whether it was queued."""
+        relpath = key.relpath
+        if self.init_queue_finished_at is not None and self.queue.empty():
+            # nothing is pending, so the file is either there or in flight
+            return False
+        skip_indexes = self.skip_indexes
+        if "all" in skip_indexes or self.get_index_name_for(key) in skip_indexes:
+            return False
+        if relpath in self.boosted or relpath in self.xom.filestore.downloads:
+            return False
+        tx = self.xom.keyfs.tx
+        try:
+            (serial, back_serial, val) = tx.conn.get_relpath_at(
+                relpath, tx.at_serial)
+        except KeyError:
+            return False
+        if val is None:
+            return False
+        entry = FileEntry(key, val)
+        if not entry.last_modified or entry.file_exists():
+            return False
+        index_type = self.lookup_index_type_for(key)
+        if index_type != IndexType(None) and str(index_type) in skip_indexes:
+            return False
+        with self._boosted_lock:
+            if relpath in self.boosted:
+                return False
+            self.boosted.add(relpath)
+            self.boosted_count += 1
+        threadlog.debug("Boosting %s in file replication queue.", relpath)
+        # note the negated serial for the PriorityQueue
+        self.queue.put((
+            IndexType(index_type, boosted=True), -serial,
+            relpath, key.name, val, back_serial))
+        self.last_added = time.time()
+        return True
+
+    def boost_links(self, links: Iterable[SimplelinkMeta]) -> int:
+        """ Boost the files of the latest version listed on a simple page,
+        as those are the ones installers are most likely to request next.
+
+        Returns the number of queued files."""
+        latest: dict[str, list[SimplelinkMeta]] = {}
+        for link in links:
+            try:
+                version = link.version
+            except ValueError:
+                continue
+            if link.yanked or not version:
+                continue
+            latest.setdefault(version, []).append(link)
+        if not latest:
+            return 0
+        version = max(latest, key=parse_version)
+        filestore = self.xom.filestore
+        count = 0
+        for link in latest[version]:
+            key = filestore.get_key_from_relpath(link.path.lstrip("/"))
+            if key is not None and self.boost(key):
+                count += 1
+        return count
+
     def update_index_types(self, keyfs, serial, key, val, back_serial):
         if val is None:
             val = {}
@@ -888,13 +1314,30 @@ class FileReplicationSharedData:
             return IndexType(default)
         return result
 
+    def lookup_index_type_for(self, key: TypedKey) -> IndexType:
+        try:
+            return self.get_index_type_for(key)
+        except KeyError:
+            index_name = self.get_index_name_for(key)
+            stage = self.xom.model.getstage(index_name)
+            if stage is None:
+                # deleted stage
+                self.set_index_type_for(index_name, None)
+            else:
+                self.set_index_type_for(stage.name, stage.ixconfig['type'])
+            return self.get_index_type_for(key)
+
     def set_index_type_for(self, stagename, index_type):
         self.index_types.put(stagename, IndexType(index_type))
 
     def is_in_future(self, ts):
         return ts > time.time()
 
-    def process_next_errored(self, handler):
+    def get_next_errored(self):
+        """ Return the next errored item which is due for a retry or None.
+
+        For a returned item ``error_queue.task_done`` has to be called
+        after processing it."""
         try:
             # it seems like without the timeout this isn't triggered frequent
             # enough, the thread was waiting a long time even though there
@@ -903,24 +1346,40 @@ class FileReplicationSharedData:
         except self.Empty:
             if self.queue.empty() and self.init_queue_finished_at is not None:
                 self.files_in_sync_at = time.time()
-            return
+            return None
         (ts, delay, index_type, serial, key, keyname, value, back_serial) = info
-        try:
-            if self.is_in_future(ts):
-                # not current yet, so re-add it
+        if self.is_in_future(ts):
+            # not current yet, so re-add it
+            try:
                 self.add_errored(
                     index_type, serial, key, keyname, value, back_serial,
                     ts=ts, delay=delay)
-                return
+            finally:
+                self.error_queue.task_done()
+                self.last_processed = time.time()
+            return None
+        return info
+
+    def retry_errored(self, info):
+        """ Re-add an errored item which failed again with longer delay. """
+        (_ts, delay, index_type, serial, key, keyname, value, back_serial) = info
+        self.add_errored(
+            index_type, serial, key, keyname, value, back_serial,
+            delay=delay * self.ERROR_QUEUE_DELAY_MULTIPLIER)
+        if delay > self.ERROR_QUEUE_REPORT_DELAY:
+            threadlog.exception(
+                "There repeatedly has been an error during file download.")
+
+    def process_next_errored(self, handler):
+        info = self.get_next_errored()
+        if info is None:
+            return
+        (_ts, _delay, index_type, serial, key, keyname, value, back_serial) = info
+        try:
             handler(index_type, serial, key, keyname, value, back_serial)
-        except Exception:
+        except Exception:  # noqa: BLE001
             # another failure, re-add with longer delay
-            self.add_errored(
-                index_type, serial, key, keyname, value, back_serial,
-                delay=delay * self.ERROR_QUEUE_DELAY_MULTIPLIER)
-            if delay > self.ERROR_QUEUE_REPORT_DELAY:
-                threadlog.exception(
-                    "There repeatedly has been an error during file download.")
+            self.retry_errored(info)
         finally:
             self.error_queue.task_done()
             self.last_processed = time.time()
@@ -934,19 +1393,66 @@ class FileReplicationSharedData:
         except self.Empty:
             # when the regular queue is empty, we retry previously errored ones
             return self.process_next_errored(handler)
+        try:
+            self._process(handler, *self._unpack(info))
+        finally:
+            self.queue.task_done()
+            self.last_processed = time.time()
+
+    def process_next_batch(self, size, handler, batch_fetcher):
+        """ Like process_next, but for up to ``size`` items at once.
+
+        The ``batch_fetcher`` is called with all items first, so it can
+        fetch the files in one go. Afterwards each item is processed
+        with the ``handler`` as usual, which then finds the file already
+        stored or fetches it on its own."""
+        try:
+            items = [self.queue.get(timeout=self.QUEUE_TIMEOUT)]
+        except self.Empty:
+            # when the regular queue is empty, we retry previously errored ones
+            return self.process_next_errored(handler)
+        while len(items) < size:
+            try:
+                items.append(self.queue.get_nowait())
+            except self.Empty:
+                break
+        try:
+            infos = [self._unpack(x) for x in items]
+            try:
+                batch_fetcher(infos)
+            except Exception as e:
+                threadlog.warn(
+                    "Error during batch file replication: %s",
+                    lazy_format_exception(e))
+            for info in infos:
+                self._process(handler, *info)
+        finally:
+            for _item in items:
+                self.queue.task_done()
+            self.last_processed = time.time()
+
+    def _unpack(self, info):
         (index_type, serial, key, keyname, value, back_serial) = info
+        if index_type.boosted:
+            with self._boosted_lock:
+                self.boosted.discard(key)
+            # the boost only matters for the order in the queue
+            index_type = IndexType(index_type)
         # negate again, because it was negated for the PriorityQueue
-        serial = -serial
+        return (index_type, -serial, key, keyname, value, back_serial)
+
+    def _process(self, handler, index_type, serial, key, keyname, value, back_serial):
         try:
             handler(index_type, serial, key, keyname, value, back_serial)
+        except FileDownloadRunning:
+            threadlog.info(
+                "file is downloaded by a client, checking later: %s", key)
+            self.add_errored(index_type, serial, key, keyname, value, back_serial)
         except Exception as e:
             threadlog.warn(
                 "Error during file replication for %s: %s",
                 key, lazy_format_exception(e))
             self.add_errored(index_type, serial, key, keyname, value, back_serial)
-        finally:
-            self.queue.task_done()
-            self.last_processed = time.time()
 
     def wait(self, error_queue=False):
         self.queue.join()
@@ -978,6 +1484,11 @@ def devpiserver_metrics(request):
                 "gauge",
                 shared_data.error_queue.qsize(),
             ),
+            (
+                "devpi_server_replica_file_download_boosted",
+                "counter",
+                shared_data.boosted_count,
+            ),
             (
                 "devpi_server_replica_deleted_cache_evictions",
                 "counter",
@@ -1037,12 +1548,30 @@ def devpiserver_metrics(request):
             ),
         ]
     )
+    async_frt = replica_thread.async_file_replication_thread
+    if async_frt is not None:
+        result.extend(
+            [
+                (
+                    "devpi_server_replica_file_download_concurrency_limit",
+                    "gauge",
+                    async_frt.concurrency.limit,
+                ),
+                (
+                    "devpi_server_replica_file_download_running",
+                    "gauge",
+                    async_frt.running,
+                ),
+            ]
+        )
     return result
 
 
 def includeme(config):
     config.add_route("/+changelog/{serial}", r"/+changelog/{serial:\d+}")
     config.add_route("/+changelog/{serial}-", r"/+changelog/{serial:\d+}-")
+    config.add_route("/+changelog/+snapshot", "/+changelog/+snapshot")
+    config.add_route("/+replica-files", "/+replica-files")
     config.scan("devpi_server.replica")
 
 
@@ -1135,7 +1664,10 @@ class FileReplicationThread:
             f.devpi_srcpath = path  # type: ignore[attr-defined]
         return (f, entry.hashes)
 
-    def importer(self, serial, key, val, back_serial):  # noqa: PLR0911, PLR0912
+    def prepare_import(self, serial, key, val, back_serial):
+        """ Handle everything not requiring a download from the primary.
+
+        Returns the entry if the file needs to be downloaded."""
         threadlog.debug("FileReplicationThread.importer for %s, %s", key, val)
         keyfs = self.xom.keyfs
         relpath = key.relpath
@@ -1148,35 +1680,109 @@ class FileReplicationThread:
                         threadlog.info("mark for deletion: %s", relpath)
                         entry.file_delete()
                 self.shared_data.errors.remove(entry)
-                return
+                return None
         if entry.last_modified is None:
             # there is no remote file
             self.shared_data.errors.remove(entry)
-            return
+            return None
         with keyfs.filestore_transaction():
             if entry.file_exists():
                 # we already have a file
                 self.shared_data.errors.remove(entry)
-                return
+                return None
 
         (f, hashes) = self.find_pre_existing_file(entry)
         if f is not None:
             # we found a matching existing file
-            with keyfs.filestore_transaction():
-                entry.file_set_content_no_meta(f, hashes=hashes)
-                # on Windows we need to close the file
-                # before the transaction closes
-                f.close()
+            self.store_file(entry, f, hashes)
+            return None
+        return entry
+
+    def start_download(self, entry) -> FileDownload | None:
+        """ Register the download of the file, so client requests wait
+        for it instead of fetching the file separately.
+
+        Raises FileDownloadRunning if a client request already fetches
+        the file. Instead of waiting for that request, the item is put
+        into the error queue and finds the stored file on retry."""
+        (download, started) = self.xom.filestore.downloads.start(entry.relpath)
+        if not started:
+            raise FileDownloadRunning(entry.relpath)
+        return download
+
+    def check_response(self, serial, entry, r):
+        """ Return whether the response contains the file content.
+
+        Raises FileReplicationError if it should be retried later."""
+        relpath = entry.relpath
+        if r.status_code == 302:
+            # mirrors might redirect to external file when
+            # mirror_use_external_urls is set
+            threadlog.info(
+                "ignoring because of redirection to external URL: %s", relpath
+            )
             self.shared_data.errors.remove(entry)
-            return
-        del f, hashes
+            return False
+        if r.status_code == 410:
+            # primary indicates Gone for files which were later deleted
+            threadlog.info("ignoring because of later deletion: %s", relpath)
+            self.shared_data.errors.remove(entry)
+            return False
 
-        threadlog.info(
-            "retrieving file from primary for serial %s: %s", serial, relpath)
+        if r.status_code in (404, 502):
+            stagename = "/".join(relpath.split("/")[:2])
+            with self.xom.keyfs.read_transaction(at_serial=serial):
+                stage = self.xom.model.getstage(stagename)
+            if stage.ixconfig["type"] == "mirror":
+                threadlog.warn(
+                    "ignoring file which couldn't be retrieved from mirror index '%s': %s",
+                    stagename,
+                    relpath,
+                )
+                self.shared_data.errors.remove(entry)
+                return False
+
+        if r.status_code != 200:
+            threadlog.error(
+                "error downloading '%s' from primary, will be retried later: %s",
+                relpath,
+                r.reason_phrase,
+            )
+            # add the error for the UI
+            self.shared_data.errors.add(
+                dict(url=r.url, message=r.reason_phrase, relpath=entry.relpath)
+            )
+            # and raise for retrying later
+            raise FileReplicationError(r, relpath)
+        return True
+
+    def new_file(self, entry):
+        with self.xom.keyfs.filestore_transaction():
+            # get a new file, but close the transaction again
+            return entry.file_new_open()
+
+    def store_file(self, entry, f, hashes):
+        # in case there were errors before, we can now remove them
+        self.shared_data.errors.remove(entry)
+        with self.xom.keyfs.filestore_transaction():
+            entry.file_set_content_no_meta(f, hashes=hashes)
+            # on Windows we need to close the file
+            # before the transaction closes
+            f.close()
+
+    def importer(self, serial, key, val, back_serial):
+        entry = self.prepare_import(serial, key, val, back_serial)
+        if entry is None:
+            return
+        relpath = entry.relpath
         url = self.xom.config.primary_url.joinpath(relpath).url
-        # we perform the request with a special header so that
-        # the primary can avoid getting "volatile" links
         with contextlib.ExitStack() as cstack:
+            download = self.start_download(entry)
+            cstack.callback(self.xom.filestore.downloads.finish, download)
+            threadlog.info(
+                "retrieving file from primary for serial %s: %s", serial, relpath)
+            # we perform the request with a special header so that
+            # the primary can avoid getting "volatile" links
             try:
                 r = self.http.stream(
                     cstack,
@@ -1192,60 +1798,22 @@ class FileReplicationThread:
                     dict(url=url, message=msg, relpath=entry.relpath)
                 )
                 raise
-            if r.status_code == 302:
-                r.close()
-                # mirrors might redirect to external file when
-                # mirror_use_external_urls is set
-                threadlog.info(
-                    "ignoring because of redirection to external URL: %s", relpath
-                )
-                self.shared_data.errors.remove(entry)
-                return
-            if r.status_code == 410:
-                # primary indicates Gone for files which were later deleted
-                r.close()
-                threadlog.info("ignoring because of later deletion: %s", relpath)
-                self.shared_data.errors.remove(entry)
-                return
-
-            if r.status_code in (404, 502):
-                r.close()
-                stagename = "/".join(relpath.split("/")[:2])
-                with self.xom.keyfs.read_transaction(at_serial=serial):
-                    stage = self.xom.model.getstage(stagename)
-                if stage.ixconfig["type"] == "mirror":
-                    threadlog.warn(
-                        "ignoring file which couldn't be retrieved from mirror index '%s': %s",
-                        stagename,
-                        relpath,
-                    )
-                    self.shared_data.errors.remove(entry)
+            try:
+                if not self.check_response(serial, entry, r):
                     return
+            finally:
+                if r.status_code != 200:
+                    r.close()
 
-            if r.status_code != 200:
-                r.close()
-                threadlog.error(
-                    "error downloading '%s' from primary, will be retried later: %s",
-                    relpath,
-                    r.reason_phrase,
-                )
-                # add the error for the UI
-                self.shared_data.errors.add(
-                    dict(url=r.url, message=r.reason_phrase, relpath=entry.relpath)
-                )
-                # and raise for retrying later
-                raise FileReplicationError(r, relpath)
-
-            with keyfs.filestore_transaction():
-                # get a new file, but close the transaction again
-                f = cstack.enter_context(entry.file_new_open())
+            f = cstack.enter_context(self.new_file(entry))
 
-            file_streamer = FileStreamer(f, entry, r)
+            file_streamer = FileStreamer(
+                f, entry, r, chunk_size=self.xom.config.download_chunk_size)
 
             try:
                 for _chunk in file_streamer:
                     # we only need the data to be written to the file
-                    pass
+                    download.progress()
             except Exception as err:
                 if isinstance(err, ChecksumError):
                     threadlog.error(
@@ -1259,27 +1827,97 @@ class FileReplicationThread:
                 )
                 raise
 
-            # in case there were errors before, we can now remove them
-            self.shared_data.errors.remove(entry)
-            with keyfs.filestore_transaction():
-                entry.file_set_content_no_meta(f, hashes=file_streamer.hashes)
-                # on Windows we need to close the file
-                # before the transaction closes
-                f.close()
-
-    def handler(self, index_type, serial, key, keyname, value, back_serial):
-        keyfs = self.xom.keyfs
+            self.store_file(entry, f, file_streamer.hashes)
+
+    def fetch_batch(self, infos):
+        """ Fetch the files for multiple queue items with one request.
+
+        Files which aren't sent by the primary or are already being
+        downloaded are left to the regular handler."""
+        downloads = self.xom.filestore.downloads
+        entries = {}
+        for (_index_type, serial, key, keyname, value, back_serial) in infos:
+            if value is None:
+                continue
+            typedkey = self.get_key_to_import(serial, key, keyname, value)
+            if typedkey is None:
+                continue
+            entry = self.prepare_import(serial, typedkey, value, back_serial)
+            if entry is not None and entry.relpath not in downloads:
+                entries[entry.relpath] = entry
+        if not entries:
+            return
+        threadlog.info("retrieving %s files from primary", len(entries))
+        url = self.xom.config.primary_url.joinpath("+replica-files").url
+        with contextlib.ExitStack() as cstack:
+            r = self.http.stream(
+                cstack,
+                "POST",
+                url,
+                allow_redirects=False,
+                content=dumps(list(entries)),
+                extra_headers={
+                    "Accept": REPLICA_FILES_CONTENT_TYPE,
+                    "Content-Type": REPLICA_FILES_CONTENT_TYPE},
+                timeout=self.xom.config.args.request_timeout,
+            )
+            if r.status_code in (404, 405):
+                threadlog.warn(
+                    "The primary doesn't support fetching multiple files "
+                    "at once, fetching files one by one.")
+                self.shared_data.file_batch_size = 0
+                return
+            if r.status_code != 200:
+                raise FileReplicationError(r, url)
+            stream = io.BufferedReader(
+                ReadableIterabel(iter(r.iter_bytes(REPLICA_CHUNK_SIZE))),
+                buffer_size=REPLICA_CHUNK_SIZE)
+            for _i in range(len(entries)):
+                (relpath, status, size, hashes) = load(stream)
+                entry = entries[relpath]
+                if status != 200:
+                    continue
+                with self.new_file(entry) as f:
+                    running_hashes = RunningHashes(
+                        entry.best_available_hash_type,
+                        *entry.default_hash_types)
+                    running_hashes.start()
+                    remaining = size
+                    while remaining:
+                        data = stream.read(min(remaining, REPLICA_CHUNK_SIZE))
+                        if not data:
+                            msg = f"{relpath}: got incomplete file data from {url}"
+                            raise ValueError(msg)
+                        remaining -= len(data)
+                        for rh in running_hashes:
+                            rh.update(data)
+                        f.write(data)
+                    digests = running_hashes.digests
+                    expected = entry.hashes or Digests(hashes)
+                    err = (
+                        digests.exception_for(expected, relpath)
+                        if expected else None)
+                    if err is not None:
+                        # the regular handler will retry it
+                        threadlog.error("%s", err)
+                        continue
+                    self.store_file(entry, f, digests)
+
+    def get_key_to_import(self, serial, key, keyname, value):
+        """ Return the typed key or None if a later deletion is known. """
         if value is None:
             self.shared_data.deleted.put(key, serial)
         else:
             deleted_serial = self.shared_data.deleted.get(key)
             if deleted_serial is not None:
                 if serial <= deleted_serial:
-                    return
+                    return None
                 else:
                     self.shared_data.deleted.invalidate(key)
-        typedkey = keyfs.get_key_instance(keyname, key)
-        self.importer(serial, typedkey, value, back_serial)
+        return self.xom.keyfs.get_key_instance(keyname, key)
+
+    def on_replicated(self, index_type, serial, typedkey, value, back_serial):
+        keyfs = self.xom.keyfs
         entry = self.xom.filestore.get_file_entry_from_key(typedkey, meta=value)
         if not entry.project or not entry.version:
             return
@@ -1303,9 +1941,21 @@ class FileReplicationThread:
                     serial=serial, back_serial=back_serial,
                     is_from_mirror=index_type == IndexType("mirror"))
 
+    def handler(self, index_type, serial, key, keyname, value, back_serial):
+        typedkey = self.get_key_to_import(serial, key, keyname, value)
+        if typedkey is None:
+            return
+        self.importer(serial, typedkey, value, back_serial)
+        self.on_replicated(index_type, serial, typedkey, value, back_serial)
+
     def tick(self):
         self.thread.exit_if_shutdown()
-        self.shared_data.process_next(self.handler)
+        batch_size = self.shared_data.file_batch_size
+        if batch_size > 1:
+            self.shared_data.process_next_batch(
+                batch_size, self.handler, self.fetch_batch)
+        else:
+            self.shared_data.process_next(self.handler)
 
     def thread_run(self):
         thread_push_log("[FREP]")
@@ -1319,6 +1969,273 @@ class FileReplicationThread:
                 self.thread.sleep(1.0)
 
 
+class AdaptiveConcurrency:
+    """ Limit for the number of concurrent file downloads.
+
+    The limit is increased additively as long as the time until the
+    response headers arrive stays close to the lowest observed latency
+    and decreased multiplicatively when it grows or errors occur."""
+
+    DECREASE_FACTOR = 0.75
+    ERROR_FACTOR = 0.5
+    LATENCY_TOLERANCE = 2.0
+    # weight of a new sample for the moving average of the latency
+    LATENCY_WEIGHT = 0.2
+    # how fast the base latency follows higher latencies, so a lasting
+    # change of the network conditions doesn't throttle forever
+    BASE_LATENCY_DRIFT = 0.01
+    base_latency: float | None
+    latency: float | None
+
+    def __init__(self, minimum: int, maximum: int) -> None:
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self._limit = float(self.minimum)
+        self.base_latency = None
+        self.latency = None
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def _set_limit(self, limit: float) -> None:
+        self._limit = min(max(limit, self.minimum), self.maximum)
+
+    def on_error(self) -> None:
+        self._set_limit(self._limit * self.ERROR_FACTOR)
+
+    def on_latency(self, latency: float) -> None:
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.LATENCY_WEIGHT * (latency - self.latency)
+        if self.base_latency is None or latency < self.base_latency:
+            self.base_latency = latency
+        else:
+            self.base_latency += self.BASE_LATENCY_DRIFT * (
+                latency - self.base_latency)
+        if self.latency > self.LATENCY_TOLERANCE * self.base_latency:
+            self._set_limit(self._limit * self.DECREASE_FACTOR)
+        else:
+            self._set_limit(self._limit + 1)
+
+
+class AsyncFileReplicationThread:
+    """ Replicates files with many concurrent downloads.
+
+    Items are taken from the queue in the same order as with the
+    FileReplicationThread and the downloads are run on the asyncio loop
+    thread. Everything else, like database access and storing the
+    files, is done in a pool of ``num_threads`` threads."""
+
+    thread: mythread.MyThread
+
+    def __init__(
+        self,
+        xom: XOM,
+        shared_data: FileReplicationSharedData,
+        *,
+        concurrency: int,
+        num_threads: int,
+    ) -> None:
+        self.xom = xom
+        self.shared_data = shared_data
+        self.frt = FileReplicationThread(xom, shared_data)
+        self.concurrency = AdaptiveConcurrency(
+            min(num_threads, concurrency), concurrency)
+        self.num_threads = max(1, num_threads)
+        self.executor = None
+        self.running = 0
+        self._running_cv = threading.Condition()
+
+    async def run_in_executor(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def write_chunk(self, f, running_hashes, data):
+        for rh in running_hashes:
+            rh.update(data)
+        f.write(data)
+
+    async def download(self, serial, entry, cstack, file_download=None):
+        """ Return the file and hashes for the entry or None if there is
+        nothing to store.
+
+        Progress is reported to the registered ``file_download``."""
+        frt = self.frt
+        relpath = entry.relpath
+        url = self.xom.config.primary_url.joinpath(relpath).url
+        started = time.monotonic()
+        try:
+            # we perform the request with a special header so that
+            # the primary can avoid getting "volatile" links
+            r = await frt.http.async_stream(
+                cstack,
+                "GET",
+                url,
+                allow_redirects=False,
+                extra_headers={H_REPLICA_FILEREPL: "YES"},
+                timeout=self.xom.config.args.request_timeout,
+            )
+        except Exception as err:
+            msg = f"error on connection: {format_exception_only(err)}"
+            self.shared_data.errors.add(
+                dict(url=url, message=msg, relpath=entry.relpath)
+            )
+            raise
+        if not await self.run_in_executor(frt.check_response, serial, entry, r):
+            return None
+        self.concurrency.on_latency(time.monotonic() - started)
+        f = cstack.enter_context(
+            await self.run_in_executor(frt.new_file, entry))
+        running_hashes = RunningHashes(
+            entry.best_available_hash_type, *entry.default_hash_types)
+        running_hashes.start()
+        content_size = r.headers.get("content-length")
+        filesize = 0
+        try:
+            async for data in r.aiter_raw(self.xom.config.download_chunk_size):
+                filesize += len(data)
+                # hashing and writing can take a while for big chunks
+                await self.run_in_executor(
+                    self.write_chunk, f, running_hashes, data)
+                if file_download is not None:
+                    file_download.progress()
+            hashes = running_hashes.digests
+            if content_size and int(content_size) != filesize:
+                msg = (
+                    f"{relpath}: got {filesize} bytes of {r.url!r} "
+                    f"from remote, expected {content_size}")
+                raise ValueError(msg)
+            if entry.hashes:
+                err = hashes.exception_for(entry.hashes, relpath)
+                if err is not None:
+                    raise err
+        except Exception as err:
+            if isinstance(err, ChecksumError):
+                threadlog.error(
+                    "checksum mismatch for '%s', will be retried later: %s",
+                    relpath,
+                    r.reason_phrase,
+                )
+            msg = f"error while downloading: {format_exception_only(err)}"
+            self.shared_data.errors.add(
+                dict(url=r.url, message=msg, relpath=entry.relpath)
+            )
+            raise
+        return (f, hashes)
+
+    async def importer(self, serial, key, val, back_serial):
+        frt = self.frt
+        entry = await self.run_in_executor(
+            frt.prepare_import, serial, key, val, back_serial)
+        if entry is None:
+            return
+        async with contextlib.AsyncExitStack() as cstack:
+            # registering doesn't block, so it can run on the loop
+            file_download = frt.start_download(entry)
+            cstack.callback(self.xom.filestore.downloads.finish, file_download)
+            threadlog.info(
+                "retrieving file from primary for serial %s: %s",
+                serial, entry.relpath)
+            result = await self.download(serial, entry, cstack, file_download)
+            if result is None:
+                return
+            (f, hashes) = result
+            await self.run_in_executor(frt.store_file, entry, f, hashes)
+
+    async def handler(self, index_type, serial, key, keyname, value, back_serial):
+        typedkey = self.frt.get_key_to_import(serial, key, keyname, value)
+        if typedkey is None:
+            return
+        await self.importer(serial, typedkey, value, back_serial)
+        await self.run_in_executor(
+            self.frt.on_replicated,
+            index_type, serial, typedkey, value, back_serial)
+
+    async def process(self, info):
+        (index_type, serial, key, keyname, value, back_serial) = (
+            self.shared_data._unpack(info))
+        try:
+            await self.handler(
+                index_type, serial, key, keyname, value, back_serial)
+        except FileDownloadRunning:
+            threadlog.info(
+                "file is downloaded by a client, checking later: %s", key)
+            self.shared_data.add_errored(
+                index_type, serial, key, keyname, value, back_serial)
+        except Exception as e:
+            self.concurrency.on_error()
+            threadlog.warn(
+                "Error during file replication for %s: %s",
+                key, lazy_format_exception(e))
+            self.shared_data.add_errored(
+                index_type, serial, key, keyname, value, back_serial)
+        finally:
+            self.shared_data.queue.task_done()
+            self.finished()
+
+    async def process_errored(self, info):
+        (_ts, _delay, index_type, serial, key, keyname, value, back_serial) = info
+        try:
+            await self.handler(
+                index_type, serial, key, keyname, value, back_serial)
+        except FileDownloadRunning:
+            self.shared_data.retry_errored(info)
+        except Exception:  # noqa: BLE001
+            self.concurrency.on_error()
+            # another failure, re-add with longer delay
+            self.shared_data.retry_errored(info)
+        finally:
+            self.shared_data.error_queue.task_done()
+            self.finished()
+
+    def finished(self):
+        self.shared_data.last_processed = time.time()
+        with self._running_cv:
+            self.running -= 1
+            self._running_cv.notify()
+
+    def tick(self):
+        self.thread.exit_if_shutdown()
+        with self._running_cv:
+            while self.running >= self.concurrency.limit:
+                self._running_cv.wait(self.shared_data.QUEUE_TIMEOUT)
+                self.thread.exit_if_shutdown()
+        try:
+            info = self.shared_data.queue.get(
+                timeout=self.shared_data.QUEUE_TIMEOUT)
+        except self.shared_data.Empty:
+            # when the regular queue is empty, we retry previously errored ones
+            errored_info = self.shared_data.get_next_errored()
+            if errored_info is None:
+                return
+            coro = self.process_errored(errored_info)
+        else:
+            coro = self.process(info)
+        with self._running_cv:
+            self.running += 1
+        self.xom.run_coroutine_in_background(coro)
+
+    def thread_run(self):
+        thread_push_log("[FREPA]")
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.num_threads,
+            thread_name_prefix="file-replication")
+        try:
+            while 1:
+                try:
+                    self.tick()
+                except mythread.Shutdown:
+                    raise
+                except Exception:  # noqa: BLE001
+                    threadlog.exception(
+                        "Unhandled exception in file replication thread.")
+                    self.thread.sleep(1.0)
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
 class InitialQueueThread:
     thread: mythread.MyThread
 
@@ -1563,3 +2480,10 @@ class FileReplicationError(Exception):
         self.reason_phrase = response.reason_phrase
         self.relpath = relpath
         self.message = message or "failed"
+
+
+class FileDownloadRunning(Exception):
+    """ raised when a client request already downloads the file. """
+    def __init__(self, relpath):
+        super().__init__(relpath)
+        self.relpath = relpath
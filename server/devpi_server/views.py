@@ -9,6 +9,7 @@ from .filestore import RunningHashes
 from .filestore import get_hashes
 from .filestore import get_seekable_content_or_file
 from .fileutil import buffered_iterator
+from .httpclient import HTTPClient
 from .keyfs import KeyfsTimeoutError
 from .log import thread_pop_log
 from .log import thread_push_log
@@ -454,6 +455,12 @@ def devpiweb_get_status_info(request):
     return msgs
 
 
+@hookimpl
+def devpiserver_metrics(request):
+    xom = request.registry["xom"]
+    return xom.get_http_pool_metrics()
+
+
 @hookimpl
 def devpiserver_authcheck_always_ok(request):
     route = request.matched_route
@@ -701,6 +708,9 @@ class PyPIView:
         if not result:
             # access of verified_project will trigger 404 if not found
             self.request.context.verified_project  # noqa: B018
+        elif self.xom.is_replica():
+            # the files are likely requested next, so replicate them first
+            self.xom.replica_thread.shared_data.boost_links(result)
 
         if requested_by_installer:
             # we don't need the extra stuff on the simple page for pip
@@ -775,6 +785,12 @@ class PyPIView:
             if link.yanked is not None and link.yanked is not False:
                 yanked = "" if link.yanked is True else link.yanked
                 attribs += ' data-yanked="%s"' % escape(yanked)
+            if link.core_metadata:
+                # PEP 714 renamed the attribute, older clients use the old name
+                core_metadata = escape(
+                    "true" if link.core_metadata is True else link.core_metadata)
+                attribs += ' data-core-metadata="%s" data-dist-info-metadata="%s"' % (
+                    core_metadata, core_metadata)
             data = dict(stage=stage, attribs=attribs, key=link.key)
             yield "{stage} <a {attribs}>{key}</a><br>\n".format(**data).encode("utf-8")
 
@@ -796,6 +812,15 @@ class PyPIView:
                 data["requires-python"] = link.require_python
             if link.yanked is not None and link.yanked is not False:
                 data["yanked"] = link.yanked
+            if link.core_metadata:
+                if link.core_metadata is True:
+                    core_metadata = True
+                else:
+                    (hash_type, hash_value) = link.core_metadata.split("=", 1)
+                    core_metadata = {hash_type: hash_value}
+                # PEP 714 renamed the key, older clients use the old name
+                data["core-metadata"] = core_metadata
+                data["dist-info-metadata"] = core_metadata
             info = json.dumps(data, indent=None, sort_keys=False)
             if first:
                 yield f'{info}'.encode("utf-8")
@@ -1586,18 +1611,36 @@ class PyPIView:
         # manually in case they need it.
         key = self.xom.filestore.get_key_from_relpath(relpath)
         if key is None or not key.exists():
-            abort(self.request, 404, "no such file")
-        entry = self.xom.filestore.get_file_entry_from_key(key)
+            entry = self._core_metadata_entry(relpath)
+            if entry is None:
+                abort(self.request, 404, "no such file")
+        else:
+            entry = self.xom.filestore.get_file_entry_from_key(key)
+        stage = self.context.stage
+        if stage.ixconfig["type"] == "mirror":
+            stage.cache_file_access.touch(relpath)
         return self._pkgserv(entry)
 
     @view_config(route_name="/{user}/{index}/+f/{relpath:.*}")
     def stage_pkgserv(self):
         relpath = self._relpath_from_request()
         entry = self.xom.filestore.get_file_entry(relpath)
+        if entry is None or not entry.meta:
+            entry = self._core_metadata_entry(relpath) or entry
         if entry is None:
             abort(self.request, 404, "no such file")
         return self._pkgserv(entry)
 
+    def _core_metadata_entry(self, relpath):
+        """ Return an entry for a not yet cached core metadata file
+        (PEP 658) of a mirror release file. """
+        if not relpath.endswith(".metadata"):
+            return None
+        stage = self.context.stage
+        if stage.ixconfig["type"] != "mirror":
+            return None
+        return stage.get_core_metadata_entry(relpath)
+
     @view_config(route_name="/{user}/{index}/+e/{relpath:.*}",
                  permission="del_entry",
                  request_method="DELETE")
@@ -1777,7 +1820,7 @@ def _headers_from_response(r):
 
 
 class FileStreamer:
-    def __init__(self, f, entry, response):
+    def __init__(self, f, entry, response, *, chunk_size=65536, resume=None, max_resumes=0):
         self.hash_type = entry.best_available_hash_type
         self.hash_types = entry.default_hash_types
         self._hashes = entry.hashes
@@ -1785,21 +1828,42 @@ class FileStreamer:
         self.response = response
         self.error = None
         self.f = f
+        self.chunk_size = chunk_size
+        # called with the number of bytes received so far to get a
+        # response with the remaining data, or None if not possible
+        self.resume = resume
+        self.max_resumes = max_resumes
+        self.filesize = 0
+
+    def _iter_raw(self):
+        resumes = 0
+        response = self.response
+        while 1:
+            try:
+                yield from response.iter_raw(self.chunk_size)
+            except HTTPClient.Errors as e:
+                if self.resume is None or resumes >= self.max_resumes:
+                    raise
+                resumes += 1
+                threadlog.warn(
+                    "%s: resuming download from %r at byte %s after %s",
+                    self.relpath, self.response.url, self.filesize,
+                    lazy_format_exception_only(e))
+                response = self.resume(self.filesize)
+                if response is None:
+                    raise
+            else:
+                return
 
     def __iter__(self):
-        filesize = 0
         running_hashes = RunningHashes(self.hash_type, *self.hash_types)
         running_hashes.start()
         content_size = self.response.headers.get("content-length")
 
         yield _headers_from_response(self.response)
 
-        data_iter = self.response.iter_raw(10240)
-        while 1:
-            data = next(data_iter, None)
-            if data is None:
-                break
-            filesize += len(data)
+        for data in self._iter_raw():
+            self.filesize += len(data)
             for rh in running_hashes._running_hashes:
                 rh.update(data)
             self.f.write(data)
@@ -1807,16 +1871,41 @@ class FileStreamer:
 
         self.hashes = running_hashes.digests
 
-        if content_size and int(content_size) != filesize:
+        if content_size and int(content_size) != self.filesize:
             raise ValueError(
                 "%s: got %s bytes of %r from remote, expected %s" % (
-                    self.relpath, filesize, self.response.url, content_size))
+                    self.relpath, self.filesize, self.response.url, content_size))
         if self._hashes:
             err = self.hashes.exception_for(self._hashes, self.relpath)
             if err is not None:
                 raise err
 
 
+def make_range_resume(http, cstack, url, response):
+    """ Return a function which requests the rest of the file from
+    ``url`` starting at the given offset with a HTTP range request.
+
+    The ETag or Last-Modified header of the original response is used
+    with If-Range, so a changed file isn't resumed."""
+    validator = response.headers.get("etag") or response.headers.get("last-modified")
+    if validator is None or response.headers.get("accept-ranges") != "bytes":
+        return None
+
+    def resume(offset):
+        r = http.stream(
+            cstack, "GET", url, allow_redirects=True,
+            extra_headers={"Range": f"bytes={offset}-", "If-Range": validator})
+        if r.status_code == 206 and r.headers.get(
+                "content-range", "").startswith(f"bytes {offset}-"):
+            return r
+        r.close()
+        threadlog.error(
+            "can't resume download of %s, got status %s", url, r.status_code)
+        return None
+
+    return resume
+
+
 def iter_cache_remote_file(stage, entry, url):
     # we get and cache the file and some http headers from remote
     xom = stage.xom
@@ -1830,7 +1919,11 @@ def iter_cache_remote_file(stage, entry, url):
             threadlog.error(msg)
             raise BadGateway(msg, code=r.status_code, url=url)
         f = cstack.enter_context(entry.file_new_open())
-        file_streamer = FileStreamer(f, entry, r)
+        file_streamer = FileStreamer(
+            f, entry, r,
+            chunk_size=xom.config.download_chunk_size,
+            resume=make_range_resume(stage.http, cstack, url, r),
+            max_resumes=xom.config.download_max_resumes)
         threadlog.info("reading remote: %r, target %s", URL(r.url), entry.relpath)
 
         try:
@@ -1840,7 +1933,8 @@ def iter_cache_remote_file(stage, entry, url):
             raise
 
         if not entry.has_existing_metadata():
-            with xom.keyfs.write_transaction(allow_restart=True):
+
+            def set_content(entry=entry):
                 if entry.readonly:
                     entry = xom.filestore.get_file_entry_from_key(entry.key)
                 entry.file_set_content(
@@ -1856,6 +1950,8 @@ def iter_cache_remote_file(stage, entry, url):
                 # on Windows we need to close the file
                 # before the transaction closes
                 f.close()
+
+            xom.keyfs.grouped_write(set_content)
         else:
             # the file was downloaded before but locally removed, so put
             # it back in place without creating a new serial
@@ -1912,7 +2008,8 @@ def iter_remote_file_replica(stage, entry, url):
                 raise BadGateway(msg)
         cstack.callback(r.close)
         f = cstack.enter_context(entry.file_new_open())
-        file_streamer = FileStreamer(f, entry, r)
+        file_streamer = FileStreamer(
+            f, entry, r, chunk_size=xom.config.download_chunk_size)
 
         try:
             yield from file_streamer
@@ -1932,11 +2029,52 @@ def iter_remote_file_replica(stage, entry, url):
         replication_errors.remove(entry)
 
 
+def iter_file_content(entry):
+    with entry.file_open_read() as f:
+        yield entry.gethttpheaders()
+        while data := f.read(65536):
+            yield data
+
+
 def iter_fetch_remote_file(stage, entry, url):
-    if not stage.xom.is_replica():
-        yield from iter_cache_remote_file(stage, entry, url)
+    xom = stage.xom
+    keyfs = xom.keyfs
+    downloads = xom.filestore.downloads
+    download = None
+    # within a write transaction we would block the download we wait for
+    while not keyfs.tx.write:
+        (download, started) = downloads.start(entry.relpath)
+        if started:
+            break
+        threadlog.info("waiting for running download of %s", entry.relpath)
+        if not download.wait(xom.config.request_timeout):
+            threadlog.warn(
+                "running download of %s stalled, fetching separately",
+                entry.relpath)
+            download = None
+            break
+        # the file is either stored now, or the download failed
+        keyfs.restart_read_transaction()
+        stored_entry = xom.filestore.get_file_entry_from_key(entry.key)
+        if stored_entry.meta:
+            # otherwise this is a new entry not stored in the database yet
+            entry = stored_entry
+        if not should_fetch_remote_file(entry, {}):
+            yield from iter_file_content(entry)
+            return
+    if not xom.is_replica():
+        data_iter = iter_cache_remote_file(stage, entry, url)
     else:
-        yield from iter_remote_file_replica(stage, entry, url)
+        data_iter = iter_remote_file_replica(stage, entry, url)
+    try:
+        for data in data_iter:
+            if download is not None:
+                download.progress()
+            yield data
+    finally:
+        data_iter.close()
+        if download is not None:
+            downloads.finish(download)
 
 
 def url_for_entrypath(request, entrypath):
@@ -0,0 +1,209 @@
+"""
+Pre-populate the file cache of a mirror index from requirement files.
+
+"""
+from __future__ import annotations
+
+from .filestore import BadGateway
+from .main import CommandRunner
+from .main import Fatal
+from .main import lock_server_path
+from .main import xom_from_config
+from .normalized import normalize_name
+from .views import iter_fetch_remote_file
+from .views import should_fetch_remote_file
+from concurrent.futures import ThreadPoolExecutor
+from devpi_common.metadata import Requirement
+from devpi_common.metadata import parse_version
+from packaging.requirements import InvalidRequirement
+from pathlib import Path
+from typing import TYPE_CHECKING
+import shlex
+import sys
+
+
+if TYPE_CHECKING:
+    from .main import XOM
+    from .model import SimplelinkMeta
+    from collections.abc import Iterator
+
+
+def add_warmup_options(parser, pluginmanager):
+    parser.addoption(
+        "--index", default="root/pypi", metavar="USER/INDEX",
+        help="The mirror index to warm up.")
+    parser.addoption(
+        "--concurrency", type=int, default=8, metavar="NUM",
+        help="Maximum number of concurrent downloads.")
+
+
+def iter_requirements(path: Path) -> Iterator[tuple[Requirement, set[str]]]:
+    """ Yield requirements with their hashes from a requirements file.
+
+    Nested files referenced with ``-r`` are read as well, other options
+    and requirements which can't be resolved from an index are skipped."""
+    text = path.read_text()
+    # join continued lines
+    text = text.replace("\\\n", " ")
+    for line in text.splitlines():
+        line = line.split(" #", 1)[0].strip()  # noqa: PLW2901
+        if not line or line.startswith("#"):
+            continue
+        parts = shlex.split(line)
+        if parts[0] in ("-r", "--requirement"):
+            yield from iter_requirements(path.parent / parts[1])
+            continue
+        if parts[0].startswith("-"):
+            continue
+        hashes = set()
+        spec = []
+        for part in parts:
+            if part.startswith("--hash="):
+                hashes.add(part.removeprefix("--hash="))
+            elif not part.startswith("-"):
+                spec.append(part)
+        try:
+            req = Requirement(" ".join(spec))
+        except InvalidRequirement:
+            continue
+        if req.url:
+            continue
+        yield (req, hashes)
+
+
+def select_links(
+    links: list[SimplelinkMeta], req: Requirement, hashes: set[str]
+) -> list[SimplelinkMeta]:
+    """ Return the links of the files to fetch for the requirement.
+
+    With hashes, all files matching one of them are returned, otherwise
+    all files of the latest version matching the requirement."""
+    links = [x for x in links if not x.yanked]
+    if hashes:
+        return [
+            x for x in links
+            if any(f"{k}:{v}" in hashes for k, v in x.hashes.items())]
+    versions = set()
+    for link in links:
+        try:
+            if req.specifier.contains(link.version):
+                versions.add(link.version)
+        except ValueError:
+            continue
+    if not versions:
+        return []
+    version = max(versions, key=parse_version)
+    return [x for x in links if x.version == version]
+
+
+def fetch_file(xom: XOM, stagename: str, relpath: str) -> tuple[str, str]:
+    with xom.keyfs.read_transaction():
+        stage = xom.model.getstage(stagename)
+        entry = xom.filestore.get_file_entry(relpath)
+        if entry is None or not entry.meta:
+            return ("missing", relpath)
+        if not should_fetch_remote_file(entry, {}):
+            return ("cached", relpath)
+        try:
+            for _data in iter_fetch_remote_file(stage, entry, entry.url):
+                pass
+        except (BadGateway, ValueError) as e:
+            return ("error", f"{relpath}: {e}")
+        return ("fetched", relpath)
+
+
+def do_warmup(
+    xom: XOM, stagename: str, paths: list[Path], *, concurrency: int
+) -> list[tuple[str, str]]:
+    log = xom.log
+    relpaths: dict[str, None] = {}
+    results = []
+    with xom.keyfs.read_transaction():
+        stage = xom.model.getstage(stagename)
+        if stage is None:
+            msg = f"index {stagename!r} doesn't exist"
+            raise Fatal(msg)
+        if stage.ixconfig["type"] != "mirror":
+            msg = f"index {stagename!r} isn't a mirror"
+            raise Fatal(msg)
+        for path in paths:
+            for req, hashes in iter_requirements(path):
+                project = normalize_name(req.name)
+                try:
+                    links = list(stage.get_simplelinks(project))
+                except stage.UpstreamNotFoundError:
+                    links = []
+                except stage.UpstreamError as e:
+                    results.append(("error", f"{req}: {e}"))
+                    continue
+                selected = select_links(links, req, hashes)
+                if not selected:
+                    results.append(("missing", str(req)))
+                for link in selected:
+                    relpaths[link.path.lstrip("/")] = None
+    log.info("Fetching %s files for %s", len(relpaths), stagename)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(fetch_file, xom, stagename, relpath)
+            for relpath in relpaths]
+        for future in futures:
+            (status, info) = future.result()
+            log.info("%s %s", status, info)
+            results.append((status, info))
+    return results
+
+
+def warmup(pluginmanager=None, argv=None):
+    """ devpi-warmup command line entry point. """
+    if argv is None:
+        argv = sys.argv
+    else:
+        # for tests
+        argv = [str(x) for x in argv]
+    with CommandRunner(pluginmanager=pluginmanager) as runner:
+        parser = runner.create_parser(
+            description="Fetch the files for requirement files into the "
+                        "cache of a mirror index. The files are fetched "
+                        "by this process, so devpi-server must not be "
+                        "running with the same serverdir at the same time.",
+            add_help=False)
+        parser.add_help_option()
+        parser.add_configfile_option()
+        parser.add_logging_options()
+        parser.add_storage_options()
+        add_warmup_options(parser.addgroup("warmup options"), pluginmanager)
+        parser.add_argument("requirements", nargs="+", metavar="FILE")
+        config = runner.get_config(argv, parser=parser)
+        runner.configure_logging(config.args)
+        xom = xom_from_config(config)
+        if xom.is_replica():
+            msg = "devpi-warmup can only be used on a primary."
+            raise Fatal(msg)
+        # downloads are only deduplicated and the mirror caches only
+        # updated within one process, so a running server must not use
+        # the same serverdir
+        try:
+            server_lock = lock_server_path(config.server_path, exclusive=True)
+        except BlockingIOError:
+            msg = (
+                f"devpi-warmup can't be used while devpi-server is running "
+                f"with the serverdir '{config.server_path}'.")
+            raise Fatal(msg) from None
+        args = config.args
+        xom.thread_pool.start_one(xom.async_thread)
+        try:
+            results = do_warmup(
+                xom, args.index, [Path(x) for x in args.requirements],
+                concurrency=max(args.concurrency, 1))
+        finally:
+            xom.thread_pool.shutdown()
+            if server_lock is not None:
+                server_lock.close()
+        counts: dict[str, int] = {}
+        for status, _info in results:
+            counts[status] = counts.get(status, 0) + 1
+        xom.log.info(
+            "Finished: %s", ", ".join(f"{v} {k}" for k, v in sorted(counts.items())))
+        if counts.get("error") or counts.get("missing"):
+            return 1
+    return runner.return_code or 0
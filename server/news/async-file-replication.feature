@@ -0,0 +1 @@
+Added the ``--file-replication-concurrency`` option for replicas. If set, files are downloaded from the primary with up to that many concurrent requests on the asyncio loop over pooled connections, while the ``--file-replication-threads`` are only used to store the files. The number of concurrent downloads adapts to the latency of the primary and is reduced on errors. The order in which files are replicated stays the same. The current limit and the number of running downloads are available as metrics.
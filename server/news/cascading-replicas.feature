@@ -0,0 +1 @@
+Added the ``--serve-replication`` option for replicas. It allows other replicas to use this replica as their ``--primary-url``, so replicas can be arranged in a tree to reduce the load on the primary. The serving replica checks the expected primary UUID of downstream replicas against the UUID of the actual primary. It only answers once it has replicated from its own primary. Changelog entries which aren't available, like those before a changelog snapshot, are answered with 404. A serving replica writes changelog snapshots when ``--changelog-snapshot-interval`` is set. If it was bootstrapped with ``--replica-snapshot``, it writes a first snapshot right away, so downstream replicas started with ``--replica-snapshot`` can bootstrap from it.
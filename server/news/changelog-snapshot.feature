@@ -0,0 +1 @@
+Add ``--changelog-snapshot-interval`` option for the primary to regularly write a snapshot of all current keys, which is served at ``/+changelog/+snapshot``. New replicas started with ``--replica-snapshot`` import that snapshot in batches instead of replaying the whole changelog from serial 0.
@@ -0,0 +1 @@
+The list of project names of mirror indexes is kept in a compact sorted representation with binary search lookups instead of a dict, which considerably reduces the memory usage for big mirrors like PyPI.
@@ -0,0 +1 @@
+Mutable copies of stored values are now copied lazily. Nested dictionaries are only copied when they are accessed, so changing a single field of a large project or version dictionary no longer copies all unchanged data.
@@ -0,0 +1 @@
+Serve the core metadata of wheels as described in PEP 658 and PEP 714. For uploaded wheels the ``METADATA`` file is extracted on upload, for mirrors it is advertised and fetched from upstream when available.
@@ -0,0 +1 @@
+Added ``devpi-warmup`` command to fetch the files needed by requirement files (including pinned lock files with ``--hash`` options) into the cache of a mirror index with ``--concurrency`` parallel downloads. This allows preparing a new or emptied mirror before the first builds use it. The command fetches the files in its own process, so devpi-server must not run with the same serverdir at the same time. Where file locks are supported, a running devpi-server holds a shared lock on ``.server.lock`` in the serverdir and ``devpi-warmup`` refuses to start while it is held.
@@ -0,0 +1 @@
+Reuse connections to upstream servers for the async requests of mirrors and use a separate connection pool per upstream host. The pool sizes and keep-alive time can be configured with ``--http-max-connections-per-host``, ``--http-max-keepalive-connections-per-host`` and ``--http-keepalive-expiry``. With ``--mirror-http2`` HTTP/2 is used for mirror upstreams if the ``h2`` package is installed. Pool metrics like active and idle connections, connects and TLS handshakes are added to the metrics.
@@ -0,0 +1 @@
+Add ``--keyfs-cache-memory`` option to bound the keyfs cache by the approximate memory used by the cached values instead of the number of entries. With this option hits, misses, evictions and memory use per key name are added to the metrics.
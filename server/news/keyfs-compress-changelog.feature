@@ -0,0 +1 @@
+Add ``--keyfs-compress-changelog`` option to store new changelog entries zlib compressed. Existing entries stay readable, and replicas fetch the entries as stored, so the compression also reduces replication bandwidth.
@@ -0,0 +1 @@
+Add ``--keyfs-current-values`` option to maintain a table with the current value of each key, so reads at the latest serial are a single row lookup instead of a changelog decode.
@@ -0,0 +1 @@
+Added ``--keyfs-group-commit-window`` option. When set, writes of mirror data like cached release files and simple links which arrive concurrently within the given number of seconds are committed together with a single serial, which reduces the load on replicas during bursts of downloads.
@@ -0,0 +1 @@
+Add ``--keyfs-indexed-changelog`` option to store new changelog entries with an index of the contained keys, so reading the value of a single key doesn't require decoding the whole entry.
@@ -0,0 +1 @@
+Added ``Transaction.iter_relpaths_with_prefix`` to iterate over all keys below a relpath prefix using a range scan of the key table instead of walking the changelog. ``devpi-fsck`` uses it to find the files to check.
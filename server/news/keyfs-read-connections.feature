@@ -0,0 +1 @@
+Read connections of the SQLite storage backends are now kept open per thread and reused by later read transactions. The number of idle connections per thread can be set with ``--keyfs-read-connections``, use ``0`` to disable reuse.
@@ -0,0 +1 @@
+Added ``--keyfs-value-cache-size`` option for a cache of readonly values shared by all transactions. Values are cached by relpath and the serial they were last changed at, so concurrent requests for the same data reuse the already decoded value even when they run at different serials.
@@ -0,0 +1 @@
+Added ``mirror_cache_quota`` index option for mirrors to limit the size of cached files. When the quota is exceeded the least recently used files are deleted while their metadata is kept, so they are fetched again on demand. The check interval can be set with ``--mirror-cache-eviction-interval``.
@@ -0,0 +1 @@
+Added ``mirror_changelog_url`` option for mirror indexes and ``--mirror-changelog-interval`` server option. When both are set, the primary follows the XML-RPC changelog of the upstream (e.g. ``https://pypi.org/pypi``) and only expires the cached links of projects which changed upstream after they were fetched. This allows a much higher ``mirror_cache_expiry`` while staying up to date.
@@ -0,0 +1 @@
+Projects not found on the upstream of a mirror index are remembered in a size limited cache. The time until they are checked again can be set with the new ``mirror_not_found_expiry`` index option, which defaults to ``mirror_cache_expiry``. The size is set with ``--mirror-not-found-cache-size`` and cache statistics are available as metrics.
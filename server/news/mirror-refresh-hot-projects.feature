@@ -0,0 +1 @@
+Added ``--mirror-refresh-hot-projects`` option. The links of the given number of most requested projects of each mirror index are refreshed in the background shortly before their cache expires, so requests for popular projects don't have to wait for upstream.
@@ -0,0 +1 @@
+Added the ``--file-replication-batch-size`` option for replicas. If set, the file replication threads fetch up to that many files with one request to the new ``/+replica-files`` endpoint of the primary, which sends the content of small files together with their hashes in one stream. Larger or missing files are still fetched one by one. This reduces the per request overhead during the initial sync of replicas with many small files.
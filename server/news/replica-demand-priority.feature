@@ -0,0 +1 @@
+On replicas, the files of the latest version listed on served simple pages are moved to the front of the file replication queue, as installers are likely to request them next. File replication now registers its downloads, so a client request for a file being replicated waits for that download instead of fetching the file separately from the primary. Files a client request is already downloading are skipped by file replication and checked again later. The number of boosted files is available as the ``devpi_server_replica_file_download_boosted`` metric.
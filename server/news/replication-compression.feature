@@ -0,0 +1 @@
+The primary compresses the changelog data sent to replicas with gzip or deflate if the replica accepts it. The streaming protocol is flushed per chunk, so replicas decode and import the changes while the stream is still running. The level can be set with ``--replication-compression-level``, use 0 to disable the compression.
@@ -0,0 +1 @@
+Interrupted downloads of mirror files are resumed with HTTP range requests if the upstream server supports them. The number of attempts can be set with ``--download-max-resumes`` and the chunk size for downloads with ``--download-chunk-size``, which now defaults to 64 KiB.
@@ -0,0 +1 @@
+Concurrent requests for the same not yet cached file now only fetch it once. Further requests wait for the running download and then serve the file from disk. If the running download fails or makes no progress within ``--request-timeout`` seconds, they fetch the file themselves.
@@ -467,9 +467,13 @@ def http(pypiurls):
                 timeout=timeout,
             )
 
-        def post(self, url, *, data=None, files=None, extra_headers=None):
+        def post(self, url, *, content=None, data=None, files=None, extra_headers=None):
             return self.__call__(
-                url, data=data, files=files, extra_headers=extra_headers
+                url,
+                content=content,
+                data=data,
+                files=files,
+                extra_headers=extra_headers,
             )
 
         def stream(
@@ -491,6 +495,25 @@ def http(pypiurls):
                 timeout=timeout,
             )
 
+        async def async_stream(
+            self,
+            cstack,
+            method,
+            url,
+            *,
+            allow_redirects,
+            timeout=None,
+            extra_headers=None,
+        ):
+            return self.stream(
+                cstack,
+                method,
+                url,
+                allow_redirects=allow_redirects,
+                extra_headers=extra_headers,
+                timeout=timeout,
+            )
+
         def __call__(self, url, *, allow_redirects=False, extra_headers=None, **kw):
             class mockresponse:
                 headers: dict
@@ -548,7 +571,12 @@ def http(pypiurls):
                     return
 
                 def iter_raw(xself, chunk_size):
-                    yield xself.raw.read(chunk_size)
+                    while data := xself.raw.read(chunk_size):
+                        yield data
+
+                async def aiter_raw(xself, chunk_size):
+                    for data in xself.iter_raw(chunk_size):
+                        yield data
 
                 def json(xself):
                     return json.loads(xself.text)
@@ -0,0 +1,57 @@
+from devpi_server.cache import ENTRY_OVERHEAD
+from devpi_server.cache import KeynameMatcher
+from devpi_server.cache import SizedLRUCache
+from devpi_server.sizeof import gettotalsizeof
+
+
+def test_sized_lru_cache():
+    item_size = gettotalsizeof("x" * 100) + ENTRY_OVERHEAD
+    cache = SizedLRUCache(item_size * 3)
+    for i in range(3):
+        cache.put(i, "x" * 100)
+    assert cache.memory == item_size * 3
+    assert cache.get(0) == "x" * 100
+    # the least recently used entry is evicted
+    cache.put(3, "x" * 100)
+    assert cache.get(1) is None
+    assert cache.get(0) == "x" * 100
+    assert cache.evictions == 1
+    assert cache.memory == item_size * 3
+    assert (cache.hits, cache.misses, cache.lookups) == (2, 1, 3)
+    # replacing a value doesn't change the memory
+    cache.put(3, "y" * 100)
+    assert cache.get(3) == "y" * 100
+    assert cache.memory == item_size * 3
+    cache.invalidate(3)
+    assert cache.get(3) is None
+    assert cache.memory == item_size * 2
+
+
+def test_sized_lru_cache_too_big():
+    cache = SizedLRUCache(1000)
+    cache.put(0, "x")
+    cache.put(1, "x" * 1000)
+    assert cache.get(0) == "x"
+    assert cache.get(1) is None
+    assert cache.evictions == 0
+
+
+def test_sized_lru_cache_keyname_stats(keyfs):
+    matcher = KeynameMatcher()
+    matcher.add_key(keyfs.add_key("NAME1", "{name}/.config", dict))
+    matcher.add_key(keyfs.add_key("NAME2", ".config", set))
+    assert matcher(5) is None
+    assert matcher((5, ".config")) == "NAME2"
+    assert matcher((5, "foo/.config")) == "NAME1"
+    assert matcher((5, "foo/bar")) == "unknown"
+    cache = SizedLRUCache(10000, get_keyname=matcher)
+    cache.put((5, "foo/.config"), {"a": 1})
+    assert cache.get((5, "foo/.config")) == {"a": 1}
+    assert cache.get((5, "bar/.config")) is None
+    assert cache.get((5, ".config")) is None
+    assert cache.get(5) is None
+    stats = cache.keyname_stats
+    assert (stats["NAME1"].hits, stats["NAME1"].misses) == (1, 1)
+    assert stats["NAME1"].size == cache.memory
+    assert (stats["NAME2"].hits, stats["NAME2"].misses) == (0, 1)
+    assert (stats[None].hits, stats[None].misses) == (0, 1)
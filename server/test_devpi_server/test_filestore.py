@@ -303,6 +303,48 @@ class TestFileStore:
         assert rheaders["last-modified"] == headers["last-modified"]
         assert rheaders["content-type"] in zip_types
 
+    @pytest.mark.parametrize("resumable", [True, False])
+    def test_iterfile_remote_resume(self, filestore, http, gen, xom, resumable):
+        import httpx
+
+        class FailingIO(BytesIO):
+            def read(self, size=-1):
+                if self.tell() >= 4:
+                    raise httpx.ReadError("connection lost")
+                return super().read(2)
+
+        link = gen.pypi_package_link("pytest-3.0.zip", hash_spec=False)
+        entry = filestore.maplink(link, "root", "pypi", "pytest")
+        headers = ResponseHeaders({
+            "accept-ranges": "bytes",
+            "content-length": "10",
+            "etag": '"abc"',
+            "last-modified": "Thu, 25 Nov 2010 20:00:27 GMT",
+            "content-type": "application/zip"})
+        http.add(
+            link.url, status_code=200, headers=headers,
+            raw=FailingIO(b"0123456789"))
+        if resumable:
+            http.add(
+                link.url, status_code=206,
+                headers={"content-range": "bytes 4-9/10", "content-length": "6"},
+                raw=BytesIO(b"456789"))
+        else:
+            # the file changed upstream, so the whole file is returned
+            http.add(
+                link.url, status_code=200, headers=headers,
+                raw=BytesIO(b"0123456789"))
+        stage = xom.model.getstage('root/pypi')
+        if not resumable:
+            with pytest.raises(httpx.ReadError):
+                list(iter_cache_remote_file(stage, entry, entry.url))
+            assert not entry.file_exists()
+            return
+        data = list(iter_cache_remote_file(stage, entry, entry.url))
+        assert b"".join(data[1:]) == b"0123456789"
+        assert entry.file_get_content() == b"0123456789"
+        assert entry.hashes == get_hashes(b"0123456789")
+
     def test_iterfile_remote_error_md5(self, filestore, http, gen, xom):
         link = gen.pypi_package_link("pytest-3.0.zip")
         entry = filestore.maplink(link, "root", "pypi", "pytest")
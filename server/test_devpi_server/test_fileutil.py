@@ -1,6 +1,13 @@
 from devpi_server.fileutil import BytesIO
 from devpi_server.fileutil import DumpError
 from devpi_server.fileutil import LoadError
+from devpi_server.fileutil import ZLIB_ENTRY_TAG
+from devpi_server.fileutil import compress_entry
+from devpi_server.fileutil import decompress_entry
+from devpi_server.fileutil import dumps_indexed_entry
+from devpi_server.fileutil import loads_entry
+from devpi_server.fileutil import loads_entry_value
+from devpi_server.fileutil import plain_entry
 from devpi_server.fileutil import dumplen
 from devpi_server.fileutil import dumps
 from devpi_server.fileutil import loads
@@ -119,3 +126,43 @@ def test_loads_bad_data():
     with pytest.raises(LoadError) as e:
         loads(b'LCQ')
     assert msg == str(e.value)
+
+
+def test_compress_entry():
+    data = dumps((
+        {"root/pypi/pytest/.simple": ("PROJSIMPLELINKS", -1, {
+            "links": [("pytest-1.0.zip", "root/pypi/+e/https_pypi.org_pytest/pytest-1.0.zip")],
+            "requires_python": [None], "serial": 10, "yanked": [None]})},
+        []))
+    compressed = compress_entry(data)
+    assert compressed.startswith(ZLIB_ENTRY_TAG)
+    assert len(compressed) < len(data)
+    assert decompress_entry(compressed) == data
+    # uncompressed entries are returned as is
+    assert decompress_entry(data) == data
+    # the tag can't be confused with plain serialized data
+    with pytest.raises(LoadError):
+        loads(compressed)
+
+
+def test_indexed_entry():
+    changes = {
+        "root/pypi/.projects": ("PROJNAMES", -1, {"pytest"}),
+        "root/pypi/.mirrornameschange": ("MIRRORNAMESINIT", 3, 2),
+        "root/pypi/+e/foo": ("PYPIFILE_NOMD5", -1, None)}
+    rel_renames = ["+files/foo-tmp"]
+    data = dumps_indexed_entry(changes, rel_renames)
+    assert loads_entry(data) == (changes, rel_renames)
+    assert loads_entry_value(data, "root/pypi/.mirrornameschange") == (
+        "MIRRORNAMESINIT", 3, 2)
+    assert loads_entry_value(data, "root/pypi/+e/foo") == (
+        "PYPIFILE_NOMD5", -1, None)
+    with pytest.raises(KeyError):
+        loads_entry_value(data, "root/pypi/.simple")
+    plain = dumps((changes, rel_renames))
+    assert plain_entry(data) == plain
+    assert plain_entry(compress_entry(data)) == plain
+    # plain entries are supported as well
+    assert loads_entry(plain) == (changes, rel_renames)
+    assert loads_entry_value(plain, "root/pypi/.projects") == (
+        "PROJNAMES", -1, {"pytest"})
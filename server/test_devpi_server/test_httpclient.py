@@ -0,0 +1,172 @@
+from devpi_server.httpclient import AsyncPerHostTransport
+from devpi_server.httpclient import HTTPClient
+from devpi_server.httpclient import PerHostTransport
+from devpi_server.httpclient import PoolStats
+import asyncio
+import httpx
+import pytest
+
+
+def test_pool_stats():
+    stats = PoolStats()
+    trace = stats.make_trace()
+    trace("connection.connect_tcp.started", {})
+    trace("connection.connect_tcp.complete", {})
+    trace("connection.start_tls.started", {})
+    trace("connection.start_tls.failed", {})
+    trace("connection.start_tls.started", {})
+    trace("connection.start_tls.complete", {})
+    trace("http11.send_request_headers.started", {})
+    assert stats.connects == 1
+    assert stats.tls_handshakes == 1
+    assert stats.connect_time >= 0
+    assert stats.tls_handshake_time >= 0
+
+
+def test_per_host_transport():
+    created = []
+
+    def create_transport():
+        transport = httpx.MockTransport(
+            lambda request: httpx.Response(200, text=request.url.host))
+        created.append(transport)
+        return transport
+
+    transport = PerHostTransport(create_transport, PoolStats())
+    with httpx.Client(transport=transport) as client:
+        assert client.get("https://example.com/foo").text == "example.com"
+        assert client.get("https://example.com/bar").text == "example.com"
+        assert len(created) == 1
+        assert client.get("https://example.org/foo").text == "example.org"
+        assert len(created) == 2
+        # different port is a different pool
+        client.get("https://example.com:8443/foo")
+        assert len(created) == 3
+        assert len(list(transport.iter_transports())) == 3
+    assert list(transport.iter_transports()) == []
+
+
+def test_async_per_host_transport():
+    created = []
+
+    def create_transport():
+        transport = httpx.MockTransport(
+            lambda request: httpx.Response(200, text=request.url.host))
+        created.append(transport)
+        return transport
+
+    async def run():
+        transport = AsyncPerHostTransport(create_transport, PoolStats())
+        async with httpx.AsyncClient(transport=transport) as client:
+            r1 = await client.get("https://example.com/foo")
+            r2 = await client.get("https://example.com/bar")
+            r3 = await client.get("https://example.org/foo")
+        return [r1.text, r2.text, r3.text]
+
+    assert asyncio.run(run()) == ["example.com", "example.com", "example.org"]
+    assert len(created) == 2
+
+
+@pytest.mark.nomocking
+def test_async_client_reused(makexom):
+    xom = makexom()
+    http = xom.new_http_client("test")
+
+    async def get_clients():
+        return (http._get_async_client(), http._get_async_client())
+
+    (client1, client2) = asyncio.run(get_clients())
+    assert client1 is client2
+    (client3, _client) = asyncio.run(get_clients())
+    assert client3 is not client1
+
+
+@pytest.mark.nomocking
+def test_pool_options(makexom):
+    xom = makexom([
+        "--http-max-connections-per-host=7",
+        "--http-max-keepalive-connections-per-host=3",
+        "--http-keepalive-expiry=12.5"])
+    http = xom.new_http_client("test")
+    assert isinstance(http, HTTPClient)
+    assert http.limits.max_connections == 7
+    assert http.limits.max_keepalive_connections == 3
+    assert http.limits.keepalive_expiry == 12.5
+    assert http.http2 is False
+
+
+@pytest.mark.nomocking
+def test_pool_metrics(makexom):
+    xom = makexom()
+    http = xom.new_http_client("test")
+    metrics = {x[0]: x for x in http.get_pool_metrics("devpi_server_http")}
+    assert metrics["devpi_server_http_connections_active"] == (
+        "devpi_server_http_connections_active", "gauge", 0)
+    assert metrics["devpi_server_http_tls_handshakes"] == (
+        "devpi_server_http_tls_handshakes", "counter", 0)
+    assert set(metrics) == {
+        "devpi_server_http_connections_active",
+        "devpi_server_http_connections_idle",
+        "devpi_server_http_connects",
+        "devpi_server_http_connect_time_seconds",
+        "devpi_server_http_pools",
+        "devpi_server_http_tls_handshakes",
+        "devpi_server_http_tls_handshake_time_seconds"}
+
+
+@pytest.mark.nomocking
+def test_mirror_http2_option(makexom):
+    import importlib.util
+
+    xom = makexom(["--mirror-http2"])
+    assert xom.config.mirror_http2 is True
+    assert xom._http.http2 is (importlib.util.find_spec("h2") is not None)
+    # other clients don't use HTTP/2
+    assert xom.new_http_client("test").http2 is False
+
+
+@pytest.mark.nomocking
+def test_close_async_clients(makexom):
+    import threading
+
+    xom = makexom()
+    http = xom.new_http_client("test")
+
+    async def get_client():
+        return http._get_async_client()
+
+    # client of a loop which isn't running anymore
+    stopped_loop = asyncio.new_event_loop()
+    stopped_client = stopped_loop.run_until_complete(get_client())
+    # client of a loop running in another thread
+    running_loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=running_loop.run_forever)
+    thread.start()
+    try:
+        running_client = asyncio.run_coroutine_threadsafe(
+            get_client(), running_loop).result(5)
+        http.close()
+        assert running_client.is_closed
+        assert stopped_client.is_closed
+        assert len(http._async_clients) == 0
+    finally:
+        running_loop.call_soon_threadsafe(running_loop.stop)
+        thread.join()
+        running_loop.close()
+        stopped_loop.close()
+
+
+@pytest.mark.nomocking
+def test_http_pool_metrics_hook(makexom):
+    from devpi_server.views import devpiserver_metrics
+
+    xom = makexom()
+
+    class Request:
+        registry = dict(xom=xom)
+
+    # not reported before the client is used
+    assert devpiserver_metrics(Request()) == []
+    assert xom._http
+    metrics = {x[0] for x in devpiserver_metrics(Request())}
+    assert "devpi_server_http_connects" in metrics
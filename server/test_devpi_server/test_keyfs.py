@@ -4,6 +4,7 @@ from devpi_server.keyfs import KeyFS
 from devpi_server.keyfs import Transaction
 from devpi_server.keyfs_types import FilePathInfo
 from devpi_server.keyfs_types import RelPath
+from devpi_server.markers import absent
 from devpi_server.mythread import ThreadPool
 from devpi_server.readonly import is_deeply_readonly
 from functools import partial
@@ -12,6 +13,7 @@ from typing import cast
 import contextlib
 import py
 import pytest
+import threading
 
 
 if TYPE_CHECKING:
@@ -479,6 +481,77 @@ class TestTransactionIsolation:
                 assert tx.get_value_at(D2, 1)
             assert tx.get_value_at(D2, 2) == {2:2}
 
+    def test_import_changes_keeps_back_serial(self, keyfs, storage, tmpdir):
+        D = keyfs.add_key("NAME", "hello", dict)
+        with keyfs.write_transaction():
+            D.set({1: 1})
+        with keyfs.write_transaction():
+            D.set({2: 2})
+        new_keyfs = KeyFS(tmpdir.join("newkeyfs"), storage)
+        D2 = cast("TypedKey[dict]", new_keyfs.add_key("NAME", "hello", dict))
+        for serial in range(2):
+            with keyfs.read_transaction() as tx:
+                changes = tx.conn.get_changes(serial)
+            new_keyfs.import_changes(serial, changes)
+        # a back_serial differing from the local history is stored as is
+        new_keyfs.import_changes(2, {D2.relpath: ("NAME", 0, {3: 3})})
+        with new_keyfs.read_transaction() as tx:
+            (last_serial, back_serial, _val) = tx.conn.get_relpath_at(
+                D2.relpath, 2)
+        assert (last_serial, back_serial) == (2, 0)
+
+    def test_import_snapshot_batches(self, monkeypatch, storage, tmpdir):
+        import devpi_server.keyfs
+
+        monkeypatch.setattr(devpi_server.keyfs, "SNAPSHOT_BATCH_SIZE", 2)
+        keyfs = KeyFS(tmpdir.join("keyfs"), storage)
+        pkey = keyfs.add_key("NAME", "hello/{name}", dict)
+        l = []
+        keyfs.subscribe_on_import(lambda *args: l.append(args))
+        items = [
+            (pkey(name=name).relpath, "NAME", {name: i})
+            for i, name in enumerate("abcde")]
+        assert keyfs.import_snapshot(10, iter(items)) == 5
+        assert keyfs.get_current_serial() == 10
+        with keyfs.read_transaction() as tx:
+            # the values aren't part of the changelog entry
+            assert tx.conn.get_changes(10) == {}
+            assert tx.get(pkey(name="c")) == {"c": 2}
+            assert tx.get_value_at(pkey(name="e"), 10) == {"e": 4}
+            assert [x.relpath for x in tx.iter_relpaths_with_prefix("")] == [
+                x[0] for x in items]
+        assert [
+            relpath for relpath, _change in keyfs.iter_snapshot_changes(10)
+        ] == [x[0] for x in items]
+        # the subscriber is called in batches
+        assert [len(changes) for serial, changes in l] == [2, 2, 1]
+        # changes after the snapshot continue the history
+        keyfs.import_changes(11, {
+            pkey(name="a").relpath: ("NAME", 10, {"a": 11})})
+        with keyfs.read_transaction() as tx:
+            assert tx.get(pkey(name="a")) == {"a": 11}
+            assert tx.get_value_at(pkey(name="a"), 10) == {"a": 0}
+
+    def test_import_snapshot_interrupted(self, storage, tmpdir):
+        keyfs = KeyFS(tmpdir.join("keyfs"), storage)
+        pkey = keyfs.add_key("NAME", "hello/{name}", dict)
+
+        def iter_items():
+            for name in "ab":
+                yield (pkey(name=name).relpath, "NAME", {})
+            raise ValueError
+
+        with pytest.raises(ValueError):  # noqa: PT011
+            keyfs.import_snapshot(10, iter_items())
+        assert keyfs.get_current_serial() == -1
+        # nothing is left for replaying the changelog from the start
+        with keyfs.read_transaction() as tx:
+            assert list(tx.iter_relpaths_with_prefix("")) == []
+        keyfs.import_changes(0, {
+            pkey(name="c").relpath: ("NAME", -1, {})})
+        with pytest.raises(RuntimeError, match="empty storage"):
+            keyfs.import_snapshot(10, [])
+
     def test_get_value_at_modify_inplace_is_safe(self, keyfs):
         from copy import deepcopy
         D = keyfs.add_key("NAME", "hello", dict)
@@ -1023,6 +1096,50 @@ def test_keyfs_sqlite_hash_hl(file_digest, gen_path, sorted_serverdir):
     assert sorted_serverdir(tmp / "+h" / content_hash[:3]) == [content_hash[3:]]
 
 
+@pytest.mark.parametrize("pool_size", [None, 0])
+def test_keyfs_sqlite_read_connections(gen_path, pool_size):
+    from devpi_server import keyfs_sqlite
+    from devpi_server.filestore_db import DBIOFile
+
+    tmp = gen_path()
+    io_file_factory = partial(DBIOFile, settings={})
+    keyfs = KeyFS(
+        tmp, keyfs_sqlite.Storage, io_file_factory=io_file_factory,
+        read_connection_pool_size=pool_size)
+    key = keyfs.add_key("NAME", "name", dict)
+    with keyfs.write_transaction():
+        key.set({"a": 1})
+    with keyfs.read_transaction() as tx:
+        sqlconn = tx.conn._sqlconn
+    with keyfs.read_transaction() as tx:
+        assert tx.get(key) == {"a": 1}
+        assert (tx.conn._sqlconn is sqlconn) is (pool_size is None)
+        sqlconn = tx.conn._sqlconn
+    # writes aren't using pooled connections and changes are visible
+    with keyfs.write_transaction() as tx:
+        assert tx.conn._sqlconn is not sqlconn
+        key.set({"a": 2})
+    with keyfs.read_transaction() as tx:
+        assert tx.get(key) == {"a": 2}
+        assert (tx.conn._sqlconn is sqlconn) is (pool_size is None)
+    # connections aren't shared between threads
+    result = []
+
+    def read():
+        with keyfs.get_connection() as conn:
+            result.append(conn._sqlconn)
+
+    thread = threading.Thread(target=read)
+    thread.start()
+    thread.join()
+    assert result[0] is not sqlconn
+    # pooled connections are discarded after schema changes
+    keyfs._storage._schema_generation += 1
+    with keyfs.read_transaction() as tx:
+        assert tx.conn._sqlconn is not sqlconn
+    keyfs._storage.close_read_connections()
+
+
 @notransaction
 def test_iter_relpaths_at(keyfs):
     pkey = keyfs.add_key("NAME1", "{name}", int)
@@ -1035,3 +1152,279 @@ def test_iter_relpaths_at(keyfs):
         (relpath_info,) = list(tx.iter_relpaths_at([key], tx.at_serial))
     assert relpath_info.keyname == "NAME1"
     assert relpath_info.value == 1
+
+
+@notransaction
+def test_iter_relpaths_with_prefix(keyfs, monkeypatch):
+    pkey = keyfs.add_key("NAME1", "{user}/{name}", int)
+    other = keyfs.add_key("NAME2", "{user}/+other", int)
+    with keyfs.write_transaction():
+        pkey(user="root", name="b_c").set(1)
+        pkey(user="root", name="a").set(2)
+        pkey(user="rootx", name="a").set(3)
+        other(user="root").set(4)
+    with keyfs.write_transaction():
+        pkey(user="root", name="a").set(5)
+        pkey(user="root", name="b_c").delete()
+        pkey(user="root", name="d").set(6)
+
+    def get(prefix, **kw):
+        with keyfs.read_transaction() as tx:
+            return [
+                (x.relpath, x.keyname, x.serial, x.value)
+                for x in tx.iter_relpaths_with_prefix(prefix, **kw)]
+
+    assert get("root/") == [
+        ("root/+other", "NAME2", 0, 4),
+        ("root/a", "NAME1", 1, 5),
+        ("root/d", "NAME1", 1, 6)]
+    assert get("root/", at_serial=0) == [
+        ("root/+other", "NAME2", 0, 4),
+        ("root/a", "NAME1", 0, 2),
+        ("root/b_c", "NAME1", 0, 1)]
+    assert get("root/", typedkeys=[pkey]) == [
+        ("root/a", "NAME1", 1, 5),
+        ("root/d", "NAME1", 1, 6)]
+    assert get("root/b_") == []
+    assert get("root/b_", at_serial=0) == [("root/b_c", "NAME1", 0, 1)]
+    assert [x[0] for x in get("")] == [
+        "root/+other", "root/a", "root/d", "rootx/a"]
+    # storages without the method use a slower fallback
+    with keyfs.read_transaction() as tx:
+        monkeypatch.setattr(
+            type(tx.conn), "iter_relpaths_with_prefix", None, raising=False)
+    assert get("root/") == [
+        ("root/+other", "NAME2", 0, 4),
+        ("root/a", "NAME1", 1, 5),
+        ("root/d", "NAME1", 1, 6)]
+
+
+@notransaction
+def test_value_cache(gen_path, storage, storage_io_file_factory):
+    keyfs = KeyFS(
+        gen_path(), storage, io_file_factory=storage_io_file_factory,
+        value_cache_size=100)
+    key1 = keyfs.add_key("NAME1", "key1", dict)
+    key2 = keyfs.add_key("NAME2", "key2", dict)
+    with keyfs.write_transaction():
+        key1.set({"a": [1]})
+    with keyfs.read_transaction():
+        value = key1.get()
+    with keyfs.write_transaction():
+        key2.set({"b": 1})
+    with keyfs.read_transaction() as tx:
+        assert tx.at_serial == 1
+        # the value is shared with the transaction at the older serial
+        assert key1.get() is value
+        assert key2.get() == {"b": 1}
+    with keyfs.write_transaction():
+        key1.set({"a": [2]})
+    with keyfs.read_transaction() as tx:
+        assert key1.get() == {"a": [2]}
+        assert tx.get_value_at(key1, 1) is value
+    with keyfs.write_transaction():
+        key1.delete()
+    with keyfs.read_transaction():
+        assert not key1.exists()
+
+
+@notransaction
+def test_value_cache_hit_without_query(
+        gen_path, monkeypatch, storage, storage_io_file_factory):
+    keyfs = KeyFS(
+        gen_path(), storage, io_file_factory=storage_io_file_factory,
+        value_cache_size=100)
+    key1 = keyfs.add_key("NAME1", "key1", dict)
+    key2 = keyfs.add_key("NAME2", "key2", dict)
+    with keyfs.write_transaction():
+        key1.set({"a": 1})
+    with keyfs.write_transaction():
+        key2.set({"b": 1})
+    with keyfs.read_transaction() as tx:
+        value = key1.get()
+        conn_class = type(tx.conn)
+    calls = []
+    orig = conn_class.db_read_typedkey
+    monkeypatch.setattr(
+        conn_class, "db_read_typedkey",
+        lambda self, relpath: calls.append(relpath) or orig(self, relpath))
+    with keyfs.read_transaction() as tx:
+        assert key1.get() is value
+        assert tx.get_value_at(key1, 0) is value
+    assert calls == []
+    with keyfs.write_transaction():
+        key2.set({"b": 2})
+    calls.clear()
+    # at the new serial the last change has to be checked once
+    with keyfs.read_transaction():
+        assert key1.get() is value
+    with keyfs.read_transaction():
+        assert key1.get() is value
+    assert calls == [key1.relpath]
+
+
+class TestGroupCommit:
+    @pytest.fixture
+    def keyfs(self, gen_path, storage, storage_io_file_factory):
+        return KeyFS(
+            gen_path(), storage, io_file_factory=storage_io_file_factory,
+            group_commit_window=0.2)
+
+    def run_concurrently(self, funcs):
+        barrier = threading.Barrier(len(funcs))
+        results = [None] * len(funcs)
+
+        def run(index, func):
+            barrier.wait()
+            try:
+                results[index] = func()
+            except Exception as e:  # noqa: BLE001
+                results[index] = e
+
+        threads = [
+            threading.Thread(target=run, args=x) for x in enumerate(funcs)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    @notransaction
+    def test_single_serial(self, keyfs):
+        pkey = keyfs.add_key("NAME", "{name}", int)
+
+        def set_value(i):
+            pkey(name=str(i)).set(i)
+            return i
+
+        results = self.run_concurrently([
+            partial(keyfs.grouped_write, partial(set_value, i))
+            for i in range(5)])
+        assert results == list(range(5))
+        assert keyfs.get_current_serial() == 0
+        with keyfs.read_transaction() as tx:
+            assert tx.conn.get_changes(0).keys() == {
+                pkey(name=str(i)).relpath for i in range(5)}
+
+    @notransaction
+    def test_failing_function(self, keyfs):
+        pkey = keyfs.add_key("NAME", "{name}", int)
+        key1 = pkey(name="1")
+        key2 = pkey(name="2")
+        committed = []
+
+        def fail():
+            key2.set(2)
+            keyfs.tx.on_commit_success(partial(committed.append, 2))
+            raise ValueError("fail")
+
+        def succeed():
+            key1.set(1)
+            keyfs.tx.on_commit_success(partial(committed.append, 1))
+
+        results = self.run_concurrently([
+            partial(keyfs.grouped_write, fail),
+            partial(keyfs.grouped_write, succeed)])
+        assert isinstance(results[0], ValueError)
+        assert results[1] is None
+        assert committed == [1]
+        assert keyfs.get_current_serial() == 0
+        with keyfs.read_transaction():
+            assert key1.get() == 1
+            assert not key2.exists()
+
+    @notransaction
+    def test_restarts_read_transaction(self, keyfs):
+        key = keyfs.add_key("NAME", "name", int)
+        with keyfs.write_transaction():
+            key.set(1)
+        with keyfs.read_transaction() as tx:
+            assert tx.at_serial == 0
+            keyfs.grouped_write(partial(key.set, 2))
+            assert not tx.write
+            assert tx.at_serial == 1
+            assert key.get() == 2
+
+    @notransaction
+    def test_disabled(self, gen_path, storage, storage_io_file_factory):
+        keyfs = KeyFS(
+            gen_path(), storage, io_file_factory=storage_io_file_factory)
+        key = keyfs.add_key("NAME", "name", int)
+        with keyfs.read_transaction() as tx:
+            keyfs.grouped_write(partial(key.set, 1))
+            # same as write_transaction(allow_restart=True)
+            assert tx.write
+        with keyfs.read_transaction():
+            assert key.get() == 1
+
+
+@notransaction
+def test_current_values(gen_path, storage, storage_io_file_factory):
+    path = gen_path()
+    keyfs = KeyFS(path, storage, io_file_factory=storage_io_file_factory)
+    pkey = keyfs.add_key("NAME1", "{name}", dict)
+    key = pkey(name="hello")
+    with keyfs.write_transaction():
+        key.set({"a": 1})
+    with keyfs.write_transaction():
+        key.set({"a": 2})
+    # enabling fills the table from the existing changelog
+    keyfs = KeyFS(
+        path, storage, io_file_factory=storage_io_file_factory,
+        current_values=True)
+    pkey = keyfs.add_key("NAME1", "{name}", dict)
+    key = pkey(name="hello")
+    assert keyfs._storage.current_values
+    with keyfs.read_transaction() as tx:
+        assert tx.conn._get_current_relpath_at(key.relpath, 1) == (1, 0, {"a": 2})
+        assert tx.conn._get_current_relpath_at(key.relpath, 0) is absent
+    with keyfs.write_transaction():
+        key.set({"a": 3})
+    with keyfs.write_transaction():
+        key.delete()
+    with keyfs.read_transaction() as tx:
+        assert tx.conn._get_current_relpath_at(key.relpath, 3) == (3, 2, None)
+        with pytest.raises(KeyError):
+            tx.conn._get_current_relpath_at("other", 3)
+        # older serials still come from the changelog
+        assert tx.get_value_at(key, 2) == {"a": 3}
+        assert tx.get_value_at(key, 1) == {"a": 2}
+        assert tx.get_value_at(key, 0) == {"a": 1}
+        assert not tx.exists(key)
+
+
+def test_indexed_changelog(gen_path, storage, storage_io_file_factory):
+    from devpi_server.fileutil import is_indexed_entry
+    from devpi_server.fileutil import loads
+
+    path = gen_path()
+    keyfs = KeyFS(path, storage, io_file_factory=storage_io_file_factory)
+    pkey = keyfs.add_key("NAME1", "{name}", dict)
+    key1 = pkey(name="hello")
+    key2 = pkey(name="world")
+    with keyfs.write_transaction():
+        key1.set({"a": 1})
+        key2.set({"b": 1})
+    # entries in both formats can be read after enabling
+    keyfs = KeyFS(
+        path, storage, io_file_factory=storage_io_file_factory,
+        indexed_changelog=True)
+    pkey = keyfs.add_key("NAME1", "{name}", dict)
+    key1 = pkey(name="hello")
+    key2 = pkey(name="world")
+    with keyfs.write_transaction():
+        key1.set({"a": 2})
+        key2.set({"b": 2})
+    with keyfs.read_transaction() as tx:
+        assert not is_indexed_entry(tx.conn.get_stored_changelog_entry(0))
+        assert is_indexed_entry(tx.conn.get_stored_changelog_entry(1))
+        (changes, rel_renames) = loads(tx.conn.get_raw_changelog_entry(1))
+        assert changes[key1.relpath] == ("NAME1", 0, {"a": 2})
+        assert changes[key2.relpath] == ("NAME1", 0, {"b": 2})
+        assert tx.conn.get_change(1, key2.relpath) == ("NAME1", 0, {"b": 2})
+        assert tx.conn.get_change(1, "other") is None
+        assert tx.conn.get_changes(1) == changes
+        assert tx.get_value_at(key1, 1) == {"a": 2}
+        assert tx.get_value_at(key1, 0) == {"a": 1}
+        assert tx.get_value_at(key2, 1) == {"b": 2}
+        assert tx.get_value_at(key2, 0) == {"b": 1}
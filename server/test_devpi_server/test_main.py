@@ -154,6 +154,35 @@ def test_fatal_if_no_storage_and_no_sqlite_file(tmp_path):
     assert "you first need to run devpi-init or devpi-import" in str(excinfo.value)
 
 
+@wsgi_run_throws
+def test_fatal_if_serverdir_locked(tmp_path):
+    from devpi_server.init import init
+    from devpi_server.main import _main
+    from devpi_server.main import get_pluginmanager
+    from devpi_server.main import lock_server_path
+
+    pytest.importorskip("fcntl")
+    pm = get_pluginmanager()
+    init(argv=["devpi-init", "--serverdir", str(tmp_path)], pluginmanager=pm)
+    lock = lock_server_path(tmp_path, exclusive=True)
+    try:
+        with pytest.raises(Fatal, match="in use by devpi-warmup"):
+            _main(
+                argv=["devpi-server", "--serverdir", str(tmp_path)],
+                pluginmanager=pm)
+    finally:
+        lock.close()
+    # the server only holds a shared lock, so several can run
+    lock = lock_server_path(tmp_path)
+    try:
+        with pytest.raises(ZeroDivisionError):
+            _main(
+                argv=["devpi-server", "--serverdir", str(tmp_path)],
+                pluginmanager=pm)
+    finally:
+        lock.close()
+
+
 @wsgi_run_throws
 def test_main_starts_server_if_run_commands_returns_none(tmpdir):
     from devpi_server.init import init
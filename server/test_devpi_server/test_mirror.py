@@ -1,5 +1,7 @@
 from devpi_server.keyfs_types import FilePathInfo
 from devpi_server.keyfs_types import RelPath
+from devpi_server.mirror import ProjectAccessCounts
+from devpi_server.mirror import ProjectNames
 from devpi_server.mirror import ProjectNamesCache
 from devpi_server.mirror import ProjectUpdateCache
 from devpi_server.mirror import URL
@@ -101,6 +103,16 @@ class TestIndexParsing:
         assert link.basename == "py-1.0.zip"
         assert link.requires_python == "<3"
 
+    def test_parse_index_with_core_metadata(self):
+        result = parse_index(
+            self.simplepy,
+            """<a href="pkg/py-1.0-py3-none-any.whl" data-core-metadata="sha256=abc" />
+               <a href="pkg/py-1.1-py3-none-any.whl" data-dist-info-metadata="true" />
+               <a href="pkg/py-1.2-py3-none-any.whl" />
+        """)
+        links = sorted(result.releaselinks, key=lambda x: x.basename)
+        assert [x.core_metadata for x in links] == ["sha256=abc", True, None]
+
     def test_parse_index_with_requires_python_hash_spec_is_better(self):
         result = parse_index(self.simplepy,
             """<a href="pkg/py-1.0.zip" data-requires-python="&lt;3" />
@@ -1425,18 +1437,22 @@ class TestProjectNamesCache:
 
     def test_get_set(self, cache):
         assert cache.get() == dict()
-        s = {1: 1, 2: 2, 3: 3}
+        s = ProjectNames(["a", "B", "c"])
         cache.set(s, '"foo"')
-        s[4] = 4
-        assert cache.get() == s
+        assert cache.get() == dict(a="a", b="B", c="c")
         cache.add('Foo')
         assert 'foo' in cache.get()
+        assert cache.get()['foo'] == 'Foo'
+        # the previously returned data isn't changed
+        assert 'foo' not in s
+        cache.discard('foo')
+        assert 'foo' not in cache.get()
         cache.discard('foo')
         assert 'foo' not in cache.get()
 
     def test_is_expired(self, cache, monkeypatch):
         expiry_time = 100
-        s = {1: 1, 2: 2, 3: 3}
+        s = ProjectNames(["a", "b", "c"])
         assert cache.get_etag() is None
         cache.set(s, '"foo"')
         assert not cache.is_expired(expiry_time)
@@ -1447,6 +1463,114 @@ class TestProjectNamesCache:
         assert cache.get_etag() == '"foo"'
 
 
+class TestProjectNames:
+    def test_mapping(self):
+        names = ProjectNames(["Foo_Bar", "baz", "Zope", "ham.Spam"])
+        assert len(names) == 4
+        assert list(names) == ["baz", "foo-bar", "ham-spam", "zope"]
+        assert names["foo-bar"] == "Foo_Bar"
+        assert names["baz"] == "baz"
+        assert names["zope"] == "Zope"
+        assert "ham-spam" in names
+        assert "ham" not in names
+        assert "zzz" not in names
+        assert 1 not in names
+        with pytest.raises(KeyError):
+            names["Foo_Bar"]
+        assert dict(names) == {
+            "baz": "baz", "foo-bar": "Foo_Bar",
+            "ham-spam": "ham.Spam", "zope": "Zope"}
+        assert names == ProjectNames(["ham.Spam", "baz", "Foo_Bar", "Zope"])
+        assert names != ProjectNames(["ham.Spam", "baz", "foo-bar", "Zope"])
+        assert ProjectNames() == {}
+        # same concatenated keys and names, but split differently
+        assert ProjectNames(["ab", "c"]) != ProjectNames(["a", "bc"])
+
+    def test_iter_prefix(self):
+        names = ProjectNames(["pytest", "pytest-cov", "py", "pyramid", "zope"])
+        assert list(names.iter_prefix("pyt")) == ["pytest", "pytest-cov"]
+        assert list(names.iter_prefix("py")) == [
+            "py", "pyramid", "pytest", "pytest-cov"]
+        assert list(names.iter_prefix("x")) == []
+        names = names.with_name("pytest-Mock").without_name("pytest")
+        assert list(names.iter_prefix("pyt")) == ["pytest-cov", "pytest-mock"]
+
+    def test_changes(self, monkeypatch):
+        monkeypatch.setattr(ProjectNames, "MAX_OVERLAY", 2)
+        names = ProjectNames(["a", "c"])
+        assert names.with_name("a") is names
+        assert names.without_name("b") is names
+        changed = names.with_name("B").without_name("a")
+        assert list(names) == ["a", "c"]
+        assert list(changed) == ["b", "c"]
+        assert len(changed) == 2
+        assert changed["b"] == "B"
+        assert changed == ProjectNames(["B", "c"])
+        # reverting a change
+        assert changed.with_name("a")._changes == {"b": "B"}
+        # merging the overlay
+        changed = changed.with_name("D")
+        assert changed._changes == {}
+        assert list(changed.items()) == [("b", "B"), ("c", "c"), ("d", "D")]
+
+
+def test_parse_core_metadata():
+    from devpi_server.mirror import parse_core_metadata
+
+    assert parse_core_metadata(None) is None
+    assert parse_core_metadata(False) is None
+    assert parse_core_metadata("") is None
+    assert parse_core_metadata(True) is True
+    assert parse_core_metadata("true") is True
+    assert parse_core_metadata({}) is True
+    assert parse_core_metadata("sha256=abc") == "sha256=abc"
+    assert parse_core_metadata({"md5": "a", "sha256": "b"}) == "sha256=b"
+    assert parse_core_metadata({"md5": "a"}) == "md5=a"
+
+
+def test_parse_index_v1_json_core_metadata():
+    from devpi_server.mirror import parse_index_v1_json
+    import json
+
+    text = json.dumps({
+        "meta": {"api-version": "1.1"},
+        "files": [
+            {"filename": "pkg-1.0-py3-none-any.whl",
+             "url": "pkg-1.0-py3-none-any.whl",
+             "hashes": {}, "core-metadata": {"sha256": "abc"}},
+            {"filename": "pkg-1.1-py3-none-any.whl",
+             "url": "pkg-1.1-py3-none-any.whl",
+             "hashes": {}, "dist-info-metadata": True},
+            {"filename": "pkg-1.2.tar.gz",
+             "url": "pkg-1.2.tar.gz",
+             "hashes": {}}]})
+    links = parse_index_v1_json("https://pypi.org/simple/pkg/", text)
+    assert [x.core_metadata for x in links] == ["sha256=abc", True, None]
+
+
+def test_parse_size():
+    from devpi_server.mirror import parse_size
+
+    assert parse_size(100) == 100
+    assert parse_size("100") == 100
+    assert parse_size("1k") == 1024
+    assert parse_size("1.5M") == 1536 * 1024
+    assert parse_size("2GiB") == 2 << 30
+    assert parse_size(" 1 TB ") == 1 << 40
+    with pytest.raises(ValueError):
+        parse_size("foo")
+    with pytest.raises(ValueError):
+        parse_size("-1G")
+
+
+def test_mirror_cache_quota_indexconfig(pypistage):
+    assert pypistage.cache_quota is None
+    assert pypistage.normalize_indexconfig_value("mirror_cache_quota", "10G") == 10 << 30
+    assert pypistage.normalize_indexconfig_value("mirror_cache_quota", "") is None
+    with pytest.raises(pypistage.InvalidIndexconfig):
+        pypistage.normalize_indexconfig_value("mirror_cache_quota", "lots")
+
+
 def test_ProjectUpdateCache(monkeypatch):
     from devpi_server.normalized import normalize_name
 
@@ -1473,6 +1597,176 @@ def test_ProjectUpdateCache(monkeypatch):
     assert x.get_etag(normalize_name("y")) is None
 
 
+def test_ProjectUpdateCache_not_found(monkeypatch):
+    from devpi_server.normalized import normalize_name
+
+    x = ProjectUpdateCache(not_found_size=2)
+    (a, b, c) = (normalize_name(n) for n in "abc")
+    assert not x.is_not_found(a)
+    x.set_not_found(a, 30)
+    x.set_not_found(b, 60)
+    assert x.is_not_found(a)
+    assert x.is_not_found(b)
+    assert x.get_timestamp(a) > 0
+    t = time.time() + 35
+    monkeypatch.setattr("time.time", lambda: t)
+    assert not x.is_not_found(a)
+    assert x.is_not_found(b)
+    # the size is bounded
+    x.set_not_found(c, 30)
+    assert len(x.not_found_cache.data) == 2
+    assert x.not_found_cache.evictions == 1
+    # finding the project again removes it from the cache
+    x.refresh(b, None)
+    assert not x.is_not_found(b)
+    x.expire(c)
+    assert not x.is_not_found(c)
+    assert x.get_timestamp(c) == -1
+    # can be disabled
+    x = ProjectUpdateCache(not_found_size=0)
+    x.set_not_found(a, 30)
+    assert not x.is_not_found(a)
+    assert x.get_timestamp(a) == -1
+
+
+@pytest.mark.notransaction
+def test_not_found_expiry(pypistage):
+    pypistage.mock_simple_projects([])
+    pypistage.ixconfig["mirror_not_found_expiry"] = 0
+    retrieve_times = pypistage.cache_retrieve_times
+    retrieve_times.expire("foo")
+    with pypistage.keyfs.read_transaction():
+        with pytest.raises(pypistage.UpstreamNotFoundError):
+            pypistage.get_simplelinks_perstage("foo")
+    assert not retrieve_times.is_not_found("foo")
+    pypistage.ixconfig["mirror_not_found_expiry"] = 600
+    with pypistage.keyfs.read_transaction():
+        with pytest.raises(pypistage.UpstreamNotFoundError):
+            pypistage.get_simplelinks_perstage("foo")
+    assert retrieve_times.is_not_found("foo")
+
+
+def test_not_found_cache_metrics(pypistage):
+    from devpi_server.mirror import devpiserver_metrics
+
+    class Request:
+        registry = dict(xom=pypistage.xom)
+
+    pypistage.cache_retrieve_times.set_not_found("foo", 600)
+    assert pypistage.cache_retrieve_times.is_not_found("foo")
+    assert not pypistage.cache_retrieve_times.is_not_found("bar")
+    metrics = {x[0]: x[2] for x in devpiserver_metrics(Request())}
+    assert metrics["devpi_server_mirror_not_found_cache_hits"] == 1
+    assert metrics["devpi_server_mirror_not_found_cache_misses"] == 1
+    assert metrics["devpi_server_mirror_not_found_cache_lookups"] == 2
+    assert metrics["devpi_server_mirror_not_found_cache_items"] == 1
+    assert metrics["devpi_server_mirror_not_found_cache_evictions"] == 0
+
+
+def test_ProjectAccessCounts(monkeypatch):
+    from devpi_server.normalized import normalize_name
+
+    x = ProjectAccessCounts()
+    for project in ("a", "b", "b", "c", "c", "c", "c"):
+        x.hit(normalize_name(project))
+    assert x.most_common(2, half_life=30) == ["c", "b"]
+    t = time.monotonic() + 35
+    monkeypatch.setattr("time.monotonic", lambda: t)
+    # the counts are halved after the half life
+    assert x.most_common(3, half_life=30) == ["c", "b", "a"]
+    assert x.most_common(3, half_life=30) == ["c", "b"]
+    for project in ("a", "a", "a"):
+        x.hit(normalize_name(project))
+    assert x.most_common(1, half_life=30) == ["a"]
+
+
+@pytest.mark.notransaction
+def test_refresh_hot_projects(devpiserver_makepypistage, makexom):
+    xom = makexom(["--mirror-refresh-hot-projects", "1"])
+    pypistage = devpiserver_makepypistage(xom)
+    pypistage.mock_simple("pkg", text='<a href="pkg-1.0.zip"</a>')
+    pypistage.mock_simple("other", text='<a href="other-1.0.zip"</a>')
+    with xom.keyfs.read_transaction():
+        assert len(pypistage.get_releaselinks("pkg")) == 1
+        assert len(pypistage.get_releaselinks("pkg")) == 1
+        assert len(pypistage.get_releaselinks("other")) == 1
+    # nothing to do while the cache is fresh
+    with xom.keyfs.read_transaction():
+        assert pypistage.refresh_hot_projects(1, 60) == []
+    pypistage.mock_simple("pkg", text='<a href="pkg-1.0.zip"</a><a href="pkg-2.0.zip"</a>')
+    # simulate the cache expiring soon for both projects
+    retrieve_times = pypistage.cache_retrieve_times._project2time
+    for project in ("pkg", "other"):
+        retrieve_times[project] = (time.time() - pypistage.cache_expiry + 30, None)
+    serial = xom.keyfs.get_current_serial()
+    with xom.keyfs.read_transaction():
+        assert pypistage.refresh_hot_projects(1, 60) == ["pkg"]
+    xom.keyfs.wait_tx_serial(serial + 1)
+    with xom.keyfs.read_transaction():
+        assert sorted(
+            x.version for x in pypistage.get_releaselinks("pkg")) == ["1.0", "2.0"]
+
+
+@pytest.mark.notransaction
+def test_refresh_simplelinks_releases_lock_on_error(monkeypatch, pypistage):
+    pypistage.mock_simple("pkg", text='<a href="pkg-1.0.zip"</a>')
+    with pypistage.keyfs.read_transaction():
+        assert len(pypistage.get_releaselinks("pkg")) == 1
+
+    locks = []
+
+    def _load_cache_links(project):
+        locks.append(pypistage.cache_retrieve_times._project2lock[project])
+        raise ValueError
+
+    monkeypatch.setattr(pypistage, "_load_cache_links", _load_cache_links)
+    with pytest.raises(ValueError), pypistage.keyfs.read_transaction():  # noqa: PT011
+        pypistage.refresh_simplelinks_perstage("pkg")
+    (lock,) = locks
+    assert not lock.locked()
+
+
+@pytest.mark.notransaction
+def test_update_from_changelog(pypistage):
+    import xmlrpc.client
+
+    changelog_url = "https://pypi.org/pypi"
+    with pytest.raises(pypistage.InvalidIndexconfig):
+        pypistage.normalize_indexconfig_value("mirror_changelog_url", "pypi.org")
+    pypistage.ixconfig["mirror_changelog_url"] = changelog_url
+
+    def mock_changelog(result):
+        pypistage.xom.http.add(
+            changelog_url,
+            text=xmlrpc.client.dumps(
+                (result,), methodresponse=True, allow_none=True))
+
+    pypistage.mock_simple("pkg", text='<a href="pkg-1.0.zip"</a>', pypiserial=10)
+    pypistage.mock_simple("other", text='<a href="other-1.0.zip"</a>', pypiserial=20)
+    with pypistage.keyfs.read_transaction():
+        assert len(pypistage.get_releaselinks("pkg")) == 1
+        assert len(pypistage.get_releaselinks("other")) == 1
+    mock_changelog(15)
+    with pypistage.keyfs.read_transaction():
+        assert pypistage.update_from_changelog() == []
+    assert pypistage.cache_changelog.serial == 15
+    (call,) = [x for x in pypistage.xom.http.call_log if x["url"] == changelog_url]
+    assert xmlrpc.client.loads(call["kw"]["content"]) == ((), "changelog_last_serial")
+    mock_changelog([
+        ["pkg", "2.0", 1700000000, "new release", 16],
+        ["other", "1.0", 1700000001, "add source file", 17],
+        ["unknown", None, 1700000002, "create", 18]])
+    with pypistage.keyfs.read_transaction():
+        assert pypistage.update_from_changelog() == ["pkg"]
+        assert pypistage.cache_changelog.serial == 18
+        assert pypistage.cache_retrieve_times.is_expired("pkg", pypistage.cache_expiry)
+        assert not pypistage.cache_retrieve_times.is_expired("other", pypistage.cache_expiry)
+    pypistage.xom.http.add(changelog_url, status_code=500)
+    with pypistage.keyfs.read_transaction(), pytest.raises(pypistage.UpstreamError):
+        pypistage.update_from_changelog()
+    assert pypistage.cache_changelog.serial == 18
+
+
 @pytest.mark.notransaction
 @pytest.mark.nomocking
 def test_cleanup_after_last_entry_deletion(mapp, simpypi):
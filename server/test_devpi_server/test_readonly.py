@@ -1,7 +1,10 @@
 from collections.abc import Mapping
 from collections.abc import Sequence
 from collections.abc import Set  # noqa: PYI025
+from devpi_server.readonly import CopyOnWriteDict
 from devpi_server.readonly import ensure_deeply_readonly
+from devpi_server.readonly import get_detached_copy
+from devpi_server.readonly import get_mutable_copy_on_write
 from devpi_server.readonly import get_mutable_deepcopy
 from devpi_server.readonly import is_deeply_readonly
 from devpi_server.readonly import is_sequence
@@ -154,3 +157,80 @@ def test_is_sequence() -> None:
     assert is_sequence(())
     assert is_sequence(ensure_deeply_readonly(()))
     assert is_sequence(ensure_deeply_readonly([]))
+
+
+class TestCopyOnWrite:
+    @pytest.fixture
+    def data(self) -> dict:
+        return {
+            "a": {"x": [1]},
+            "b": [{"y": 1}, ("z", 2)],
+            "c": "c",
+            "d": (("t", 1),)}
+
+    def test_shares_until_accessed(self, data: dict) -> None:
+        c = get_mutable_copy_on_write(ensure_deeply_readonly(data))
+        assert isinstance(c, CopyOnWriteDict)
+        assert c == data
+        assert dict.__getitem__(c, "a") is data["a"]
+        # deeply immutable values are always shared
+        assert c["d"] is data["d"]
+        c["a"]["x"].append(2)
+        assert c["a"] == {"x": [1, 2]}
+        assert data["a"] == {"x": [1]}
+        assert dict.__getitem__(c, "b") is data["b"]
+        c["b"][0]["y"] = 2
+        c["b"][1] = None
+        assert data["b"] == [{"y": 1}, ("z", 2)]
+
+    @pytest.mark.parametrize("access", [
+        lambda c: c.copy()["a"],
+        lambda c: dict(c)["a"],
+        lambda c: {**c}["a"],
+        lambda c: (c | {})["a"],
+        lambda c: c.get("a"),
+        lambda c: c.pop("a"),
+        lambda c: c.popitem()[1],
+        lambda c: c.setdefault("a", None),
+        lambda c: dict(c.items())["a"],
+        lambda c: next(iter(c.values())),
+        lambda c: get_mutable_deepcopy(c)["a"],
+        lambda c: get_mutable_copy_on_write(c)["a"],
+    ])
+    def test_no_shared_data_exposed(self, access) -> None:
+        data = {"a": {"x": [1]}}
+        c = get_mutable_copy_on_write(ensure_deeply_readonly(data))
+        access(c)["x"].append(2)
+        assert data == {"a": {"x": [1]}}
+
+    def test_copy_of_modified(self, data: dict) -> None:
+        c1 = get_mutable_copy_on_write(ensure_deeply_readonly(data))
+        c1["a"]["x"].append(2)
+        c2 = get_mutable_copy_on_write(c1)
+        c1["a"]["x"].append(3)
+        assert c2["a"] == {"x": [1, 2]}
+        assert dict.__getitem__(c2, "b") is data["b"]
+
+    def test_detached_copy(self, data: dict) -> None:
+        c = get_mutable_copy_on_write(ensure_deeply_readonly(data))
+        c["a"]["x"].append(2)
+        c["e"] = {"new": [1]}
+        d = get_detached_copy(c)
+        assert type(d) is dict
+        assert d == dict(data, a={"x": [1, 2]}, e={"new": [1]})
+        # values which weren't accessed are still shared
+        assert d["b"] is data["b"]
+        c["a"]["x"].append(3)
+        c["e"]["new"].append(2)
+        assert d["a"] == {"x": [1, 2]}
+        assert d["e"] == {"new": [1]}
+
+    def test_update_and_delete(self, data: dict) -> None:
+        c = get_mutable_copy_on_write(ensure_deeply_readonly(data))
+        new = {"x": []}
+        c.update(a=new)
+        del c["b"]
+        new["x"].append(1)
+        assert c == {"a": {"x": [1]}, "c": "c", "d": (("t", 1),)}
+        c.clear()
+        assert c == {}
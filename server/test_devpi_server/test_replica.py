@@ -1,6 +1,7 @@
 from devpi_server.filestore import get_hashes
 from devpi_server.fileutil import LoadError
 from devpi_server.fileutil import dumps
+from devpi_server.fileutil import load
 from devpi_server.fileutil import loads
 from devpi_server.keyfs import MissingFileException
 from devpi_server.keyfs_types import FilePathInfo
@@ -12,6 +13,7 @@ from devpi_server.replica import H_EXPECTED_MASTER_ID
 from devpi_server.replica import H_EXPECTED_PRIMARY_ID
 from devpi_server.replica import H_MASTER_UUID
 from devpi_server.replica import H_PRIMARY_UUID
+from devpi_server.replica import H_REPLICA_FILEREPL
 from devpi_server.replica import H_REPLICA_OUTSIDE_URL
 from devpi_server.replica import H_REPLICA_UUID
 from devpi_server.replica import PrimaryChangelogRequest
@@ -20,6 +22,7 @@ from devpi_server.views import iter_remote_file_replica
 from pyramid.httpexceptions import HTTPNotFound
 import os
 import pytest
+import zlib
 
 
 pytestmark = [pytest.mark.notransaction]
@@ -163,6 +166,7 @@ class TestMultiChangelog:
     def test_accept_header(self, testapp):
         from devpi_server.replica import REPLICA_ACCEPT_STREAMING
         from devpi_server.replica import REPLICA_CONTENT_TYPE
+        from devpi_server.replica import REPLICA_STORED_CONTENT_TYPE
 
         r = testapp.get("/+changelog/0-")
         assert r.content_type == "application/octet-stream"
@@ -172,8 +176,10 @@ class TestMultiChangelog:
         assert r.content_type == "application/octet-stream"
         r = testapp.get("/+changelog/0-", headers={"Accept": REPLICA_CONTENT_TYPE})
         assert r.content_type == REPLICA_CONTENT_TYPE
+        r = testapp.get("/+changelog/0-", headers={"Accept": REPLICA_STORED_CONTENT_TYPE})
+        assert r.content_type == REPLICA_STORED_CONTENT_TYPE
         r = testapp.get("/+changelog/0-", headers={"Accept": REPLICA_ACCEPT_STREAMING})
-        assert r.content_type == REPLICA_CONTENT_TYPE
+        assert r.content_type == REPLICA_STORED_CONTENT_TYPE
 
     @pytest.mark.usefixtures("noiter")
     def test_multiple_changes(self, mapp, reqchangelogs, testapp):
@@ -190,6 +196,119 @@ class TestMultiChangelog:
         assert "this/.config" in str(data[-2])
         assert "that/.config" in str(data[-1])
 
+    @pytest.mark.usefixtures("noiter")
+    def test_stored_changes(self, auth_serializer, makexom, mapp, testapp):
+        from devpi_server.fileutil import ZLIB_ENTRY_TAG
+        from devpi_server.replica import REPLICA_STORED_CONTENT_TYPE
+
+        xom = testapp.xom
+        xom.keyfs._storage.compress_changelog = True
+        xom.keyfs._storage.indexed_changelog = True
+        mapp.create_and_login_user("this", password="p")
+        mapp.create_index("this/dev")
+        latest_serial = self.get_latest_serial(testapp)
+        with xom.keyfs.get_connection() as conn:
+            stored = conn.get_stored_changelog_entry(latest_serial)
+            assert stored.startswith(ZLIB_ENTRY_TAG)
+            assert loads(conn.get_raw_changelog_entry(latest_serial))
+        token = auth_serializer.dumps(self.replica_uuid)
+        r = testapp.get("/+changelog/0-", headers={
+            H_REPLICA_UUID: self.replica_uuid,
+            H_REPLICA_OUTSIDE_URL: self.replica_url,
+            'Authorization': 'Bearer %s' % token,
+            "Accept": REPLICA_STORED_CONTENT_TYPE})
+        assert r.content_type == REPLICA_STORED_CONTENT_TYPE
+        # the compressed entry is sent as is
+        assert stored in r.body
+
+        class FakeResponse:
+            headers = {"content-type": r.content_type}
+
+            def iter_bytes(self, chunk_size):
+                for i in range(0, len(r.body), chunk_size):
+                    yield r.body[i:i + chunk_size]
+
+            def close(self):
+                pass
+
+        replica_xom = makexom(["--primary-url=http://localhost"])
+        replica_xom.replica_thread.handler_multi(FakeResponse())
+        assert replica_xom.keyfs.get_current_serial() == latest_serial
+        with replica_xom.keyfs.get_connection() as conn:
+            assert conn.get_raw_changelog_entry(
+                latest_serial) == get_raw_changelog_entry(xom, latest_serial)
+
+    def get_raw_response(self, auth_serializer, testapp, url, **headers):
+        # webtest would decode the content encoding
+        from webob import Request
+
+        token = auth_serializer.dumps(self.replica_uuid)
+        req = Request.blank(url, headers={
+            **testapp.headers,
+            H_REPLICA_UUID: self.replica_uuid,
+            H_REPLICA_OUTSIDE_URL: self.replica_url,
+            'Authorization': 'Bearer %s' % token,
+            **headers})
+        return req.get_response(testapp.app)
+
+    @pytest.mark.parametrize("encoding", ["gzip", "deflate"])
+    def test_multiple_changes_compressed(self, auth_serializer, encoding, mapp, testapp):
+        mapp.create_user("this", password="p")
+        latest_serial = self.get_latest_serial(testapp)
+        plain = self.get_raw_response(auth_serializer, testapp, "/+changelog/0-")
+        assert plain.status_code == 200
+        assert "Content-Encoding" not in plain.headers
+        r = self.get_raw_response(
+            auth_serializer, testapp, "/+changelog/0-",
+            **{"Accept-Encoding": encoding})
+        assert r.headers["Content-Encoding"] == encoding
+        assert "Accept-Encoding" in r.headers["Vary"]
+        assert int(r.headers['X-DEVPI-SERIAL']) == latest_serial
+        body = zlib.decompress(r.body, 31 if encoding == "gzip" else 15)
+        assert body == plain.body
+        assert len(loads(body)) == (latest_serial + 1)
+
+    def test_multiple_changes_compression_disabled(self, auth_serializer, testapp):
+        testapp.xom.config.args.replication_compression_level = 0
+        r = self.get_raw_response(
+            auth_serializer, testapp, "/+changelog/0-",
+            **{"Accept-Encoding": "gzip"})
+        assert r.status_code == 200
+        assert "Content-Encoding" not in r.headers
+
+    def test_streaming_changes_compressed(
+            self, auth_serializer, makexom, mapp, testapp):
+        from devpi_server.replica import REPLICA_CONTENT_TYPE
+        from devpi_server.replica import iter_decompressed
+
+        mapp.create_and_login_user("this", password="p")
+        mapp.create_index("this/dev")
+        latest_serial = self.get_latest_serial(testapp)
+        r = self.get_raw_response(
+            auth_serializer, testapp, "/+changelog/0-",
+            **{"Accept": REPLICA_CONTENT_TYPE,
+               "Accept-Encoding": "gzip;q=0.5, deflate"})
+        assert r.content_type == REPLICA_CONTENT_TYPE
+        assert r.headers["Content-Encoding"] == "deflate"
+        body = r.body
+
+        class FakeResponse:
+            headers = {"content-type": r.content_type}
+
+            def iter_bytes(self, chunk_size):
+                # httpx decodes the content encoding on the fly
+                chunks = (
+                    body[i:i + chunk_size]
+                    for i in range(0, len(body), chunk_size))
+                return iter_decompressed(chunks)
+
+            def close(self):
+                pass
+
+        replica_xom = makexom(["--primary-url=http://localhost"])
+        replica_xom.replica_thread.handler_multi(FakeResponse())
+        assert replica_xom.keyfs.get_current_serial() == latest_serial
+
     @pytest.mark.usefixtures("noiter")
     def test_size_limit(self, mapp, monkeypatch, reqchangelogs, testapp):
         monkeypatch.setattr(PrimaryChangelogRequest, "MAX_REPLICA_CHANGES_SIZE", 1024)
@@ -205,6 +324,287 @@ class TestMultiChangelog:
         assert len(data) < latest_serial
 
 
+class TestChangelogSnapshot:
+    replica_uuid = "111"
+    replica_url = "http://qwe"
+
+    @pytest.fixture
+    def reqsnapshot(self, auth_serializer, testapp):
+        def reqsnapshot(code=200):
+            token = auth_serializer.dumps(self.replica_uuid)
+            req_headers = {H_REPLICA_UUID: self.replica_uuid,
+                           H_REPLICA_OUTSIDE_URL: self.replica_url,
+                           'Authorization': 'Bearer %s' % token}
+            return testapp.xget(code, "/+changelog/+snapshot", headers=req_headers)
+        return reqsnapshot
+
+    def get_snapshot_state(self, keyfs, serial):
+        from devpi_server.replica import iter_snapshot_items
+
+        with keyfs.read_transaction(at_serial=serial) as tx:
+            return sorted(
+                (relpath, keyname, repr(val))
+                for relpath, keyname, val in iter_snapshot_items(tx))
+
+    def test_no_snapshot(self, reqsnapshot):
+        reqsnapshot(404)
+
+    @pytest.mark.usefixtures("noiter")
+    def test_snapshot(self, makexom, mapp, reqsnapshot, testapp):
+        from devpi_server.replica import CHANGELOG_SNAPSHOT_FILENAME
+        from devpi_server.replica import REPLICA_SNAPSHOT_CONTENT_TYPE
+        from devpi_server.replica import read_changelog_snapshot_serial
+        from devpi_server.replica import write_changelog_snapshot
+
+        xom = testapp.xom
+        mapp.create_and_login_user("this", password="p")
+        mapp.create_index("this/dev")
+        mapp.upload_file_pypi("pkg-1.0.tar.gz", b"123", "pkg", "1.0")
+        path = xom.config.server_path / CHANGELOG_SNAPSHOT_FILENAME
+        snapshot_serial = write_changelog_snapshot(xom.keyfs, path)
+        assert snapshot_serial == xom.keyfs.get_current_serial()
+        assert read_changelog_snapshot_serial(path) == snapshot_serial
+        # changes after the snapshot must not affect it
+        mapp.delete_index("this/dev")
+        mapp.create_index("this/prod")
+        r = reqsnapshot()
+        assert r.content_type == REPLICA_SNAPSHOT_CONTENT_TYPE
+        assert int(r.headers["X-DEVPI-SERIAL"]) == snapshot_serial
+
+        class FakeResponse:
+            def iter_bytes(self, chunk_size):
+                for i in range(0, len(r.body), chunk_size):
+                    yield r.body[i:i + chunk_size]
+
+            def close(self):
+                pass
+
+        replica_xom = makexom([
+            "--primary-url=http://localhost", "--replica-snapshot"])
+        replica_xom.replica_thread.handler_snapshot(FakeResponse())
+        assert replica_xom.keyfs.get_current_serial() == snapshot_serial
+        state = self.get_snapshot_state(xom.keyfs, snapshot_serial)
+        assert any(x[0].startswith("this/dev/") for x in state)
+        assert state == self.get_snapshot_state(
+            replica_xom.keyfs, snapshot_serial)
+        # the remaining changes can be imported on top of the snapshot
+        current_serial = xom.keyfs.get_current_serial()
+        for serial in range(snapshot_serial + 1, current_serial + 1):
+            with xom.keyfs._storage.get_connection() as conn:
+                changes = conn.get_changes(serial)
+            replica_xom.keyfs.import_changes(serial, changes)
+        assert replica_xom.keyfs.get_current_serial() == current_serial
+        assert self.get_snapshot_state(
+            xom.keyfs, current_serial) == self.get_snapshot_state(
+            replica_xom.keyfs, current_serial)
+        # keys changed after the snapshot continue their local history
+        with replica_xom.keyfs.read_transaction() as tx:
+            key = replica_xom.keyfs.get_key_instance(
+                "USER", "this/.config")
+            serials = [
+                serial for serial, _val in tx.iter_serial_and_value_backwards(
+                    key.relpath, current_serial)]
+        assert serials[0] > snapshot_serial
+        assert serials[-1] == snapshot_serial
+
+
+class TestReplicaFiles:
+    replica_uuid = "111"
+
+    @pytest.fixture
+    def reqfiles(self, auth_serializer, testapp):
+        def reqfiles(body, code=200, *, auth=True):
+            from devpi_server.replica import REPLICA_FILES_CONTENT_TYPE
+
+            req_headers = {
+                H_REPLICA_UUID: self.replica_uuid,
+                "Content-Type": REPLICA_FILES_CONTENT_TYPE}
+            if auth:
+                token = auth_serializer.dumps(self.replica_uuid)
+                req_headers["Authorization"] = "Bearer %s" % token
+            return testapp.post(
+                "/+replica-files", body, headers=req_headers,
+                status=code)
+        return reqfiles
+
+    def iter_frames(self, body):
+        from io import BytesIO
+
+        f = BytesIO(body)
+        while f.tell() < len(body):
+            (relpath, status, size, hashes) = load(f)
+            yield (relpath, status, hashes, f.read(size) if status == 200 else None)
+
+    def get_relpaths(self, xom, stagename, project):
+        with xom.keyfs.read_transaction():
+            stage = xom.model.getstage(stagename)
+            return {
+                link.basename: link.relpath
+                for link in stage.get_releaselinks(project)}
+
+    @pytest.mark.usefixtures("noiter")
+    def test_files(self, mapp, monkeypatch, reqfiles, testapp):
+        from devpi_server.replica import REPLICA_FILES_CONTENT_TYPE
+
+        mapp.create_and_login_user("this", password="p")
+        mapp.create_index("this/dev")
+        mapp.upload_file_pypi("pkg-1.0.tar.gz", b"123", "pkg", "1.0")
+        mapp.upload_file_pypi("pkg-1.1.tar.gz", b"12345", "pkg", "1.1")
+        relpaths = self.get_relpaths(testapp.xom, "this/dev", "pkg")
+        missing = "this/dev/+f/123/4567890abcdef/pkg-0.1.tar.gz"
+        monkeypatch.setattr(
+            PrimaryChangelogRequest, "MAX_REPLICA_FILES_BATCH_FILE_SIZE", 4)
+        r = reqfiles(dumps([
+            relpaths["pkg-1.1.tar.gz"], missing, relpaths["pkg-1.0.tar.gz"]]))
+        assert r.content_type == REPLICA_FILES_CONTENT_TYPE
+        frames = list(self.iter_frames(r.body))
+        assert [x[:2] for x in frames] == [
+            (relpaths["pkg-1.1.tar.gz"], 413),
+            (missing, 404),
+            (relpaths["pkg-1.0.tar.gz"], 200)]
+        (_relpath, _status, hashes, content) = frames[2]
+        assert content == b"123"
+        assert hashes == dict(get_hashes(b"123"))
+
+    def test_requires_replica(self, reqfiles):
+        r = reqfiles(dumps([]), code=403, auth=False)
+        assert "Only replicas" in r.text
+
+    def test_bad_request(self, monkeypatch, reqfiles):
+        reqfiles(b"foo", code=400)
+        reqfiles(dumps({"foo": "bar"}), code=400)
+        monkeypatch.setattr(PrimaryChangelogRequest, "MAX_REPLICA_FILES_BATCH", 1)
+        reqfiles(dumps(["foo", "bar"]), code=400)
+
+    def test_not_on_replica(self, maketestapp, replica_xom, reqfiles):
+        testapp = maketestapp(replica_xom)
+        r = testapp.post("/+replica-files", dumps([]), status=403)
+        assert "Replication protocol disabled" in r.text
+
+
+class TestServeReplication:
+    replica_uuid = "222"
+
+    @pytest.fixture
+    def serving_xom(self, makexom, secretfile):
+        # files are fetched on demand in these tests
+        return makexom([
+            "--primary-url", "http://localhost",
+            "--serve-replication",
+            "--file-replication-skip-indexes", "all",
+            "--secretfile", secretfile])
+
+    @pytest.fixture
+    def serving_app(self, maketestapp, serving_xom, xom):
+        replay(xom, serving_xom, events=False)
+        serving_xom.config.set_primary_uuid(xom.config.get_primary_uuid())
+        testapp = maketestapp(serving_xom)
+        testapp.set_header_default(
+            H_EXPECTED_PRIMARY_ID, xom.config.get_primary_uuid())
+        return testapp
+
+    def get_headers(self, xom):
+        import itsdangerous
+
+        auth_serializer = itsdangerous.TimedSerializer(
+            xom.config.get_replica_secret())
+        token = auth_serializer.dumps(self.replica_uuid)
+        return {
+            H_REPLICA_UUID: self.replica_uuid,
+            "Authorization": "Bearer %s" % token}
+
+    def test_option(self, serving_xom, replica_xom, xom):
+        assert serving_xom.config.serve_replication is True
+        assert replica_xom.config.serve_replication is False
+        assert xom.config.serve_replication is False
+
+    def test_changelog(self, mapp, serving_app, serving_xom, xom):
+        mapp.create_and_login_user("this", password="p")
+        replay(xom, serving_xom, events=False)
+        latest_serial = xom.keyfs.get_current_serial()
+        r = serving_app.get(
+            "/+changelog/0-", headers=self.get_headers(serving_xom))
+        assert r.status_code == 200
+        assert int(r.headers["X-DEVPI-SERIAL"]) == latest_serial
+        # downstream replicas get the UUID of the primary
+        assert r.headers[H_PRIMARY_UUID] == xom.config.get_primary_uuid()
+        assert [x[0] for x in loads(r.body)] == list(range(latest_serial + 1))
+        r = serving_app.get(
+            "/+changelog/%s" % latest_serial,
+            headers=self.get_headers(serving_xom))
+        assert r.body == get_raw_changelog_entry(xom, latest_serial)
+        assert self.replica_uuid in serving_xom.polling_replicas
+
+    def test_wrong_primary_uuid(self, serving_app, serving_xom):
+        serving_app.xget(400, "/+changelog/0", headers={
+            H_EXPECTED_PRIMARY_ID: "foo",
+            **self.get_headers(serving_xom)})
+
+    def test_primary_uuid_unknown(self, maketestapp, serving_xom):
+        testapp = maketestapp(serving_xom)
+        r = testapp.xget(
+            503, "/+changelog/0", headers={
+                H_EXPECTED_PRIMARY_ID: "",
+                **self.get_headers(serving_xom)})
+        assert "Primary UUID not known" in r.text
+
+    @pytest.mark.usefixtures("noiter")
+    def test_replica_files(self, mapp, serving_app, serving_xom, xom):
+        from devpi_server.replica import REPLICA_FILES_CONTENT_TYPE
+
+        mapp.create_and_login_user("this", password="p")
+        mapp.create_index("this/dev")
+        mapp.upload_file_pypi("pkg-1.0.tar.gz", b"123", "pkg", "1.0")
+        replay(xom, serving_xom, events=False)
+        with xom.keyfs.read_transaction():
+            (link,) = xom.model.getstage("this/dev").get_releaselinks("pkg")
+        # the file isn't replicated to the serving replica yet
+        r = serving_app.post(
+            "/+replica-files", dumps([link.relpath]),
+            headers={
+                "Content-Type": REPLICA_FILES_CONTENT_TYPE,
+                **self.get_headers(serving_xom)})
+        assert loads(r.body) == (link.relpath, 404, 0, {})
+
+    @pytest.mark.usefixtures("noiter")
+    def test_changelog_before_snapshot(
+            self, makexom, mapp, maketestapp, secretfile, xom):
+        from devpi_server.replica import write_changelog_snapshot
+
+        mapp.create_and_login_user("this", password="p")
+        mapp.create_index("this/dev")
+        path = xom.config.server_path / "snapshot"
+        snapshot_serial = write_changelog_snapshot(xom.keyfs, path)
+        body = path.read_bytes()
+
+        class FakeResponse:
+            def iter_bytes(self, chunk_size):
+                for i in range(0, len(body), chunk_size):
+                    yield body[i:i + chunk_size]
+
+            def close(self):
+                pass
+
+        serving_xom = makexom([
+            "--primary-url", "http://localhost", "--serve-replication",
+            "--replica-snapshot", "--secretfile", secretfile])
+        serving_xom.replica_thread.handler_snapshot(FakeResponse())
+        serving_xom.config.set_primary_uuid(xom.config.get_primary_uuid())
+        testapp = maketestapp(serving_xom)
+        testapp.set_header_default(
+            H_EXPECTED_PRIMARY_ID, xom.config.get_primary_uuid())
+        headers = self.get_headers(serving_xom)
+        r = testapp.xget(404, "/+changelog/0-", headers=headers)
+        assert "changelog entry 0 not available" in r.text
+        testapp.xget(404, "/+changelog/0", headers=headers)
+        testapp.xget(200, "/+changelog/%s" % snapshot_serial, headers=headers)
+        # downstream replicas get a snapshot of the serving replica
+        testapp.xget(404, "/+changelog/+snapshot", headers=headers)
+        serving_xom.changelog_snapshot_thread.tick()
+        r = testapp.xget(200, "/+changelog/+snapshot", headers=headers)
+        assert int(r.headers["X-DEVPI-SERIAL"]) == snapshot_serial
+
+
 def get_raw_changelog_entry(xom, serial):
     with xom.keyfs._storage.get_connection() as conn:
         return conn.get_raw_changelog_entry(serial)
@@ -271,6 +671,18 @@ class TestReplicaThread:
         (call,) = stream.call_args_list
         assert "Accept" not in call.kwargs["extra_headers"]
 
+    def test_snapshot_retried(self, makexom, monkeypatch):
+        xom = makexom(["--primary-url=http://localhost", "--replica-snapshot"])
+        rt = xom.replica_thread
+        calls = []
+        monkeypatch.setattr(rt, "fetch_snapshot", lambda: calls.append("snapshot"))
+        monkeypatch.setattr(rt, "fetch_multi", lambda serial: calls.append(serial))
+        monkeypatch.setattr(rt.thread, "sleep", lambda _x: None)
+        rt.tick()
+        rt.tick()
+        # an upstream replica might not have a snapshot yet
+        assert calls == ["snapshot", 0, "snapshot", 0]
+
     def test_thread_run_fail(self, rt, mockchangelog, caplog):
         rt.thread.sleep = lambda _x: 0 / 0
         mockchangelog(0, code=404)
@@ -1159,6 +1571,396 @@ class TestFileReplication:
         assert list(replication_errors.errors.keys()) == []
 
 
+class TestFileReplicationBatch:
+    @pytest.fixture
+    def replica_xom(self, makexom, secretfile):
+        replica_xom = makexom([
+            "--primary-url", "http://localhost",
+            "--file-replication-threads", "1",
+            "--file-replication-batch-size", "10",
+            "--secretfile", secretfile])
+        (replica_xom.frt,) = replica_xom.replica_thread.file_replication_threads
+        return replica_xom
+
+    @pytest.fixture
+    def upload_files(self, mapp, xom):
+        def upload_files():
+            mapp.create_and_use()
+            contents = {}
+            for i in range(3):
+                basename = f"hello-1.{i}.tar.gz"
+                contents[basename] = mapp.makepkg(
+                    basename, b"content%d" % i, "hello", f"1.{i}")
+                mapp.upload_file_pypi(
+                    basename, contents[basename], "hello", f"1.{i}")
+            with xom.keyfs.read_transaction():
+                stage = xom.model.getstage(mapp.current_stage)
+                return {
+                    link.relpath: contents[link.basename]
+                    for link in stage.get_releaselinks("hello")}
+        return upload_files
+
+    def replay(self, monkeypatch, xom, replica_xom):
+        # don't wait for the queue, we process it in the test
+        monkeypatch.setattr(
+            replica_xom.replica_thread, "wait", lambda error_queue=False: None)
+        replay(xom, replica_xom, events=False)
+
+    def process_batch(self, replica_xom):
+        shared_data = replica_xom.replica_thread.shared_data
+        shared_data.process_next_batch(
+            shared_data.file_batch_size,
+            replica_xom.frt.handler,
+            replica_xom.frt.fetch_batch)
+
+    def assert_files(self, replica_xom, files):
+        with replica_xom.keyfs.read_transaction():
+            for relpath, content in files.items():
+                r_entry = replica_xom.filestore.get_file_entry(relpath)
+                assert r_entry.file_get_content() == content
+
+    @pytest.mark.usefixtures("noiter")
+    def test_fetch_batch(
+            self, auth_serializer, monkeypatch, replica_xom, testapp,
+            upload_files, xom):
+        files = upload_files()
+        calls = []
+
+        class FakeResponse:
+            def __init__(self, r):
+                self.status_code = r.status_code
+                self.reason_phrase = r.status
+                self.url = r.request.url
+                self.body = r.body
+
+            def iter_bytes(self, chunk_size):
+                for i in range(0, len(self.body), chunk_size):
+                    yield self.body[i:i + chunk_size]
+
+        class FakeHTTP:
+            def stream(self, cstack, method, url, *, content=None, **kw):
+                calls.append((method, url))
+                token = auth_serializer.dumps("111")
+                r = testapp.request(
+                    url.removeprefix("http://localhost"),
+                    method=method, body=content, headers={
+                        H_REPLICA_UUID: "111",
+                        "Authorization": "Bearer %s" % token,
+                        **testapp.headers,
+                        **kw["extra_headers"]})
+                return FakeResponse(r)
+
+        monkeypatch.setattr(replica_xom.frt, "http", FakeHTTP())
+        self.replay(monkeypatch, xom, replica_xom)
+        assert replica_xom.replica_thread.shared_data.queue.qsize() == 3
+        self.process_batch(replica_xom)
+        assert calls == [("POST", "http://localhost/+replica-files")]
+        self.assert_files(replica_xom, files)
+        assert replica_xom.replica_thread.shared_data.errors.errors == {}
+
+    def test_fallback(self, http, monkeypatch, replica_xom, upload_files, xom):
+        files = upload_files()
+        monkeypatch.setattr(replica_xom.frt, "http", http)
+        primary_url = replica_xom.config.primary_url
+        for relpath, content in files.items():
+            http.mockresponse(primary_url.joinpath(relpath).url, content=content)
+        self.replay(monkeypatch, xom, replica_xom)
+        self.process_batch(replica_xom)
+        # the primary doesn't support batches
+        assert replica_xom.replica_thread.shared_data.file_batch_size == 0
+        self.assert_files(replica_xom, files)
+        assert [x["url"] for x in http.call_log][0] == (
+            "http://localhost/+replica-files")
+
+
+class TestAsyncFileReplication:
+    @pytest.fixture
+    def replica_xom(self, http, makexom, monkeypatch, secretfile):
+        replica_xom = makexom([
+            "--primary-url", "http://localhost",
+            "--file-replication-threads", "1",
+            "--file-replication-concurrency", "4",
+            "--secretfile", secretfile])
+        replica_xom.replica_thread.shared_data.ERROR_QUEUE_MAX_DELAY = 0.1
+        async_frt = replica_xom.replica_thread.async_file_replication_thread
+        assert replica_xom.replica_thread.file_replication_threads == []
+        monkeypatch.setattr(async_frt.frt, "http", http)
+        replica_xom.async_frt = async_frt
+        replica_xom.thread_pool.start_one(async_frt)
+        return replica_xom
+
+    def test_fetch(self, gen, xom, replica_xom):
+        replay(xom, replica_xom)
+        content1 = b'hello'
+        md5_1 = get_hashes(content1, hash_types=("md5",))
+        link = gen.pypi_package_link("pytest-1.8.zip", hash_spec=md5_1.get_spec("md5"))
+        with xom.keyfs.write_transaction():
+            entry = xom.filestore.maplink(link, "root", "pypi", "pytest")
+            entry.file_set_content(content1, hashes=get_hashes(content1))
+        primary_url = replica_xom.config.primary_url
+        primary_file_path = primary_url.joinpath(entry.relpath).url
+        http = replica_xom.async_frt.frt.http
+        # first we try to return something wrong
+        http.mockresponse(primary_file_path, content=b"13")
+        replay(xom, replica_xom, events=False)
+        replica_xom.replica_thread.wait(error_queue=False)
+        replication_errors = replica_xom.replica_thread.shared_data.errors
+        assert list(replication_errors.errors.keys()) == [entry.relpath]
+        with replica_xom.keyfs.read_transaction():
+            r_entry = replica_xom.filestore.get_file_entry(entry.relpath)
+            assert not r_entry.file_exists()
+        # then we return the correct thing
+        with xom.keyfs.write_transaction():
+            # trigger a change
+            entry.last_modified = 'Fri, 09 Aug 2019 13:15:02 GMT'
+        http.mockresponse(
+            primary_file_path, content=content1,
+            headers={"content-length": str(len(content1))})
+        replay(xom, replica_xom)
+        assert replication_errors.errors == {}
+        with replica_xom.keyfs.read_transaction():
+            assert r_entry.file_exists()
+            assert r_entry.file_get_content() == content1
+        assert http.call_log
+        for call in http.call_log:
+            assert call["extra_headers"][H_REPLICA_FILEREPL] == "YES"
+
+    def test_retry_errored(self, gen, monkeypatch, xom, replica_xom):
+        replay(xom, replica_xom)
+        content1 = b'hello'
+        md5_1 = get_hashes(content1, hash_types=("md5",))
+        link = gen.pypi_package_link("pytest-1.8.zip", hash_spec=md5_1.get_spec("md5"))
+        with xom.keyfs.write_transaction():
+            entry = xom.filestore.maplink(link, "root", "pypi", "pytest")
+            entry.file_set_content(content1, hashes=get_hashes(content1))
+        primary_url = replica_xom.config.primary_url
+        primary_file_path = primary_url.joinpath(entry.relpath).url
+        http = replica_xom.async_frt.frt.http
+        shared_data = replica_xom.replica_thread.shared_data
+        http.mockresponse(primary_file_path, code=500)
+        replay(xom, replica_xom, events=False)
+        replica_xom.replica_thread.wait(error_queue=False)
+        assert list(shared_data.errors.errors.keys()) == [entry.relpath]
+
+        # errored items are retried on the loop, not with the blocking handler
+        def handler(*args):
+            raise RuntimeError
+        monkeypatch.setattr(replica_xom.async_frt.frt, "handler", handler)
+        http.mockresponse(
+            primary_file_path, content=content1,
+            headers={"content-length": str(len(content1))})
+        shared_data.wait(error_queue=True)
+        assert shared_data.errors.errors == {}
+        with replica_xom.keyfs.read_transaction():
+            r_entry = replica_xom.filestore.get_file_entry(entry.relpath)
+            assert r_entry.file_get_content() == content1
+        assert replica_xom.async_frt.running == 0
+
+    def test_many_files(self, mapp, xom, replica_xom):
+        mapp.create_and_use()
+        contents = {}
+        for i in range(10):
+            basename = f"hello-1.{i}.tar.gz"
+            content = mapp.makepkg(basename, b"content%d" % i, "hello", f"1.{i}")
+            mapp.upload_file_pypi(basename, content, "hello", f"1.{i}")
+            contents[basename] = content
+        http = replica_xom.async_frt.frt.http
+        primary_url = replica_xom.config.primary_url
+        with xom.keyfs.read_transaction():
+            stage = xom.model.getstage(mapp.current_stage)
+            links = stage.get_releaselinks("hello")
+            for link in links:
+                http.mockresponse(
+                    primary_url.joinpath(link.relpath).url,
+                    content=contents[link.basename])
+        replay(xom, replica_xom)
+        replica_xom.replica_thread.wait()
+        with replica_xom.keyfs.read_transaction():
+            for link in links:
+                r_entry = replica_xom.filestore.get_file_entry(link.relpath)
+                assert r_entry.file_get_content() == contents[link.basename]
+        assert replica_xom.async_frt.running == 0
+
+    def test_metrics(self, replica_xom):
+        from devpi_server.replica import devpiserver_metrics
+
+        class Request:
+            registry = dict(xom=replica_xom)
+
+        metrics = {x[0]: x[2] for x in devpiserver_metrics(Request())}
+        assert metrics["devpi_server_replica_file_download_concurrency_limit"] == 1
+        assert metrics["devpi_server_replica_file_download_running"] == 0
+
+
+def test_adaptive_concurrency():
+    from devpi_server.replica import AdaptiveConcurrency
+
+    concurrency = AdaptiveConcurrency(2, 10)
+    assert concurrency.limit == 2
+    for _i in range(20):
+        concurrency.on_latency(0.1)
+    assert concurrency.limit == 10
+    # growing latency reduces the limit
+    for _i in range(5):
+        concurrency.on_latency(1.0)
+    assert 2 <= concurrency.limit < 10
+    limit = concurrency.limit
+    concurrency.on_error()
+    assert concurrency.limit == max(2, int(limit * 0.5))
+    for _i in range(20):
+        concurrency.on_error()
+    assert concurrency.limit == 2
+    # the base latency slowly adapts to lasting changes
+    for _i in range(1000):
+        concurrency.on_latency(1.0)
+    assert concurrency.limit == 10
+
+
+class TestFileReplicationBoost:
+    @pytest.fixture
+    def replica_xom(self, makexom, monkeypatch, secretfile):
+        replica_xom = makexom([
+            "--primary-url", "http://localhost",
+            "--file-replication-threads", "1",
+            "--secretfile", secretfile])
+        (replica_xom.frt,) = replica_xom.replica_thread.file_replication_threads
+        # don't wait for the queue, we process it in the test
+        monkeypatch.setattr(
+            replica_xom.replica_thread, "wait", lambda error_queue=False: None)
+        return replica_xom
+
+    @pytest.fixture
+    def relpaths(self, mapp, replica_xom, xom):
+        mapp.create_and_use()
+        for i in range(3):
+            basename = f"hello-1.{i}.tar.gz"
+            content = mapp.makepkg(basename, b"content%d" % i, "hello", f"1.{i}")
+            mapp.upload_file_pypi(basename, content, "hello", f"1.{i}")
+        with xom.keyfs.read_transaction():
+            stage = xom.model.getstage(mapp.current_stage)
+            links = stage.get_releaselinks("hello")
+            relpaths = {link.version: link.relpath for link in links}
+        replay(xom, replica_xom, events=False)
+        return relpaths
+
+    def process_all(self, shared_data):
+        result = []
+
+        def handler(index_type, serial, key, keyname, value, back_serial):
+            result.append((index_type, key))
+
+        while not shared_data.queue.empty():
+            shared_data.process_next(handler)
+        return result
+
+    def test_index_type_order(self):
+        from devpi_server.replica import IndexType
+        assert IndexType(None, boosted=True) < IndexType("stage")
+        assert IndexType("mirror", boosted=True) < IndexType("stage")
+        assert not IndexType("stage") < IndexType(None, boosted=True)
+        assert IndexType("stage", boosted=True) != IndexType("stage")
+        assert IndexType(IndexType("stage", boosted=True)) == IndexType("stage")
+
+    def test_boost(self, mapp, relpaths, replica_xom):
+        from devpi_server.replica import IndexType
+        shared_data = replica_xom.replica_thread.shared_data
+        assert shared_data.queue.qsize() == 3
+        relpath = relpaths["1.0"]
+        with replica_xom.keyfs.read_transaction():
+            key = replica_xom.filestore.get_key_from_relpath(relpath)
+            assert shared_data.boost(key)
+            # only boosted once while queued
+            assert not shared_data.boost(key)
+        assert shared_data.queue.qsize() == 4
+        assert shared_data.boosted == {relpath}
+        assert shared_data.boosted_count == 1
+        result = self.process_all(shared_data)
+        # the boosted file comes first, the regular entry stays queued
+        assert result == [
+            (IndexType("stage"), relpath),
+            (IndexType("stage"), relpaths["1.2"]),
+            (IndexType("stage"), relpaths["1.1"]),
+            (IndexType("stage"), relpath)]
+        assert shared_data.boosted == set()
+
+    def test_boost_skipped(self, mapp, relpaths, replica_xom):
+        shared_data = replica_xom.replica_thread.shared_data
+        downloads = replica_xom.filestore.downloads
+        relpath = relpaths["1.0"]
+        with replica_xom.keyfs.read_transaction():
+            key = replica_xom.filestore.get_key_from_relpath(relpath)
+            # already in flight
+            (download, started) = downloads.start(relpath)
+            assert started
+            assert not shared_data.boost(key)
+            downloads.finish(download)
+            # index is skipped
+            shared_data.skip_indexes = {mapp.current_stage}
+            assert not shared_data.boost(key)
+            shared_data.skip_indexes = set()
+            # nothing is pending anymore
+            shared_data.init_queue_finished_at = 0
+            self.process_all(shared_data)
+            assert not shared_data.boost(key)
+        assert shared_data.boosted_count == 0
+
+    def test_boost_links(self, mapp, relpaths, replica_xom):
+        shared_data = replica_xom.replica_thread.shared_data
+        with replica_xom.keyfs.read_transaction():
+            stage = replica_xom.model.getstage(mapp.current_stage)
+            links = stage.SimpleLinks(stage.get_simplelinks("hello"))
+            assert shared_data.boost_links(links) == 1
+        assert shared_data.boosted == {relpaths["1.2"]}
+
+    def test_simple_page_boosts(self, maketestapp, mapp, relpaths, replica_xom):
+        shared_data = replica_xom.replica_thread.shared_data
+        testapp = maketestapp(replica_xom)
+        r = testapp.get(f"/{mapp.current_stage}/+simple/hello/")
+        assert r.status_code == 200
+        assert shared_data.boosted == {relpaths["1.2"]}
+
+    def test_skips_running_download(self, mapp, relpaths, replica_xom):
+        from devpi_server.replica import FileDownloadRunning
+        shared_data = replica_xom.replica_thread.shared_data
+        downloads = replica_xom.filestore.downloads
+        relpath = relpaths["1.0"]
+        with replica_xom.keyfs.read_transaction():
+            key = replica_xom.filestore.get_key_from_relpath(relpath)
+            entry = replica_xom.filestore.get_file_entry_from_key(
+                key, meta=key.get())
+        # a client request fetches the file
+        (download, started) = downloads.start(relpath)
+        assert started
+        with pytest.raises(FileDownloadRunning):
+            replica_xom.frt.start_download(entry)
+        # the replication thread doesn't wait, the item is checked later
+        calls = []
+
+        def handler(*args):
+            calls.append(args)
+            replica_xom.frt.start_download(entry)
+
+        shared_data._process(handler, *shared_data._unpack(
+            shared_data.queue.get_nowait()))
+        shared_data.queue.task_done()
+        assert len(calls) == 1
+        assert shared_data.error_queue.qsize() == 1
+        assert shared_data.errors.errors == {}
+        downloads.finish(download)
+
+    def test_registers_download(self, mapp, relpaths, replica_xom):
+        downloads = replica_xom.filestore.downloads
+        relpath = relpaths["1.0"]
+        with replica_xom.keyfs.read_transaction():
+            key = replica_xom.filestore.get_key_from_relpath(relpath)
+            entry = replica_xom.filestore.get_file_entry_from_key(
+                key, meta=key.get())
+        download = replica_xom.frt.start_download(entry)
+        assert relpath in downloads
+        downloads.finish(download)
+        assert relpath not in downloads
+
+
 def test_get_simplelinks_perstage(monkeypatch, pypistage, replica_pypistage,
                                   pypiurls, replica_xom, xom):
     replica_xom.thread_pool.start_one(
@@ -1660,3 +2462,17 @@ class TestFileReplicationSharedData:
         shared_data.process_next(handler)
         (index_type,) = result
         assert index_type == IndexType(None)
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "deflate"])
+def test_iter_compressed(encoding):
+    from devpi_server.replica import iter_compressed
+
+    wbits = 31 if encoding == "gzip" else 15
+    decompressor = zlib.decompressobj(wbits)
+    chunks = [b"foo" * 100, b"bar" * 100, b""]
+    compressed = list(iter_compressed(iter(chunks), encoding, 1))
+    # each chunk can be decoded as soon as it arrives
+    for chunk, data in zip(chunks, compressed):
+        assert decompressor.decompress(data) == chunk
+    assert zlib.decompress(b"".join(compressed), wbits) == b"".join(chunks)
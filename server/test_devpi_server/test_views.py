@@ -10,6 +10,7 @@ from devpi_common.metadata import splitbasename
 from devpi_common.url import URL
 from devpi_common.viewhelp import ViewLinkStore
 from devpi_server.config import hookimpl
+from devpi_server.filestore import FileDownload
 from devpi_server.filestore import FileEntry
 from devpi_server.filestore import get_hash_spec
 from devpi_server.filestore import get_hashes
@@ -23,6 +24,8 @@ import devpi_server.views
 import json
 import posixpath
 import pytest
+import threading
+import time
 
 
 proj = pytest.mark.parametrize("proj", [True, False])
@@ -816,6 +819,63 @@ def test_pkgserv(pypistage, testapp):
     assert r.body == b"123"
 
 
+def test_pkgserv_group_commit(devpiserver_makepypistage, makexom, maketestapp):
+    xom = makexom(["--keyfs-group-commit-window", "0.01"])
+    pypistage = devpiserver_makepypistage(xom)
+    testapp = maketestapp(xom)
+    pypistage.mock_simple("package", '<a href="/package-1.0.zip" />')
+    pypistage.mock_extfile("/package-1.0.zip", b"123")
+    r = testapp.get("/root/pypi/+simple/package/")
+    assert r.status_code == 200
+    serial = xom.keyfs.get_current_serial()
+    href = getfirstlink(r.text).get("href")
+    url = URL(r.request.url).joinpath(href).url
+    r = testapp.get(url)
+    assert r.body == b"123"
+    assert xom.keyfs.get_current_serial() == serial + 1
+    with xom.keyfs.read_transaction():
+        entry = xom.filestore.get_file_entry(URL(url).path.lstrip("/"))
+        assert entry.file_exists()
+
+
+@pytest.mark.parametrize("leader_stores", [True, False])
+def test_pkgserv_single_flight(leader_stores, monkeypatch, pypistage, testapp, xom):
+    pypistage.mock_simple("package", '<a href="/package-1.0.zip" />')
+    r = testapp.get("/root/pypi/+simple/package/")
+    assert r.status_code == 200
+    href = getfirstlink(r.text).get("href")
+    url = URL(r.request.url).joinpath(href).url
+    relpath = URL(url).path.lstrip("/")
+    if not leader_stores:
+        # the follower has to fetch the file itself
+        pypistage.mock_extfile("/package-1.0.zip", b"123")
+    waiting = threading.Event()
+    orig_wait = FileDownload.wait
+
+    def wait(self, timeout):
+        waiting.set()
+        return orig_wait(self, timeout)
+
+    monkeypatch.setattr(FileDownload, "wait", wait)
+    (download, started) = xom.filestore.downloads.start(relpath)
+    assert started
+    results = []
+    thread = threading.Thread(target=lambda: results.append(testapp.get(url)))
+    thread.start()
+    assert waiting.wait(10)
+    if leader_stores:
+        with xom.keyfs.write_transaction():
+            key = xom.filestore.get_key_from_relpath(relpath)
+            entry = xom.filestore.get_file_entry_from_key(key)
+            entry.file_set_content(b"123", hashes=get_hashes(b"123"))
+    xom.filestore.downloads.finish(download)
+    thread.join(10)
+    (r,) = results
+    assert r.status_code == 200
+    assert r.body == b"123"
+    assert relpath not in xom.filestore.downloads
+
+
 def test_pkgserv_caching(mapp, testapp):
     api = mapp.create_and_use()
     mapp.upload_file_pypi("pkg1-2.6.tgz", b"123", "pkg1", "2.6")
@@ -1379,6 +1439,70 @@ def test_push_from_base_error(mapp, testapp, monkeypatch, pypistage):
     assert "no files for" in r.json["message"]
 
 
+def test_simple_project_core_metadata_mirror(pypistage, testapp):
+    metadata = b"Metadata-Version: 2.1\nName: hello\nVersion: 1.0\n"
+    md_hash_spec = get_hashes(metadata).get_default_spec()
+    pypistage.mock_simple(
+        "hello",
+        text=f'<a href="hello-1.0-py3-none-any.whl#sha256={"a" * 64}" '
+             f'data-core-metadata="{md_hash_spec}" />'
+             '<a href="hello-1.0.tar.gz" />')
+    pypistage.mock_extfile(
+        "/simple/hello/hello-1.0-py3-none-any.whl.metadata", metadata)
+    r = testapp.get("/root/pypi/+simple/hello/")
+    assert r.status_code == 200
+    links = {
+        posixpath.basename(x.get("href")).split("#")[0]: x
+        for x in BeautifulSoup(r.text, "html.parser").find_all("a")}
+    wheel_link = links["hello-1.0-py3-none-any.whl"]
+    assert wheel_link.get("data-core-metadata") == md_hash_spec
+    assert wheel_link.get("data-dist-info-metadata") == md_hash_spec
+    assert links["hello-1.0.tar.gz"].get("data-core-metadata") is None
+    r = testapp.get(
+        "/root/pypi/+simple/hello/",
+        headers={"Accept": "application/vnd.pypi.simple.v1+json"})
+    files = {x["filename"]: x for x in r.json["files"]}
+    (hash_type, hash_value) = md_hash_spec.split("=")
+    assert files["hello-1.0-py3-none-any.whl"]["core-metadata"] == {
+        hash_type: hash_value}
+    assert "core-metadata" not in files["hello-1.0.tar.gz"]
+    href = wheel_link.get("href").split("#")[0]
+    metadata_path = URL(r.request.url).joinpath(href).path + ".metadata"
+    r = testapp.get(metadata_path)
+    assert r.status_code == 200
+    assert r.body == metadata
+    # now served from the cache
+    r = testapp.get(metadata_path)
+    assert r.status_code == 200
+    assert r.body == metadata
+    r = testapp.get(
+        URL(r.request.url).joinpath("hello-1.0.tar.gz.metadata").path,
+        expect_errors=True)
+    assert r.status_code == 404
+
+
+def test_simple_project_core_metadata_upload(mapp, testapp):
+    api = mapp.create_and_use()
+    metadata = b"Metadata-Version: 2.1\nName: pkg1\nVersion: 2.6\n"
+    content = zip_dict({
+        "pkg1": {"__init__.py": ""},
+        "pkg1-2.6.dist-info": {"METADATA": metadata, "RECORD": ""}})
+    mapp.upload_file_pypi("pkg1-2.6-py3-none-any.whl", content, "pkg1", "2.6")
+    mapp.upload_file_pypi("pkg1-2.6.tgz", b"123", "pkg1", "2.6")
+    md_hash_spec = get_hashes(metadata).get_default_spec()
+    r = testapp.get(f"/{api.stagename}/+simple/pkg1/")
+    links = {
+        posixpath.basename(x.get("href")).split("#")[0]: x
+        for x in BeautifulSoup(r.text, "html.parser").find_all("a")}
+    wheel_link = links["pkg1-2.6-py3-none-any.whl"]
+    assert wheel_link.get("data-core-metadata") == md_hash_spec
+    assert links["pkg1-2.6.tgz"].get("data-core-metadata") is None
+    href = wheel_link.get("href").split("#")[0]
+    r = testapp.get(URL(r.request.url).joinpath(href).path + ".metadata")
+    assert r.status_code == 200
+    assert r.body == metadata
+
+
 def test_push_from_pypi(mapp, pypistage, testapp):
     pypistage.mock_simple("hello", text='<a href="hello-1.0.tar.gz"/>')
     content = b"123"
@@ -1978,6 +2102,51 @@ def test_delete_from_mirror(mapp, pypistage, testapp):
         assert not getentry(testapp, other_path).file_exists()
 
 
+def test_evict_cached_files_from_mirror(pypistage, testapp):
+    from devpi_server.mirror import MirrorCacheEvictionThread
+
+    name = "pkg"
+    paths = ["/%s-%s.zip" % (name, x) for x in ("1.0", "2.0", "3.0")]
+    pypistage.mock_simple(
+        name, text="\n".join('<a href="%s"/>' % x for x in paths))
+    for path in paths:
+        pypistage.mock_extfile(path, b"1234567890")
+    r = testapp.get('/root/pypi/+simple/%s' % name)
+    links = sorted(
+        x.get('href').replace('../../', '/root/pypi/')
+        for x in getlinks(r.text))
+    for link in links:
+        testapp.xget(200, link)
+    # access the first file again, so it is the most recently used
+    time.sleep(0.01)
+    testapp.xget(200, links[0])
+    relpaths = [x[1:].split("#")[0] for x in links]
+    keyfs = testapp.xom.keyfs
+    with keyfs.read_transaction():
+        stage = testapp.xom.model.getstage("root/pypi")
+        assert stage.get_eviction_candidates(30) == []
+        assert stage.get_eviction_candidates(15) == [
+            (relpaths[1], 10), (relpaths[2], 10)]
+    with keyfs.write_transaction():
+        stage = testapp.xom.model.getstage("root/pypi")
+        stage.modify(mirror_cache_quota="15")
+    thread = MirrorCacheEvictionThread(testapp.xom)
+    thread.tick()
+    with keyfs.read_transaction():
+        assert getentry(testapp, relpaths[0]).file_exists()
+        for relpath in relpaths[1:]:
+            entry = getentry(testapp, relpath)
+            assert not entry.file_exists()
+            # the metadata is kept
+            assert entry.meta
+    # the files are fetched again on demand
+    for path in paths[1:]:
+        pypistage.mock_extfile(path, b"1234567890")
+    testapp.xget(200, links[1])
+    with keyfs.read_transaction():
+        assert getentry(testapp, relpaths[1]).file_exists()
+
+
 def test_delete_version_from_mirror(mapp, pypistage, testapp):
     mapp.login_root()
     mapp.use("root/pypi")
@@ -45,6 +45,21 @@ class TestStatus:
             ['devpi_plugin_my_size', 'gauge', 20.0],
             ['devpi_plugin_my_totals', 'counter', 10.0]]
 
+    def test_storage_cache_memory_metrics(self, maketestapp, makexom):
+        from devpi_server import keyfs_sqlite
+
+        xom = makexom(["--keyfs-cache-memory", "10"], plugins=[keyfs_sqlite])
+        assert xom.keyfs._storage._relpath_cache.size == 10 * 1024 * 1024
+        testapp = maketestapp(xom)
+        testapp.get_json("/root/pypi", status=200)
+        testapp.get_json("/root/pypi", status=200)
+        r = testapp.get_json("/+status", status=200)
+        metrics = {x[0]: x[2] for x in r.json["result"]["metrics"]}
+        assert metrics["devpi_server_storage_cache_memory_bytes"] > 0
+        assert metrics["devpi_server_storage_cache_user_hits"] > 0
+        assert metrics["devpi_server_storage_cache_user_memory_bytes"] > 0
+        assert "devpi_server_relpath_cache_hits" not in metrics
+
 
 class TestStatusInfoPlugin:
     @pytest.fixture
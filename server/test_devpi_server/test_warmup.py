@@ -0,0 +1,70 @@
+from devpi_common.url import URL
+from devpi_server.warmup import do_warmup
+from devpi_server.warmup import iter_requirements
+import pytest
+
+
+def test_iter_requirements(tmp_path):
+    tmp_path.joinpath("base.txt").write_text("six\n")
+    path = tmp_path / "requirements.txt"
+    path.write_text("\n".join([
+        "# comment",
+        "-r base.txt",
+        "--index-url https://example.com/simple",
+        "-e .",
+        "pkg>=1.0,<2  # inline comment",
+        "other==1.0 \\",
+        "    --hash=sha256:aaaa \\",
+        "    --hash=sha256:bbbb",
+        "direct @ https://example.com/direct-1.0.zip",
+        "",
+    ]))
+    result = [(str(req), hashes) for req, hashes in iter_requirements(path)]
+    assert result == [
+        ("six", set()),
+        ("pkg<2,>=1.0", set()),
+        ("other==1.0", {"sha256:aaaa", "sha256:bbbb"})]
+
+
+@pytest.mark.notransaction
+def test_do_warmup(pypistage, tmp_path, xom):
+    pypistage.mock_simple(
+        "pkg",
+        text='<a href="/pkg-1.0.zip" /><a href="/pkg-1.1.zip" /><a href="/pkg-2.0.zip" />')
+    pypistage.mock_simple("other", text='<a href="/other-1.0.zip" />')
+    pypistage.mock_extfile("/pkg-1.1.zip", b"123")
+    pypistage.mock_extfile("/other-1.0.zip", b"456")
+    path = tmp_path / "requirements.txt"
+    path.write_text("pkg<2\nother\nunknown\n")
+    results = do_warmup(xom, pypistage.name, [path], concurrency=2)
+    results = [(status, URL(info).basename) for status, info in results]
+    assert sorted(results) == [
+        ("fetched", "other-1.0.zip"),
+        ("fetched", "pkg-1.1.zip"),
+        ("missing", "unknown")]
+    results = do_warmup(xom, pypistage.name, [path], concurrency=2)
+    results = [(status, URL(info).basename) for status, info in results]
+    assert sorted(results) == [
+        ("cached", "other-1.0.zip"),
+        ("cached", "pkg-1.1.zip"),
+        ("missing", "unknown")]
+
+
+def test_warmup_fails_while_server_running(capsys, tmp_path):
+    from devpi_server.init import init
+    from devpi_server.main import lock_server_path
+    from devpi_server.warmup import warmup
+
+    pytest.importorskip("fcntl")
+    serverdir = tmp_path / "server"
+    init(argv=["devpi-init", "--serverdir", str(serverdir)])
+    path = tmp_path / "requirements.txt"
+    path.write_text("pkg\n")
+    capsys.readouterr()
+    server_lock = lock_server_path(serverdir)
+    try:
+        assert warmup(argv=["devpi-warmup", "--serverdir", serverdir, path]) == 1
+    finally:
+        server_lock.close()
+    (out, err) = capsys.readouterr()
+    assert "can't be used while devpi-server is running" in err